@@ -0,0 +1,78 @@
+'''
+File: bench_auth.py
+Author: Konrad Wasowicz
+Description: Measures authentication requests per second (GET /auth)
+with password hashing inline on the IOLoop and on process pools of
+different sizes
+
+usage: python benchmarks/bench_auth.py --requests=200 --concurrency=16 --pools=0,1,2,4
+'''
+
+import argparse
+import simplejson as json
+
+from bench_utils import temp_database, report, Timer
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient
+from tornado import gen, netutil
+
+from models import metadata, create_db_engine
+from views import Application
+
+
+@gen.coroutine
+def run(port, requests, concurrency):
+    client = AsyncHTTPClient(max_clients = concurrency)
+    base = "http://127.0.0.1:{0}".format(port)
+    user = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+    yield client.fetch(base + "/users", method = "POST", body = json.dumps(dict(user = user)))
+
+    samples = list()
+
+    @gen.coroutine
+    def authenticate():
+        with Timer() as t:
+            resp = yield client.fetch(base + "/auth?username=konrad&password=deprofundis")
+        assert resp.body == "1"
+        samples.append(t.elapsed)
+
+    with Timer() as total:
+        for start in xrange(0, requests, concurrency):
+            yield [authenticate() for i in xrange(min(concurrency, requests - start))]
+    raise gen.Return((samples, total.elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--requests", type = int, default = 200)
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--pools", default = "0,1,2,4",
+                        help = "comma separated hash process pool sizes, 0 hashes inline")
+    args = parser.parse_args()
+
+    for processes in [int(n) for n in args.pools.split(",")]:
+        engine = create_db_engine(temp_database())
+        metadata.create_all(engine)
+        app = Application(engine, hash_processes = processes)
+        # every request has to hash the password, not hit the auth cache
+        app.auth_cache.max_entries = 0
+
+        sockets = netutil.bind_sockets(0, "127.0.0.1")
+        port = sockets[0].getsockname()[1]
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+
+        samples, elapsed = IOLoop.instance().run_sync(lambda: run(port, args.requests, args.concurrency))
+        report("hash processes={0}".format(processes), samples)
+        print "  auth requests/s: {0:.1f}".format(len(samples) / elapsed)
+
+        server.stop()
+        app.hash_executor.shutdown()
+        app.db_executor.shutdown()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+'''
+File: bench_columnar.py
+Author: Konrad Wasowicz
+Description: Compares payload size, build and encode time of product pages
+in the default shape (dict keyed by uuid) and in columnar format
+
+usage: python benchmarks/bench_columnar.py --page=500 --iterations=200
+'''
+
+import argparse
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from models import metadata, products, create_db_engine
+from db_base import ProductDatabaseHandler
+from serializers import dumps, encoder_name
+
+
+def seed(conn, rows):
+    conn.execute(products.insert(), [
+        dict(product_uuid = str(uuid.uuid4()), product_name = u"product{0}".format(i),
+             product_desc = u"Wiertarka udarowa z zestawem wiertel, {0}".format(i),
+             category = u"category{0}".format(i % 10), price = u"{0}zl".format(i), seller = u"konrad")
+        for i in xrange(rows)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--page", type = int, default = 500)
+    parser.add_argument("--iterations", type = int, default = 200)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    conn = engine.connect()
+    seed(conn, args.page)
+    handler = ProductDatabaseHandler(conn)
+    print "{0} products per page, encoded with {1}".format(args.page, encoder_name)
+
+    for label, columnar in (("dict", False), ("columnar", True)):
+        build, encode = list(), list()
+        for i in xrange(args.iterations):
+            with Timer() as t:
+                page = handler.get_product_list(args.page, 0, columnar = columnar)
+            build.append(t.elapsed)
+            with Timer() as t:
+                body = dumps(dict(products = page))
+            encode.append(t.elapsed)
+        report(label + " query+build", build)
+        report(label + " encode", encode)
+        print "  payload: {0} bytes".format(len(body))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
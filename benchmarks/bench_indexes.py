@@ -0,0 +1,97 @@
+'''
+File: bench_indexes.py
+Author: Konrad Wasowicz
+Description: Compares lookup queries from db_base.py with and without
+secondary indexes on a seeded database
+
+usage: python benchmarks/bench_indexes.py --rows=1000000
+'''
+
+import argparse
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from models import metadata, users, products, bought_products, create_db_engine
+from db_base import UserDatabaseHandler, ProductDatabaseHandler, BoughtDBHandler
+
+
+def seed(conn, rows):
+    """
+    Inserts rows products and purchases and rows / 10 users
+    """
+    number_of_users = max(rows / 10, 1)
+    batch = 10000
+    trans = conn.begin()
+    for start in xrange(0, number_of_users, batch):
+        conn.execute(users.insert(), [
+            dict(user_uuid = str(uuid.uuid4()), username = "user{0}".format(i),
+                 password = "x", email = "user{0}@mail.com".format(i), joined = "2014-03-02")
+            for i in xrange(start, min(start + batch, number_of_users))])
+    for start in xrange(0, rows, batch):
+        conn.execute(products.insert(), [
+            dict(product_uuid = str(uuid.uuid4()), product_name = "product{0}".format(i),
+                 product_desc = "desc", category = "category{0}".format(i % 100),
+                 price = "10zl", seller = "user{0}".format(i % number_of_users))
+            for i in xrange(start, min(start + batch, rows))])
+    for start in xrange(0, rows, batch):
+        conn.execute(bought_products.insert(), [
+            dict(quantity = 1, user_id = i % number_of_users + 1, product_id = (i * 7) % rows + 1)
+            for i in xrange(start, min(start + batch, rows))])
+    trans.commit()
+    return number_of_users
+
+
+def run_lookups(conn, rows, number_of_users, iterations):
+    user_handler = UserDatabaseHandler(conn)
+    product_handler = ProductDatabaseHandler(conn)
+    bought_handler = BoughtDBHandler(conn)
+
+    lookups = (
+        ("get_uuid_by_username", lambda i: user_handler.get_uuid_by_username("user{0}".format(i % number_of_users))),
+        ("credentials_unique", lambda i: user_handler.credentials_unique("nobody", "user{0}@mail.com".format(i % number_of_users))),
+        ("get_product by name", lambda i: product_handler.get_product("product{0}".format(i * 13 % rows), uuid = False)),
+        ("get_users_sold_products", lambda i: bought_handler.get_users_sold_products("user{0}".format(i % number_of_users))),
+        ("get_product_list category", lambda i: product_handler.get_product_list(10, 0, "category{0}".format(i % 100))),
+        ("get_users_bought_products", lambda i: bought_handler.get_users_bought_products("user{0}".format(i % number_of_users), uuid = False)),
+    )
+    for label, lookup in lookups:
+        samples = list()
+        for i in xrange(iterations):
+            with Timer() as t:
+                lookup(i)
+            samples.append(t.elapsed)
+        report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--rows", type = int, default = 1000000)
+    parser.add_argument("--iterations", type = int, default = 20)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    conn = engine.connect()
+    for table in (users, products, bought_products):
+        for index in table.indexes:
+            index.drop(conn)
+
+    with Timer() as t:
+        number_of_users = seed(conn, args.rows)
+    print "seeded {0} products and purchases, {1} users in {2:.1f}s".format(args.rows, number_of_users, t.elapsed)
+
+    print "\nwithout secondary indexes:"
+    run_lookups(conn, args.rows, number_of_users, args.iterations)
+
+    for table in (users, products, bought_products):
+        for index in table.indexes:
+            index.create(conn)
+    conn.execute("ANALYZE")
+
+    print "\nwith secondary indexes:"
+    run_lookups(conn, args.rows, number_of_users, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+'''
+File: bench_product_writes.py
+Author: Konrad Wasowicz
+Description: Measures http requests served by the application and latency
+of every product write (POST /products, PUT /product, DELETE /product)
+
+usage: python benchmarks/bench_product_writes.py --writes=200
+'''
+
+import argparse
+import simplejson as json
+
+from bench_utils import temp_database, report, Timer
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado import gen, netutil
+
+from models import metadata, create_db_engine
+from views import Application
+
+
+class RequestCounter(object):
+
+    """
+    Used as tornado log_function, counts every request served
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, handler):
+        self.count += 1
+
+
+@gen.coroutine
+def run(port, counter, writes):
+    client = AsyncHTTPClient()
+    base = "http://127.0.0.1:{0}".format(port)
+    user = dict(username = "konrad", password = "deprofundis")
+
+    yield client.fetch(base + "/users", method = "POST",
+                       body = json.dumps(dict(user = dict(user, email = "konrad@gmail.com"))))
+
+    timings = dict(post = [], put = [], delete = [])
+    served = dict(post = 0, put = 0, delete = 0)
+
+    for i in xrange(writes):
+        name = "product{0}".format(i)
+        requests = [
+            ("post", HTTPRequest(base + "/products", method = "POST",
+                                 body = json.dumps(dict(user = user, product = dict(
+                                     product_name = name, product_desc = "desc",
+                                     category = "bench", price = "10zl"))))),
+            ("put", HTTPRequest(base + "/product", method = "PUT",
+                                body = json.dumps(dict(user = user, update = dict(
+                                    product_name = name, product_desc = "changed"))))),
+            ("delete", HTTPRequest(base + "/product?id=" + name + "&name=konrad&password=deprofundis",
+                                   method = "DELETE")),
+        ]
+        for kind, req in requests:
+            before = counter.count
+            with Timer() as t:
+                yield client.fetch(req)
+            timings[kind].append(t.elapsed)
+            served[kind] += counter.count - before
+
+    for kind in ("post", "put", "delete"):
+        report(kind, timings[kind])
+        print "  requests served per write: {0:.2f}".format(served[kind] / float(writes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--writes", type = int, default = 200)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.bind = engine
+    metadata.create_all()
+
+    counter = RequestCounter()
+    app = Application(engine)
+    app.settings["log_function"] = counter
+
+    sockets = netutil.bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+
+    IOLoop.instance().run_sync(lambda: run(port, counter, args.writes))
+
+
+if __name__ == "__main__":
+    main()
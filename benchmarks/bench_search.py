@@ -0,0 +1,101 @@
+'''
+File: bench_search.py
+Author: Konrad Wasowicz
+Description: Measures latency of full text product search
+(ProductDatabaseHandler.search_products) on large catalog
+for rare, common and multi word queries and deep pages,
+compared to LIKE scan over names and descriptions
+
+usage: python benchmarks/bench_search.py --products=1000000
+'''
+
+import argparse
+import random
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from sqlalchemy.sql import select, or_
+
+from models import metadata, products, create_db_engine
+from db_base import ProductDatabaseHandler
+
+
+WORDS = (u"wiertarka pralka lodowka szlifierka odkurzacz suszarka mlotek klucz pila zegar "
+         u"lampa kabel bateria ladowarka sluchawki glosnik monitor klawiatura myszka drukarka "
+         u"bosch makita amica samsung philips sony dell logitech canon braun").split()
+ADJECTIVES = (u"udarowa automatyczna bezprzewodowa reczna cyfrowa przenosna mocna cicha "
+              u"lekka kompaktowa profesjonalna wodoodporna czarna biala srebrna").split()
+
+
+def seed(conn, number_of_products):
+    """
+    Inserts products with names and descriptions drawn from WORDS and ADJECTIVES,
+    index is filled by triggers as in production
+    """
+    rand = random.Random(1)
+    batch = 10000
+    trans = conn.begin()
+    for start in xrange(0, number_of_products, batch):
+        conn.execute(products.insert(), [
+            dict(product_uuid = str(uuid.uuid4()),
+                 product_name = u"{0} {1}".format(rand.choice(WORDS), i),
+                 product_desc = u" ".join(rand.choice(WORDS + ADJECTIVES) for word in xrange(12)),
+                 category = u"category{0}".format(i % 20), price = u"{0}zl".format(i % 1000), seller = u"konrad")
+            for i in xrange(start, min(start + batch, number_of_products))])
+    # a few products with rare word
+    conn.execute(products.update().where(products.c.product_id % 100000 == 7)
+                 .values(product_desc = products.c.product_desc + u" unikat"))
+    trans.commit()
+
+
+def like_search(conn, word, limit):
+    """
+    Substring search available without the full text index
+    """
+    pattern = u"%{0}%".format(word)
+    columns = list(products.columns)[1:]
+    sel = select(columns).where(or_(products.c.product_name.like(pattern), products.c.product_desc.like(pattern)))\
+            .limit(limit)
+    return conn.execute(sel).fetchall()
+
+
+def measure(label, function, iterations):
+    samples = list()
+    for i in xrange(iterations):
+        with Timer() as t:
+            function()
+        samples.append(t.elapsed)
+    report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--products", type = int, default = 1000000)
+    parser.add_argument("--iterations", type = int, default = 20)
+    parser.add_argument("--limit", type = int, default = 10)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    conn = engine.connect()
+    with Timer() as t:
+        seed(conn, args.products)
+    print "seeded {0} products in {1:.1f}s".format(args.products, t.elapsed)
+    handler = ProductDatabaseHandler(conn)
+    limit = args.limit
+
+    measure("search rare word", lambda: handler.search_products(u"unikat", limit, 0), args.iterations)
+    measure("search two words", lambda: handler.search_products(u"makita udarowa cicha", limit, 0), args.iterations)
+    measure("search common word", lambda: handler.search_products(u"bosch", limit, 0), args.iterations)
+    measure("search common, offset 1000", lambda: handler.search_products(u"bosch", limit, 1000), args.iterations)
+    measure("search common, category", lambda: handler.search_products(u"bosch", limit, 0, u"category3"),
+            args.iterations)
+    measure("search common, columnar", lambda: handler.search_products(u"bosch", limit, 0, columnar = True),
+            args.iterations)
+    measure("LIKE rare word", lambda: like_search(conn, u"unikat", limit), args.iterations)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+'''
+File: bench_serializers.py
+Author: Konrad Wasowicz
+Description: Measures cost of encoding 100 product page with every
+available JSON library and of generic status responses
+with and without pre-encoded envelopes
+
+usage: python benchmarks/bench_serializers.py --iterations=2000
+'''
+
+import argparse
+import uuid
+import simplejson
+
+from bench_utils import temp_database, report, Timer
+
+from models import metadata, products, create_db_engine
+from db_base import ProductDatabaseHandler
+from serializers import ENCODERS, encoder_name, response_envelope
+
+
+def product_page(engine, size = 100):
+    """
+    Returns response of /products with size products, as built by ProductsHandler
+    """
+    conn = engine.connect()
+    conn.execute(products.insert(), [
+        dict(product_uuid = str(uuid.uuid4()), product_name = u"product{0}".format(i),
+             product_desc = u"Wiertarka udarowa z zestawem wiertel, {0}".format(i),
+             category = u"category{0}".format(i % 10), price = u"{0}zl".format(i), seller = u"konrad")
+        for i in xrange(size)])
+    page = dict(products = ProductDatabaseHandler(conn).get_product_list(size, 0))
+    page["_metadata"] = dict(total = size, limit = size, offset = 0)
+    page["status"] = 200
+    page["message"] = "OK"
+    conn.close()
+    return page
+
+
+def measure(label, function, iterations):
+    samples = list()
+    for i in xrange(iterations):
+        with Timer() as t:
+            function()
+        samples.append(t.elapsed)
+    report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--iterations", type = int, default = 2000)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    page = product_page(engine)
+    print "page size: {0} bytes, responses use {1}".format(len(simplejson.dumps(page)), encoder_name)
+
+    for name, load in sorted(ENCODERS.items()):
+        try:
+            dumps = load()
+        except ImportError:
+            print "{0:<28} not installed".format(name)
+            continue
+        measure("page " + name, lambda: dumps(page), args.iterations)
+
+    response_codes = dict(Success = 200, Bad_Request = 400, Server_Error = 500, Created = 201,
+                          Not_Found = 404, Unauthorized = 401, Forbidden = 403, Conflict = 409)
+
+    def generic_dumps():
+        # what generic_resp did before envelopes
+        message = "Unknown_Message"
+        for key, val in response_codes.items():
+            if val == 404:
+                message = key
+        return simplejson.dumps(dict(status = 404, message = message, _meta = None))
+
+    measure("status dict + dumps", generic_dumps, args.iterations)
+    measure("status envelope", lambda: response_envelope(404, "Not_Found"), args.iterations)
+    measure("status envelope + _meta", lambda: response_envelope(201, "Created", "Bought succesfully"), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+'''
+File: bench_statements.py
+Author: Konrad Wasowicz
+Description: Measures per call overhead of hot lookups (get_scalar,
+get_credentials, get_row) building and compiling select every call
+compared to prebuilt statements compiled once (see statements.py)
+
+usage: python benchmarks/bench_statements.py --iterations=5000
+'''
+
+import argparse
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from models import metadata, users, create_db_engine
+from db_base import UserDatabaseHandler
+from config import USER_FIELDS
+from sqlalchemy.sql import select, or_
+
+
+def measure(label, function, iterations):
+    samples = list()
+    for i in xrange(iterations):
+        with Timer() as t:
+            function()
+        samples.append(t.elapsed)
+    report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--iterations", type = int, default = 5000)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    conn = engine.connect()
+    user_uuid = str(uuid.uuid4())
+    conn.execute(users.insert().values(user_uuid = user_uuid, username = u"konrad",
+                                       password = "x" * 120, email = "konrad@gmail.com"))
+    handler = UserDatabaseHandler(conn)
+
+    # what the lookups did before the statement registry
+    def built_scalar():
+        sel = select([users.c.username]).where(users.c.user_uuid == user_uuid)
+        return conn.execute(sel).scalar()
+
+    def built_credentials():
+        sel = select([users.c.username, users.c.password, users.c.user_uuid])\
+                .where(or_(users.c.username == u"konrad", users.c.user_uuid == u"konrad"))
+        return conn.execute(sel).fetchone()
+
+    def built_row():
+        names, columns = handler.get_columns(users, USER_FIELDS)
+        return dict(zip(names, conn.execute(select(columns).where(users.c.user_uuid == user_uuid)).fetchone()))
+
+    measure("get_scalar built", built_scalar, args.iterations)
+    measure("get_scalar prebuilt", lambda: handler.get_username_by_uuid(user_uuid), args.iterations)
+    measure("get_credentials built", built_credentials, args.iterations)
+    measure("get_credentials prebuilt", lambda: handler.get_credentials(u"konrad"), args.iterations)
+    measure("get_row built", built_row, args.iterations)
+    measure("get_row prebuilt", lambda: handler.get_user(user_uuid), args.iterations)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
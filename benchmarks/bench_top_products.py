@@ -0,0 +1,111 @@
+'''
+File: bench_top_products.py
+Author: Konrad Wasowicz
+Description: Compares /products/top computed by aggregating whole
+bought_products table (SUM GROUP BY) against reading maintained
+product_sales through its quantity index, also measures what
+maintaining product_sales costs every purchase
+
+usage: python benchmarks/bench_top_products.py --purchases=10000000
+'''
+
+import argparse
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from sqlalchemy import desc, func
+from sqlalchemy.sql import select
+
+from models import metadata, users, products, bought_products, create_db_engine
+from db_base import BoughtDBHandler, MiscDBHandler
+
+
+def seed(conn, purchases, number_of_products):
+    """
+    Inserts number_of_products products and purchases rows of bought products,
+    every user buys each product once so there are purchases / products users
+    """
+    number_of_users = max(purchases / number_of_products, 1)
+    batch = 10000
+    trans = conn.begin()
+    for start in xrange(0, number_of_users, batch):
+        conn.execute(users.insert(), [
+            dict(user_uuid = str(uuid.uuid4()), username = "user{0}".format(i),
+                 password = "x", email = "user{0}@mail.com".format(i), joined = "2014-03-08")
+            for i in xrange(start, min(start + batch, number_of_users))])
+    for start in xrange(0, number_of_products, batch):
+        conn.execute(products.insert(), [
+            dict(product_uuid = str(uuid.uuid4()), product_name = "product{0}".format(i),
+                 product_desc = "desc", category = "bench", price = "10zl", seller = "user0")
+            for i in xrange(start, min(start + batch, number_of_products))])
+    # raw dbapi executemany, building dicts for 10M rows takes longer than inserting them
+    cursor = conn.connection.cursor()
+    for start in xrange(0, purchases, batch * 10):
+        cursor.executemany("INSERT INTO bought_products (quantity, user_id, product_id) VALUES (?, ?, ?)",
+                           ((i % 97 + 1, i / number_of_products + 1, i % number_of_products + 1)
+                            for i in xrange(start, min(start + batch * 10, purchases))))
+    trans.commit()
+    return number_of_users
+
+
+def aggregated_top(conn, limit):
+    """
+    Top sellers query used before product_sales existed
+    """
+    sel = select([products.c.product_name, products.c.product_uuid, func.sum(bought_products.c.quantity).label("sum")])\
+            .select_from(products.join(bought_products))\
+            .group_by(bought_products.c.product_id)\
+            .order_by(desc("sum")).limit(limit)
+    return conn.execute(sel).fetchall()
+
+
+def measure(label, function, iterations):
+    samples = list()
+    for i in xrange(iterations):
+        with Timer() as t:
+            function(i)
+        samples.append(t.elapsed)
+    report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--purchases", type = int, default = 10000000)
+    parser.add_argument("--products", type = int, default = 10000)
+    parser.add_argument("--iterations", type = int, default = 10)
+    parser.add_argument("--limit", type = int, default = 10)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.create_all(engine)
+    conn = engine.connect()
+
+    with Timer() as t:
+        number_of_users = seed(conn, args.purchases, args.products)
+    print "seeded {0} purchases in {1:.1f}s".format(args.purchases, t.elapsed)
+    misc_handler = MiscDBHandler(conn)
+    with Timer() as t:
+        misc_handler.reconcile_counters()
+    print "built product_sales in {0:.1f}s".format(t.elapsed)
+
+    # products with equal sales may come in different order, compare quantities
+    aggregated = sorted(row[2] for row in aggregated_top(conn, args.limit))
+    maintained = sorted(p["quantity"] for p in misc_handler.get_top_selling_products(args.limit).values())
+    if aggregated != maintained:
+        print "warning: approaches returned different quantities"
+
+    measure("top aggregated", lambda i: aggregated_top(conn, args.limit), args.iterations)
+    measure("top product_sales", lambda i: misc_handler.get_top_selling_products(args.limit),
+            args.iterations * 100)
+
+    bought_handler = BoughtDBHandler(conn)
+    measure("purchase with product_sales",
+            lambda i: bought_handler.add_bought_product(1, "user{0}".format(i % number_of_users),
+                                                        "product{0}".format(i % args.products),
+                                                        user_uuid = False, product_uuid = False),
+            args.iterations * 100)
+
+
+if __name__ == "__main__":
+    main()
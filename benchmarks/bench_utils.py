@@ -0,0 +1,58 @@
+'''
+File: bench_utils.py
+Author: Konrad Wasowicz
+Description: Shared helpers for benchmark scripts
+'''
+
+import os, sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "core"))
+
+
+def temp_database():
+    """
+    Returns sqlalchemy url of fresh sqlite file in temp directory
+    """
+    fd, path = tempfile.mkstemp(suffix = ".db", prefix = "consumption_bench_")
+    os.close(fd)
+    os.remove(path)
+    return "sqlite:///" + path
+
+
+def percentile(samples, pct):
+    """
+    Returns pct percentile (0-100) of given samples
+    using nearest rank method
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    rank = max(0, min(rank, len(ordered) - 1))
+    return ordered[rank]
+
+
+def report(label, samples):
+    """
+    Prints basic latency statistics (in ms) for given samples (in seconds)
+    """
+    ms = [s * 1000 for s in samples]
+    print "{0:<28} n={1:<6} mean={2:8.3f}ms p50={3:8.3f}ms p99={4:8.3f}ms".format(
+        label, len(ms), sum(ms) / max(len(ms), 1), percentile(ms, 50), percentile(ms, 99))
+
+
+class Timer(object):
+
+    """
+    Context manager measuring wall clock time of the block
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
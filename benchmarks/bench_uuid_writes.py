@@ -0,0 +1,106 @@
+'''
+File: bench_uuid_writes.py
+Author: Konrad Wasowicz
+Description: Compares write throughput of creating products and users
+when uuid is probed with SELECT EXISTS before every insert
+(generate_unique_uuid, the loop handlers used before) against
+optimistic insert relying on unique uuid index (create_product, create_user)
+
+usage: python benchmarks/bench_uuid_writes.py --writes=2000
+'''
+
+import argparse
+import uuid
+
+from bench_utils import temp_database, report, Timer
+
+from sqlalchemy import event
+
+from models import metadata, create_db_engine, users, products
+from db_base import UserDatabaseHandler, ProductDatabaseHandler
+
+
+class StatementCounter(object):
+
+    """
+    Counts statements executed on engine
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def generate_unique_uuid(handler, column):
+    """
+    Draws uuids until one is not found in given column,
+    one SELECT EXISTS per attempt
+    """
+    while True:
+        sample_uuid = str(uuid.uuid4())
+        if not handler.check_exists(column, sample_uuid):
+            return sample_uuid
+
+
+def probed_product(handler, data):
+    data["uuid"] = generate_unique_uuid(handler, products.c.product_uuid)
+    return handler.save_product(data)
+
+
+def probed_user(handler, data):
+    data["uuid"] = generate_unique_uuid(handler, users.c.user_uuid)
+    return handler.save_user(data)
+
+
+def product_data(prefix, i):
+    return dict(product_name = u"{0}{1}".format(prefix, i), product_desc = u"desc",
+                category = "bench", price = "10zl", seller = "konrad")
+
+
+def user_data(prefix, i):
+    return dict(username = u"{0}{1}".format(prefix, i), password = "pass",
+                email = "{0}{1}@bench.com".format(prefix, i), joined = None)
+
+
+def measure(label, create, make_data, counter, writes):
+    timings = list()
+    before = counter.count
+    with Timer() as total:
+        for i in xrange(writes):
+            data = make_data(label, i)
+            with Timer() as t:
+                create(data)
+            timings.append(t.elapsed)
+    report(label, timings)
+    print "  writes/s: {0:.0f}  statements per write: {1:.2f}".format(
+        writes / total.elapsed, (counter.count - before) / float(writes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--writes", type = int, default = 2000)
+    args = parser.parse_args()
+
+    engine = create_db_engine(temp_database())
+    metadata.bind = engine
+    metadata.create_all()
+    counter = StatementCounter(engine)
+    conn = engine.connect()
+    product_handler = ProductDatabaseHandler(conn)
+    user_handler = UserDatabaseHandler(conn)
+
+    measure("product exists-probe", lambda d: probed_product(product_handler, d),
+            product_data, counter, args.writes)
+    measure("product optimistic", product_handler.create_product,
+            product_data, counter, args.writes)
+    measure("user exists-probe", lambda d: probed_user(user_handler, d),
+            user_data, counter, args.writes)
+    measure("user optimistic", user_handler.create_user,
+            user_data, counter, args.writes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+'''
+File: bench_workers.py
+Author: Konrad Wasowicz
+Description: Measures requests per second served by run.py
+with different number of worker processes (--workers)
+
+usage: python benchmarks/bench_workers.py --workers=1,2,4 --requests=2000 --clients=4
+'''
+
+import argparse
+import logging
+import os, sys
+import signal
+import socket
+import subprocess
+import time
+import multiprocessing
+import simplejson as json
+
+from bench_utils import ROOT_DIR, temp_database, report, Timer
+
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPClient
+from tornado import gen
+
+from models import metadata, create_db_engine
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, workers, database):
+    """
+    Starts run.py in its own process group (so workers can be killed
+    together with the parent) and waits until it accepts requests
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "run.py"),
+                               "--port={0}".format(port), "--workers={0}".format(workers),
+                               "--database={0}".format(database), "--logging=none"],
+                              stdout = open(os.devnull, "w"), preexec_fn = os.setsid)
+    # connection errors are expected until server starts listening
+    logging.getLogger("tornado.general").setLevel(logging.ERROR)
+    client = HTTPClient()
+    for attempt in xrange(100):
+        try:
+            client.fetch("http://127.0.0.1:{0}/stats".format(port))
+            return server
+        except Exception:
+            time.sleep(0.1)
+    stop_server(server)
+    raise RuntimeError("server didnt start")
+
+
+def stop_server(server):
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+
+
+def seed(port):
+    """
+    Creates user with bought products through the api
+    """
+    client = HTTPClient()
+    base = "http://127.0.0.1:{0}".format(port)
+    user = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+    client.fetch(base + "/users", method = "POST", body = json.dumps(dict(user = user)))
+    for i in xrange(20):
+        product = dict(product_name = "product{0}".format(i), product_desc = "desc", price = "10")
+        client.fetch(base + "/products", method = "POST",
+                     body = json.dumps(dict(user = user, product = product)))
+        buy = dict(user = user, product = dict(product_name = "product{0}".format(i), quantity = 1))
+        client.fetch(base + "/products/buy", method = "POST", body = json.dumps(buy))
+
+
+def load(args):
+    """
+    Runs in client process, returns list of request latencies
+    """
+    url, requests, concurrency = args
+    samples = list()
+
+    @gen.coroutine
+    def run():
+        client = AsyncHTTPClient(max_clients = concurrency)
+
+        @gen.coroutine
+        def fetch():
+            with Timer() as t:
+                yield client.fetch(url)
+            samples.append(t.elapsed)
+
+        for start in xrange(0, requests, concurrency):
+            yield [fetch() for i in xrange(min(concurrency, requests - start))]
+
+    IOLoop.instance().run_sync(run)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--workers", default = ",".join(str(2 ** i) for i in xrange(8)
+                                                        if 2 ** i <= multiprocessing.cpu_count()),
+                        help = "comma separated numbers of worker processes")
+    parser.add_argument("--requests", type = int, default = 2000)
+    parser.add_argument("--concurrency", type = int, default = 16, help = "per client process")
+    parser.add_argument("--clients", type = int, default = 4, help = "load generating processes")
+    parser.add_argument("--path", default = "/user/konrad/bought",
+                        help = "requested route, default one isnt cached")
+    args = parser.parse_args()
+
+    database = temp_database()
+    engine = create_db_engine(database)
+    metadata.create_all(engine)
+    engine.dispose()
+    seeded = False
+    for workers in [int(n) for n in args.workers.split(",")]:
+        port = free_port()
+        server = start_server(port, workers, database)
+        try:
+            if not seeded:
+                seed(port)
+                seeded = True
+            url = "http://127.0.0.1:{0}{1}".format(port, args.path)
+            per_client = args.requests // args.clients
+            # clients are forked before any IOLoop exists in this process
+            pool = multiprocessing.Pool(args.clients)
+            with Timer() as total:
+                results = pool.map(load, [(url, per_client, args.concurrency)] * args.clients)
+            pool.close()
+            pool.join()
+        finally:
+            stop_server(server)
+        samples = [sample for result in results for sample in result]
+        report("workers={0}".format(workers), samples)
+        print "  requests/s: {0:.1f}".format(len(samples) / total.elapsed)
+
+
+if __name__ == "__main__":
+    main()
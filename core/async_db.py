@@ -0,0 +1,134 @@
+'''
+File: async_db.py
+Author: Konrad Wasowicz
+Description: Runs database handlers on a thread pool so that slow queries
+dont block the IOLoop
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import dummy_executor
+
+from config import *
+from models import current_query_stats, collect_queries
+
+
+class ThreadedDBExecutor(object):
+
+    """
+    Bounded thread pool for database work,
+    every worker thread lazily opens and keeps its own connection
+    taken from given engine (with connect if given, eg. PoolStats.connect
+    measuring time spent waiting for the pool)
+    """
+
+    def __init__(self, engine, max_workers = DB_THREADS, connect = None):
+        self.engine = engine
+        self.connect = connect or engine.connect
+        self.executor = ThreadPoolExecutor(max_workers)
+        self._local = threading.local()
+
+    def connection(self):
+        """
+        Returns connection bound to the current worker thread
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self.connect()
+            self._local.conn = conn
+        return conn
+
+    def run(self, handler_class, method, args, kwargs, stats = None):
+        with collect_queries(stats):
+            handler = handler_class(self.connection())
+            return getattr(handler, method)(*args, **kwargs)
+
+    def submit(self, handler_class, method, *args, **kwargs):
+        """
+        Schedules handler_class(conn).method(*args, **kwargs)
+        on the pool, returns future,
+        statements are counted for request that scheduled them
+        """
+        return self.executor.submit(self.run, handler_class, method, args, kwargs,
+                                    current_query_stats())
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait)
+
+
+class InlineDBExecutor(object):
+
+    """
+    Runs database handlers synchronously on a single connection
+    and returns already resolved futures,
+    used when connection cannot be shared between threads
+    (eg. sqlite in-memory database)
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def run(self, handler_class, method, args, kwargs):
+        handler = handler_class(self.conn)
+        return getattr(handler, method)(*args, **kwargs)
+
+    def submit(self, handler_class, method, *args, **kwargs):
+        return dummy_executor.submit(self.run, handler_class, method, args, kwargs)
+
+    def shutdown(self, wait = True):
+        pass
+
+
+class AsyncDBHandler(object):
+
+    """
+    Proxy returning futures for methods of given database handler class,
+    if cache is given writes invalidate it (see cache.ResponseCache),
+    same for auth_cache (see cache.AuthCache) and revocations
+    (see cache.SessionRevocations)
+
+    sample usage inside coroutine:
+        db = AsyncDBHandler(UserDatabaseHandler, executor)
+        users = yield db.list_all_users(10, 0)
+    """
+
+    def __init__(self, handler_class, executor, cache = None, auth_cache = None, revocations = None):
+        self.handler_class = handler_class
+        self.executor = executor
+        self.cache = cache
+        self.auth_cache = auth_cache
+        self.revocations = revocations
+
+    def create_handler(self, conn):
+        """
+        Creates handler on executor's connection,
+        writes made by it invalidate given caches
+        """
+        handler = self.handler_class(conn)
+        handler.cache = self.cache
+        handler.auth_cache = self.auth_cache
+        handler.revocations = self.revocations
+        return handler
+
+    def __getattr__(self, name):
+        if not callable(getattr(self.handler_class, name, None)):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self.executor.submit(self.create_handler, name, *args, **kwargs)
+        return method
+
+
+def create_db_executor(bind, max_workers = DB_THREADS, connect = None):
+    """
+    Returns executor suitable for given engine or connection,
+    in-memory sqlite databases exist only inside single connection
+    so they are always run inline,
+    connect -- (optional) function checking out connection for worker thread
+    """
+    url = bind.engine.url
+    if not max_workers or (url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:")):
+        if bind is bind.engine:
+            bind = bind.connect()
+        return InlineDBExecutor(bind)
+    return ThreadedDBExecutor(bind.engine, max_workers, connect)
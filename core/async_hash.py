@@ -0,0 +1,36 @@
+'''
+File: async_hash.py
+Author: Konrad Wasowicz
+Description: Runs password hashing on a process pool so that slow
+key derivation doesnt block the IOLoop
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from tornado.concurrent import dummy_executor
+
+from config import *
+from helper_functions import generate_password_hash
+
+
+def create_hash_executor(max_workers = HASH_PROCESSES):
+    """
+    Returns process pool executor for hashing passwords,
+    or executor running them inline if max_workers is 0
+
+    sample usage inside coroutine:
+        valid = yield executor.submit(check_password_hash, password, signature)
+    """
+    if not max_workers:
+        return dummy_executor
+    return ProcessPoolExecutor(max_workers)
+
+
+def hash_passwords(executor, passwords, iterations = PASSWORD_HASH_ITERATIONS):
+    """
+    Hashes list of passwords in parallel on given executor,
+    blocks until all are done so should be called outside of the IOLoop
+    (eg. from db executor thread)
+    """
+    futures = [executor.submit(generate_password_hash, password, iterations = iterations)
+               for password in passwords]
+    return [future.result() for future in futures]
@@ -0,0 +1,368 @@
+'''
+File: cache.py
+Author: Konrad Wasowicz
+Description: In-memory cache of serialized GET responses with
+tag based invalidation and LRU eviction, cache of verified credentials
+and record of revoked session tokens
+'''
+
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+import urllib
+import zlib
+from collections import OrderedDict
+
+from config import *
+
+
+class SharedCounter(object):
+
+    """
+    Counter kept in shared memory, has to be created before
+    worker processes are forked so all of them see the same value
+    """
+
+    def __init__(self):
+        self._value = multiprocessing.Value("L", 0)
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def increment(self):
+        with self._value.get_lock():
+            self._value.value += 1
+            return self._value.value
+
+
+class SessionRevocations(object):
+
+    """
+    Remembers when session tokens of users were revoked
+    (password change, deletion), tokens issued before are rejected
+    without database lookup. Kept in shared memory, has to be created
+    before worker processes are forked so revoking in one worker
+    reaches all of them. Users are hashed into fixed number of slots,
+    users sharing a slot only revoke more tokens than needed
+    """
+
+    def __init__(self, slots = SESSION_REVOCATION_SLOTS):
+        self._times = multiprocessing.Array("d", slots)
+
+    def _slot(self, identifier):
+        if isinstance(identifier, unicode):
+            identifier = identifier.encode("utf-8")
+        return (zlib.crc32(str(identifier)) & 0xffffffff) % len(self._times)
+
+    def revoke(self, identifier):
+        """
+        Revokes tokens issued until now for user with given username or uuid
+        """
+        slot = self._slot(identifier)
+        with self._times.get_lock():
+            self._times[slot] = max(self._times[slot], time.time())
+
+    def revoked(self, issued, *identifiers):
+        """
+        Returns True if token issued at given time (seconds) was revoked
+        for any of given identifiers (username and uuid of its user)
+        """
+        return any(issued <= self._times[self._slot(identifier)] for identifier in identifiers)
+
+
+class WorkerCache(object):
+
+    """
+    Base of in-process caches. Given shared counter (see SharedCounter)
+    invalidations are announced to other worker processes, which drop
+    all their entries next time they use the cache.
+    Subclasses call _sync and _publish holding their lock
+    and implement _drop_all
+    """
+
+    def __init__(self, shared = None):
+        self.shared = shared
+        self._seen = shared.value if shared is not None else 0
+
+    def _sync(self):
+        # other worker invalidated something, we dont know what
+        if self.shared is not None and self.shared.value != self._seen:
+            self._seen = self.shared.value
+            self._drop_all()
+
+    def _publish(self):
+        if self.shared is not None:
+            value = self.shared.increment()
+            if value != self._seen + 1:
+                self._drop_all()
+            self._seen = value
+
+    def _drop_all(self):
+        raise NotImplementedError
+
+
+class ResponseCache(WorkerCache):
+
+    """
+    Keeps serialized response bodies keyed by route and query arguments.
+
+    Every entry is stored with tags (eg. "products", "product:<uuid>"),
+    db handlers call invalidate with the tags their writes affect
+    and all entries carrying any of them are dropped.
+    Total size of entries is capped at max_bytes,
+    least recently used entries are evicted first
+    """
+
+    def __init__(self, max_bytes = RESPONSE_CACHE_BYTES, shared = None):
+        super(ResponseCache, self).__init__(shared)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.tags = dict()
+        self.size = 0
+        # bumped by every invalidation, responses computed while
+        # it changed may contain stale data and are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def key(self, path, arguments):
+        """
+        Returns cache key for given route and query arguments,
+        arguments are sorted so their order doesnt matter
+
+        Keyword Arguments:
+        path -- request path (str)
+        arguments -- dict of argument name -> list of values (as in request.query_arguments)
+        """
+        pairs = sorted((name, value) for name, values in arguments.items() for value in values)
+        return path + "?" + urllib.urlencode(pairs)
+
+    def get(self, key):
+        """
+        Returns tuple (etag, body) for given key or None
+        """
+        with self._lock:
+            self._sync()
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body, tags, generation):
+        """
+        Stores response body, returns its etag
+
+        Keyword Arguments:
+        key -- see key
+        body -- serialized response (str)
+        tags -- iterable of tags invalidating this entry
+        generation -- value of generation read before response was computed,
+        entry is not stored if anything was invalidated since
+        """
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        size = len(key) + len(body)
+        with self._lock:
+            self._sync()
+            if generation != self.generation or size > self.max_bytes:
+                return etag
+            self._remove(key)
+            self.entries[key] = (etag, body, tuple(tags), size)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return etag
+
+    def invalidate(self, *tags):
+        """
+        Drops all entries stored with any of given tags
+        """
+        with self._lock:
+            self._sync()
+            self.generation += 1
+            self.invalidations += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+            self._publish()
+
+    def clear(self):
+        with self._lock:
+            self._drop_all()
+            self._publish()
+
+    def _drop_all(self):
+        self.generation += 1
+        self.entries.clear()
+        self.tags.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[3]
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def as_dict(self):
+        return dict(
+            entries = len(self.entries),
+            bytes = self.size,
+            max_bytes = self.max_bytes,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            invalidations = self.invalidations
+        )
+
+
+class AuthCache(WorkerCache):
+
+    """
+    Remembers recently verified credentials so repeated requests
+    with the same identifier and password skip database lookup
+    and password hashing.
+
+    Entries are keyed by identifier (username or uuid) and HMAC of
+    the password with random per process key, plaintext passwords
+    are never stored. Entries expire after ttl seconds, at most
+    max_entries are kept, least recently used are evicted first.
+    invalidate drops entries of given user immediately
+    (password change, deletion)
+    """
+
+    def __init__(self, max_entries = AUTH_CACHE_SIZE, ttl = AUTH_CACHE_TTL, shared = None):
+        super(AuthCache, self).__init__(shared)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # username and uuid -> keys of entries of that user
+        self.users = dict()
+        # bumped by every invalidation, credentials read from database
+        # while it changed may be stale and are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._secret = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def key(self, identifier, password):
+        if isinstance(identifier, unicode):
+            identifier = identifier.encode("utf-8")
+        if isinstance(password, unicode):
+            password = password.encode("utf-8")
+        return identifier, hmac.new(self._secret, password, hashlib.sha256).digest()
+
+    def get(self, identifier, password):
+        """
+        Returns tuple (username, user_uuid) if credentials were verified
+        within ttl, None otherwise
+        """
+        key = self.key(identifier, password)
+        with self._lock:
+            self._sync()
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] < time.time():
+                self._unlink(key, entry)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[:2]
+
+    def put(self, identifier, password, username, user_uuid, generation):
+        """
+        Stores verified credentials
+
+        Keyword Arguments:
+        identifier -- identifier used for authentication
+        password -- verified password
+        username, user_uuid -- user the credentials belong to,
+        invalidate with either of them drops the entry
+        generation -- value of generation read before credentials were fetched
+        """
+        key = self.key(identifier, password)
+        with self._lock:
+            self._sync()
+            if generation != self.generation or self.max_entries <= 0:
+                return
+            self._remove(key)
+            self.entries[key] = (username, user_uuid, time.time() + self.ttl)
+            for name in (username, user_uuid):
+                self.users.setdefault(name, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, identifier):
+        """
+        Drops all entries of user with given username or uuid
+        """
+        with self._lock:
+            self._sync()
+            self.generation += 1
+            self.invalidations += 1
+            for key in list(self.users.get(identifier, ())):
+                self._remove(key)
+            self._publish()
+
+    def clear(self):
+        with self._lock:
+            self._drop_all()
+            self._publish()
+
+    def _drop_all(self):
+        self.generation += 1
+        self.entries.clear()
+        self.users.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._unlink(key, entry)
+
+    def _unlink(self, key, entry):
+        for name in entry[:2]:
+            keys = self.users.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.users[name]
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return dict(
+            entries = len(self.entries),
+            max_entries = self.max_entries,
+            ttl = self.ttl,
+            hits = self.hits,
+            misses = self.misses,
+            hit_rate = float(self.hits) / lookups if lookups else 0.0,
+            expirations = self.expirations,
+            evictions = self.evictions,
+            invalidations = self.invalidations
+        )
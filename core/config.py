@@ -8,6 +8,30 @@ ROOT_PATH = os.path.dirname(BASE_PATH + "..")
 # define sqlalchemy database path here
 DATABASE_PATH = "sqlite:///" + ROOT_PATH + "/test.db"
 
+# connection pool settings, every request checks out its own connection
+# and every db thread keeps one for itself, so pool should be bigger than DB_THREADS
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 10
+# seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = 30
+
+# number of threads running database queries outside of the IOLoop
+DB_THREADS = 4
+
+# memory (in bytes) used by cached GET responses, least recently used
+# responses are evicted above it, set to 0 to disable the cache
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+# JSON libraries used for encoding responses in order of preference,
+# first one that can be imported is used, simplejson is the fallback
+JSON_ENCODERS = ("ujson", "rapidjson", "simplejson")
+
+# number of recently verified credentials remembered (see cache.AuthCache)
+# and seconds they are trusted for, password change or user deletion
+# drops them earlier, set size to 0 to disable
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+
 #all the user fields
 USER_FIELDS = ("uuid", "username", "password", "email", "joined")
 # fields that can be changed by the user
@@ -21,9 +45,57 @@ PRODUCT_FIELDS = ("uuid", "product_name", "product_desc", "category", "price", "
 CUSTOM_PRODUCT_FIELDS = ("product_name", "product_desc", "category", "price")
 
 
+# maximum number of items bought in single request to /products/buy
+MAX_CART_ITEMS = 100
+
+# maximum number of users created in single bulk request to /users
+MAX_BULK_USERS = 1000
+
+# rows read by single query of /users/export and /products/export,
+# every chunk is written and flushed before next one is read
+EXPORT_CHUNK_ROWS = 500
+
+# maximum number of products returned by single /products/search page
+SEARCH_MAX_LIMIT = 50
+
+# number of values sent in single IN (...) clause,
+# kept low so two lists fit in sqlite's 999 variable limit
+IN_CHUNK_SIZE = 400
+
+# number of attempts at inserting row with random uuid,
+# uuid columns are unique so only collision causes retry
+UUID_RETRIES = 3
+
+
+# algorithm and cost used for new password hashes (see helper_functions),
+# hashes made with other algorithm or lower cost are replaced on login
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = 100000
+# processes verifying and generating password hashes outside of the IOLoop,
+# 0 runs hashing inline
+HASH_PROCESSES = 2
+
 # unique secret key used for encrypting passwords
 SECRET_KEY = "super-secret"
 
+# keys signing session tokens returned by /auth?persist=1, id -> key.
+# New tokens are signed with SESSION_KEY_ID, tokens signed with any key
+# listed here are accepted, to rotate add new key, switch SESSION_KEY_ID
+# to it and remove the old one after SESSION_MAX_AGE
+SESSION_KEYS = {
+    "1": "super-secret-session"
+}
+SESSION_KEY_ID = "1"
+# session token lifetime in seconds
+SESSION_MAX_AGE = 7 * 24 * 3600
+# slots of in-memory record of revoked session tokens (see cache.SessionRevocations),
+# users sharing a slot revoke each others tokens
+SESSION_REVOCATION_SLOTS = 65536
+
 DEBUG = False
 
+# send number of SQL statements and time spent on them (X-Query-Count, X-DB-Time)
+# with every response, they are written to the access log regardless
+QUERY_STATS_HEADERS = DEBUG
+
 # url for this site
@@ -7,11 +7,13 @@ TODO -- Implement db logging hanfling
 
 import logging
 from config import *
-from models import users, bought_products, products, engine
+from models import users, bought_products, products, counters, product_sales, products_search, engine
 from sqlalchemy.sql import select, exists
 from sqlalchemy.sql import and_, or_, not_
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, text, bindparam
 from sqlalchemy.exc import IntegrityError
+from statements import execute
+from helper_functions import parse_price
 
 logging.basicConfig(filename = ROOT_PATH + "/errors.log", level = logging.DEBUG)
 import uuid
@@ -23,10 +25,43 @@ class BaseDBHandler(object):
     Implements basic functions for database interaction.
     """
 
+    # response cache (see cache.ResponseCache) notified about writes,
+    # set by views for handlers serving requests
+    cache = None
+    # cache of verified credentials (see cache.AuthCache)
+    auth_cache = None
+    # revoked session tokens (see cache.SessionRevocations)
+    revocations = None
+
     def __init__(self, conn = None):
         if conn:
             self.conn = conn
 
+    def invalidate(self, *tags):
+        """
+        Drops cached responses carrying any of given tags,
+        called by write methods after their transaction is commited
+
+        tags used:
+            users -- list of users
+            products -- list of products
+            product:<uuid> -- single product
+            top -- top selling products
+        """
+        if self.cache is not None:
+            self.cache.invalidate(*tags)
+
+    def invalidate_credentials(self, identifier):
+        """
+        Forgets verified credentials and revokes session tokens
+        of user with given username or uuid,
+        called when password changes or user is deleted
+        """
+        if self.auth_cache is not None:
+            self.auth_cache.invalidate(identifier)
+        if self.revocations is not None:
+            self.revocations.revoke(identifier)
+
     def parse_query_data(self, query, iter, id = False):
         """
         Parses tuple returned from database by sqlalchemy,  
@@ -66,23 +101,70 @@ class BaseDBHandler(object):
             result[temp[key]] = temp
         return result
 
-    def generate_unique_uuid(self, field_name):
+    def get_columns(self, table, field_tuple, fields = None, exclude = ()):
         """
-        Generates unique 36 characters long uuid 
-        (generated by uuid.uuid4 module)
-        
+        Returns tuple (field names, columns) to select from table,
+        so that fields which are not needed are never fetched
+        raises ValueError if fields contain name not in field_tuple
+        or nothing is left to select
+
         Keyword Arguments:
-        field_name -- column name in sqlalchemy expression language format
-        to compare to, eg. users.c.user_uuid (sqlalchemy column name)
-        """
-        while True:
-            sample_uuid = str(uuid.uuid4())
-            sel = select([exists().where(field_name == sample_uuid)])
-            result = self.conn.execute(sel).scalar()
-            if result == 0:
-                return sample_uuid
-    
-    def get_row(self,table, column, uuid, field_tuple):
+        table -- sqlalchemy table
+        field_tuple -- names of table columns following primary key (eg. USER_FIELDS)
+        fields -- (optional) names of fields to select, all if None
+        exclude -- (optional) names of fields never selected (eg. SECURE_USER_FIELDS)
+        """
+        if fields is not None:
+            unknown = set(fields) - set(field_tuple)
+            if unknown:
+                raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+        names = [name for name in field_tuple
+                 if (fields is None or name in fields) and name not in exclude]
+        if not names:
+            raise ValueError("No fields selected")
+        columns = list(table.columns)[1:]
+        return names, [columns[field_tuple.index(name)] for name in names]
+
+    def parse_rows(self, rows, names, key = "uuid", keep_key = True):
+        """
+        Parses rows selected with columns returned by get_columns
+        (plus key column if it wasnt among them, see get_key_columns)
+        Returns dictionary containing:
+            key: {field_name: value}
+        keep_key -- if False key field is removed from the values
+        """
+        result = dict()
+        for row in rows:
+            temp = dict(zip(names, row))
+            result[temp[key] if keep_key else temp.pop(key)] = temp
+        return result
+
+    def columnar_rows(self, rows, names, start = 0):
+        """
+        Returns rows in columnar format, without building dictionary for every row:
+            {"columns": [field names], "rows": [[values], ...]}
+
+        Keyword Arguments:
+        rows -- rows returned from db
+        names -- field names of consecutive columns
+        start -- index of the column first name refers to (eg. 1 to skip primary key),
+        columns following the named ones are left out
+        """
+        end = start + len(names)
+        return dict(columns = list(names), rows = [row[start:end] for row in rows])
+
+    def get_key_columns(self, table, field_tuple, fields = None, exclude = (), key = "uuid"):
+        """
+        Same as get_columns but key field used by parse_rows is always selected,
+        Returns tuple (names, columns, keep_key)
+        """
+        names, columns = self.get_columns(table, field_tuple, fields, exclude)
+        if key in names:
+            return names, columns, True
+        key_names, key_columns = self.get_columns(table, field_tuple, (key,))
+        return names + key_names, columns + key_columns, False
+
+    def get_row(self,table, column, uuid, field_tuple, fields = None, exclude = ()):
         """
         Returns dictionary containg single row data returned from db
         
@@ -90,14 +172,18 @@ class BaseDBHandler(object):
         column -- sqlalchemy column name (eg. users.c.username)
         uuid -- unique uuid (str)
         field_tuple - iterable containing fields to parse dictionary against (list/tuple)
+        fields, exclude -- (optional) limit selected fields, see get_columns
         """
-        sel = select([table]).where(column == uuid)
-        q = self.conn.execute(sel).fetchone()
+        names, columns = self.get_columns(table, field_tuple, fields, exclude)
+        q = execute(self.conn, ("row", tuple(columns), column),
+                    lambda: select(columns).where(column == bindparam("value")),
+                    value = uuid).fetchone()
         if not q:
             return dict()
-        return self.parse_query_data(q, field_tuple)
+        return dict(zip(names, q))
 
-    def get_all_rows(self, table, field_tuple, limit, offset):
+    def get_all_rows(self, table, field_tuple, limit, offset, fields = None, exclude = (), where = None,
+                     columnar = False, order_by = None):
         """
         Returns dictionary containing list of rows returned from table,
         see parse_list_query_data for structure of the dict
@@ -107,10 +193,89 @@ class BaseDBHandler(object):
         field_tuple -- iterable to parse dictionary against (list/tuple)
         limit -- limit the number of rows returned (int)
         offset -- offset for query (int)
+        fields, exclude -- (optional) limit selected fields, see get_columns
+        where -- (optional) additional sqlalchemy filter expression
+        columnar -- if True returns rows in columnar format (see columnar_rows),
+        including uuid column
+        order_by -- (optional) list of sqlalchemy order by clauses,
+        rows are then returned as list of dicts (including uuid)
+        in that order, JSON objects dont keep order of their keys
+        """
+        names, columns, keep_key = self.get_key_columns(table, field_tuple, fields, exclude)
+        sel = select(columns).limit(limit).offset(offset)
+        if where is not None:
+            sel = sel.where(where)
+        if order_by is not None:
+            sel = sel.order_by(*order_by)
+        res = self.conn.execute(sel).fetchall()
+        if columnar:
+            return self.columnar_rows(res, names)
+        if order_by is not None:
+            return [dict(zip(names, row)) for row in res]
+        return self.parse_rows(res, names, keep_key = keep_key)
+
+    def get_rows_after(self, table, key_column, field_tuple, limit, after = None, where = None,
+                       fields = None, exclude = (), columnar = False):
         """
-        sel = select([table]).limit(limit).offset(offset)
+        Keyset pagination, returns tuple containing dictionary of rows
+        (see parse_list_query_data) and key of the last row returned
+        which should be passed as after to get next page
+        (None if there are no more rows)
+        Unlike offset every page costs the same no matter how deep it is
+
+        Keyword Arguments:
+        table -- sqlalchemy table to get data from
+        key_column -- unique indexed column to sort and seek by (eg. users.c.user_id)
+        field_tuple -- iterable to parse dictionary against (list/tuple)
+        limit -- maximum number of rows returned (int)
+        after -- key of the last row from previous page or None for first page
+        where -- (optional) additional sqlalchemy filter expression
+        fields, exclude -- (optional) limit selected fields, see get_columns
+        columnar -- if True returns rows in columnar format (see columnar_rows),
+        including uuid column
+        """
+        names, columns, keep_key = self.get_key_columns(table, field_tuple, fields, exclude)
+        sel = select(columns + [key_column]).order_by(key_column).limit(limit)
+        if where is not None:
+            sel = sel.where(where)
+        if after is not None:
+            sel = sel.where(key_column > after)
         res = self.conn.execute(sel).fetchall()
-        return self.parse_list_query_data(res, field_tuple)
+        last = None
+        if res and len(res) == limit:
+            last = res[-1][key_column]
+        if columnar:
+            return self.columnar_rows(res, names), last
+        return self.parse_rows(res, names, keep_key = keep_key), last
+
+    def export_rows_after(self, table, key_column, field_tuple, limit, after = None, where = None,
+                          fields = None, exclude = ()):
+        """
+        Returns tuple containing list of row dictionaries ordered by key_column
+        (see parse_query_data) and key of the last one (None if no rows),
+        used for exporting whole tables chunk by chunk, every chunk is separate
+        indexed query so no transaction or cursor is kept open between them
+        export is done once fewer than limit rows are returned
+
+        Keyword Arguments:
+        table -- sqlalchemy table to get data from
+        key_column -- unique indexed column to sort and seek by (eg. users.c.user_id)
+        field_tuple -- iterable to parse dictionary against (list/tuple)
+        limit -- maximum number of rows returned (int)
+        after -- key of the last row from previous chunk or None for first chunk
+        where -- (optional) additional sqlalchemy filter expression
+        fields, exclude -- (optional) limit selected fields, see get_columns
+        """
+        names, columns = self.get_columns(table, field_tuple, fields, exclude)
+        sel = select(columns + [key_column]).order_by(key_column).limit(limit)
+        if where is not None:
+            sel = sel.where(where)
+        if after is not None:
+            sel = sel.where(key_column > after)
+        res = self.conn.execute(sel).fetchall()
+        if not res:
+            return [], None
+        return [dict(zip(names, row)) for row in res], res[-1][key_column]
 
     def check_exists(self, column, value):
         """
@@ -120,10 +285,46 @@ class BaseDBHandler(object):
         column -- sqlalchemy expression language column (eg. users.c.username)
         value -- value to search for (str)
         """
-        sel = select([exists().where(column == value)])
-        result = self.conn.execute(sel).scalar()
+        result = execute(self.conn, ("exists", column),
+                         lambda: select([exists().where(column == bindparam("value"))]),
+                         value = value).scalar()
         return result
 
+    def uuids_taken(self, column, values):
+        """
+        Returns set of given uuids that already exist in column,
+        values are looked up in chunks of IN queries
+        """
+        values = list(values)
+        taken = set()
+        for start in range(0, len(values), IN_CHUNK_SIZE):
+            sel = select([column]).where(column.in_(values[start:start + IN_CHUNK_SIZE]))
+            taken.update(row[0] for row in self.conn.execute(sel))
+        return taken
+
+    def save_with_uuid(self, save, data, column):
+        """
+        Generates random uuid and saves data with given function,
+        uuid columns have unique index so collision is not checked
+        up front, instead save is retried with new uuid (up to UUID_RETRIES times)
+        when IntegrityError was caused by uuid already being taken
+
+        Returns: whatever save returns
+
+        Keyword Arguments:
+        save -- function accepting data dict (eg. save_user)
+        data -- dictionary passed to save, its "uuid" key is set
+        column -- sqlalchemy uuid column (eg. users.c.user_uuid)
+        """
+        for attempt in range(UUID_RETRIES):
+            data["uuid"] = str(uuid.uuid4())
+            try:
+                return save(data)
+            except IntegrityError:
+                if attempt + 1 < UUID_RETRIES and self.check_exists(column, data["uuid"]):
+                    continue
+                raise
+
     def delete_row(self,table, column, value):
         """
         Deletes row that matches value 
@@ -133,7 +334,74 @@ class BaseDBHandler(object):
         value -- value to match it against
         """
         delete_q = table.delete().where(column == value)
-        self.conn.execute(delete_q)
+        return self.conn.execute(delete_q).rowcount
+
+    def category_counter(self, category):
+        """
+        Returns name of the counter holding number of products in given category
+        """
+        return "products:" + category
+
+    def counter_seed(self, name):
+        """
+        Returns query counting rows for counter with given name,
+        used when counter doesnt exist yet
+        """
+        if name == "users":
+            return select([func.count(users.c.user_id)])
+        if name == "products":
+            return select([func.count(products.c.product_id)])
+        category = name[len("products:"):]
+        return select([func.count(products.c.product_id)]).where(products.c.category == category)
+
+    def bump_counter(self, name, delta):
+        """
+        Adds delta to maintained counter,
+        should be called inside transaction that changed the counted rows
+        so counter is always consistent with the table.
+        Missing counter is created by counting rows
+        (which already include the change)
+        """
+        update_q = counters.update()\
+                .where(counters.c.name == name)\
+                .values(value = counters.c.value + delta)
+        if not self.conn.execute(update_q).rowcount:
+            value = self.conn.execute(self.counter_seed(name)).scalar() or 0
+            self.conn.execute(counters.insert().values(name = name, value = value))
+
+    def get_counter(self, name):
+        """
+        Returns value of maintained counter, O(1) lookup by primary key,
+        rows are counted if the counter doesnt exist yet,
+        missing counter is left to be created by writes
+        (bump_counter) or reconcile_counters
+        """
+        value = execute(self.conn, ("scalar", counters.c.value, counters.c.name),
+                        lambda: select([counters.c.value]).where(counters.c.name == bindparam("value")),
+                        value = name).scalar()
+        if value is None:
+            value = self.conn.execute(self.counter_seed(name)).scalar() or 0
+        return value
+
+    def bump_product_sales(self, product_id, delta):
+        """
+        Adds delta to quantity sold of given product,
+        should be called inside transaction that changed bought_products.
+        Missing row is created by summing bought quantities
+        (which already include the change), see bump_counter
+
+        Keyword Arguments:
+        product_id -- product primary key or scalar select returning it
+        delta -- change of quantity sold (int)
+        """
+        update_q = product_sales.update()\
+                .where(product_sales.c.product_id == product_id)\
+                .values(quantity = product_sales.c.quantity + delta)
+        if not self.conn.execute(update_q).rowcount:
+            seed = select([bought_products.c.product_id, func.sum(bought_products.c.quantity)])\
+                    .where(bought_products.c.product_id == product_id)\
+                    .group_by(bought_products.c.product_id)
+            self.conn.execute(product_sales.insert().from_select(["product_id", "quantity"], seed))
 
     def get_scalar(self, output, column, identifier):
         """
@@ -143,8 +411,9 @@ class BaseDBHandler(object):
         Returns :
             Scalar Value or False if not exists
         """
-        sel = select([output]).where(column == identifier)
-        res = self.conn.execute(sel).scalar()
+        res = execute(self.conn, ("scalar", output, column),
+                      lambda: select([output]).where(column == bindparam("value")),
+                      value = identifier).scalar()
         if not res:
             return False
         return res
@@ -180,19 +449,19 @@ class BaseDBHandler(object):
 
     def get_credentials(self, identifier):
         """
-        Return username and password
+        Return username, password and user_uuid
         used for user verification
         identifier might be either uuid or username
         """
 
-        sel = select([users.c.username, users.c.password])\
+        build = lambda: select([users.c.username, users.c.password, users.c.user_uuid])\
                 .where(or_(
-                    users.c.username == identifier,
-                    users.c.user_uuid == identifier
+                    users.c.username == bindparam("identifier"),
+                    users.c.user_uuid == bindparam("identifier")
                 ))
 
         try:
-            res = self.conn.execute(sel).fetchone()
+            res = execute(self.conn, "credentials", build, identifier = identifier).fetchone()
             return res
         except:
             raise
@@ -217,12 +486,6 @@ class UserDatabaseHandler(BaseDBHandler):
     #     """
     #     return self.check_exists(users.c.user_uuid, uuid)
 
-    def generate_user_uuid(self):
-        """
-        Generate user uuid 
-        """
-        return self.generate_unique_uuid(users.c.user_uuid)
-
     def credentials_unique(self, username, email):
         """
         Checks if given credentials are already taken
@@ -233,14 +496,14 @@ class UserDatabaseHandler(BaseDBHandler):
         """
         if not username or not email:
             raise TypeError("no username or email given")
-        sel = select([exists().where(
+        build = lambda: select([exists().where(
                 or_(
-                    users.c.username == username,
-                    users.c.email == email
+                    users.c.username == bindparam("username"),
+                    users.c.email == bindparam("email")
                 )
         )])
         try:
-            result = self.conn.execute(sel).scalar()
+            result = execute(self.conn, "credentials_taken", build, username = username, email = email).scalar()
             return not result
         except:
             raise
@@ -270,7 +533,9 @@ class UserDatabaseHandler(BaseDBHandler):
        trans = self.conn.begin()
        try:
            res = self.conn.execute(ins)
+           self.bump_counter("users", 1)
            trans.commit()
+           self.invalidate("users")
            return res.inserted_primary_key[0]
        except:
            trans.rollback()
@@ -283,7 +548,7 @@ class UserDatabaseHandler(BaseDBHandler):
         -Generates unique uuid
         -Checks if name and email are unique
         -Saves user to database
-        see save_user, credentials_unique, generate_user_uuid for details
+        see save_user, credentials_unique, save_with_uuid for details
         
         Returns: inserted user pk or raises IntegrityError if name or email is taken
         
@@ -296,38 +561,140 @@ class UserDatabaseHandler(BaseDBHandler):
 
         # if not self.credentials_unique(data["username"], data["email"]):
         #     raise IntegrityError("Name and email must be unique")
-        user_uuid = self.generate_user_uuid()
-        data["uuid"] = user_uuid
         try:
-            res = self.save_user(data)
+            res = self.save_with_uuid(self.save_user, data, users.c.user_uuid)
             return res
         except:
             raise
 
+    def taken_credentials(self, usernames, emails):
+        """
+        Checks which of given usernames and emails are already taken,
+        values are looked up in chunks of IN queries
+
+        Returns : tuple (set of taken usernames, set of taken emails)
+
+        Keyword Arguments:
+        usernames, emails -- lists of values to check (list)
+        """
+        taken_names, taken_emails = set(), set()
+        usernames, emails = list(usernames), list(emails)
+        for start in range(0, max(len(usernames), len(emails)), IN_CHUNK_SIZE):
+            names_chunk = usernames[start:start + IN_CHUNK_SIZE]
+            emails_chunk = emails[start:start + IN_CHUNK_SIZE]
+            conditions = list()
+            if names_chunk:
+                conditions.append(users.c.username.in_(names_chunk))
+            if emails_chunk:
+                conditions.append(users.c.email.in_(emails_chunk))
+            sel = select([users.c.username, users.c.email]).where(or_(*conditions))
+            for username, email in self.conn.execute(sel):
+                taken_names.add(username)
+                taken_emails.add(email)
+        return taken_names, taken_emails
+
+    def create_users(self, records, hash_passwords = None):
+        """
+        Creates many users at once (eg. import from other system),
+        uniqueness of whole batch is checked with single query
+        and all users are inserted with one executemany in one transaction
+
+        Returns list containing result for every record:
+            {"username": username, "status": code, "uuid": user_uuid}
+        where status is 201 if created, 409 if username or email
+        is taken (also within batch) or 400 if record is malformed
 
-    def get_user(self, identifier, safe = False, direct = False):
+        Keyword Arguments:
+        records -- list of dicts containing username, email, password
+        and optionally joined
+        hash_passwords -- (optional) function given list of passwords of users
+        that will be inserted and returning list of their hashes,
+        passwords are saved as given if None
+        """
+        results, candidates = list(), list()
+        for record in records:
+            if not isinstance(record, dict) or \
+                    not all(record.get(field) for field in ("username", "email", "password")):
+                results.append(dict(username = None, status = 400))
+                continue
+            results.append(dict(username = record["username"]))
+            candidates.append((len(results) - 1, record))
+
+        taken_names, taken_emails = self.taken_credentials(
+            [record["username"] for i, record in candidates],
+            [record["email"] for i, record in candidates])
+
+        rows = list()
+        for i, record in candidates:
+            if record["username"] in taken_names or record["email"] in taken_emails:
+                results[i]["status"] = 409
+                continue
+            # duplicates within the batch conflict with first occurence
+            taken_names.add(record["username"])
+            taken_emails.add(record["email"])
+            results[i]["status"] = 201
+            rows.append((i, record))
+
+        if not rows:
+            return results
+        passwords = [record["password"] for i, record in rows]
+        if hash_passwords:
+            passwords = hash_passwords(passwords)
+        to_insert = list()
+        for (i, record), password in zip(rows, passwords):
+            to_insert.append(dict(
+                username = record["username"],
+                password = password,
+                email = record["email"],
+                joined = record.get("joined")
+            ))
+        # uuids are not checked up front, batch is retried
+        # with fresh uuids if any of them collided, see save_with_uuid
+        for attempt in range(UUID_RETRIES):
+            for row in to_insert:
+                row["user_uuid"] = str(uuid.uuid4())
+            trans = self.conn.begin()
+            try:
+                self.conn.execute(users.insert(), to_insert)
+                self.bump_counter("users", len(to_insert))
+                trans.commit()
+                self.invalidate("users")
+                break
+            except IntegrityError:
+                trans.rollback()
+                if attempt + 1 < UUID_RETRIES and \
+                        self.uuids_taken(users.c.user_uuid, [row["user_uuid"] for row in to_insert]):
+                    continue
+                logging.error("Error creating users")
+                raise
+            except:
+                trans.rollback()
+                logging.error("Error creating users")
+                raise
+        for (i, record), row in zip(rows, to_insert):
+            results[i]["uuid"] = row["user_uuid"]
+        return results
+
+
+    def get_user(self, identifier, safe = False, direct = False, fields = None):
         """
         Get user with given uuid 
         
         Keyword Arguments:
         identifier -- unique user identifier
-        safe -- if false returns full query data
+        safe -- if false returns full query data,
+        if true private fields are not selected at all
         uuid -- if True looks by user_uuid field else looks by username
         direct -- if False looks by user_uuid column else by username
+        fields -- (optional) list of USER_FIELDS to return, all if None
         """
         if not direct:
             haystack = users.c.user_uuid
         else:
             haystack = users.c.username
+        exclude = SECURE_USER_FIELDS if safe else ()
         try:
-            if not self.check_exists(haystack, identifier):
-                return dict()
-            if safe:
-                res = self.get_row(users, haystack, identifier, USER_FIELDS)
-                for field in SECURE_USER_FIELDS:
-                    del res[field]
-                return res
-            return self.get_row(users, haystack, identifier, USER_FIELDS)
+            return self.get_row(users, haystack, identifier, USER_FIELDS, fields, exclude)
         except:
             raise
 
@@ -343,10 +710,27 @@ class UserDatabaseHandler(BaseDBHandler):
             haystack = users.c.user_uuid
         else:
             haystack = users.c.username
+        user_ids = select([users.c.user_id]).where(haystack == identifier)
+        user_bought = bought_products.c.user_id.in_(user_ids)
+        # users purchases no longer count towards product sales
+        sold = select([func.sum(bought_products.c.quantity)])\
+                .where(and_(bought_products.c.product_id == product_sales.c.product_id, user_bought))\
+                .as_scalar()
+        update_sales = product_sales.update()\
+                .where(product_sales.c.product_id.in_(select([bought_products.c.product_id]).where(user_bought)))\
+                .values(quantity = product_sales.c.quantity - sold)
         trans = self.conn.begin()
         try:
-            self.delete_row(users, haystack, identifier)
+            self.conn.execute(update_sales)
+            # removed explicitly so sales stay consistent even if foreign keys are not enforced
+            self.conn.execute(bought_products.delete().where(user_bought))
+            deleted = self.delete_row(users, haystack, identifier)
+            if deleted:
+                self.bump_counter("users", -deleted)
             trans.commit()
+            if deleted:
+                self.invalidate("users", "top")
+                self.invalidate_credentials(identifier)
         except:
             trans.rollback()
             logging.error("Error deleting user")
@@ -375,40 +759,78 @@ class UserDatabaseHandler(BaseDBHandler):
         try:
             resp = self.conn.execute(update_q)
             trans.commit()
+            if "password" in items_to_update:
+                self.invalidate_credentials(identifier)
             return resp.last_updated_params()
         except:
             trans.rollback()
             raise
 
-    def list_all_users(self, limit, offset, safe = False):
+    def replace_password_hash(self, username, old_hash, new_hash):
+        """
+        Replaces stored password hash (eg. with stronger one after login),
+        only if it wasnt changed in the meantime
+
+        Returns: True if replaced
+        """
+        update_q = users.update()\
+                .where(and_(users.c.username == username, users.c.password == old_hash))\
+                .values(password = new_hash)
+        return bool(self.conn.execute(update_q).rowcount)
+
+    def list_all_users(self, limit, offset, safe = False, fields = None, columnar = False):
 
         """
         Returns list of users from db 
         limit -- limit amount of rows returned (int),
         offset -- offset for a query (int)
-        safe -- removes private user information from result
+        safe -- leaves private user information out of result
+        (users are still keyed by uuid)
+        fields -- (optional) list of USER_FIELDS to return, all if None
+        columnar -- returns columnar format, see get_all_rows
         """
         try:
-
-            result = self.get_all_rows(users, USER_FIELDS, limit, offset)
-            if safe:
-                for key, value in result.items():
-                    for field in SECURE_USER_FIELDS:
-                        del result[key][field]
-
-                return result
-            return result
+            exclude = SECURE_USER_FIELDS if safe else ()
+            return self.get_all_rows(users, USER_FIELDS, limit, offset, fields, exclude, columnar = columnar)
         except:
             raise
 
+    def list_users_after(self, limit, after = None, safe = False, fields = None, columnar = False):
+        """
+        Returns tuple containing list of users and user_id of the last one
+        see get_rows_after for details
+
+        limit -- limit amount of rows returned (int),
+        after -- user_id of last user from previous page or None
+        safe -- leaves private user information out of result
+        fields -- (optional) list of USER_FIELDS to return, all if None
+        columnar -- returns columnar format, see get_rows_after
+        """
+        exclude = SECURE_USER_FIELDS if safe else ()
+        return self.get_rows_after(users, users.c.user_id, USER_FIELDS, limit, after,
+                                   fields = fields, exclude = exclude, columnar = columnar)
+
+    def export_users(self, limit, after = None, safe = True, fields = None):
+        """
+        Returns tuple containing list of users ordered by user_id
+        and user_id of the last one, see export_rows_after for details
+
+        limit -- limit amount of rows returned (int),
+        after -- user_id of last user from previous chunk or None
+        safe -- leaves private user information out of result
+        fields -- (optional) list of USER_FIELDS to return, all if None
+        """
+        exclude = SECURE_USER_FIELDS if safe else ()
+        return self.export_rows_after(users, users.c.user_id, USER_FIELDS, limit, after,
+                                      fields = fields, exclude = exclude)
+
     def get_number_of_users(self):
         """
         Get number of users in database 
         """
 
-        sel = select([func.count(users.c.user_id)])
         try:
-            return self.conn.execute(sel).scalar()
+            return self.get_counter("users")
         except:
             raise
 
@@ -427,7 +849,8 @@ class UserDatabaseHandler(BaseDBHandler):
         user_id = self.conn.execute(sel).fetchone()[0]
         if not user_id:
             return dict()
-        user_products = select([products, bought_products.c.quantity])\
+        columns = [products.c.product_id] + self.get_columns(products, PRODUCT_FIELDS)[1]
+        user_products = select(columns + [bought_products.c.quantity])\
                 .select_from(products.join(bought_products))\
                 .where(bought_products.c.user_id == user_id)\
                 .order_by(desc(bought_products.c.quantity))
@@ -444,6 +867,10 @@ class UserDatabaseHandler(BaseDBHandler):
         """
         del_all = users.delete()
         self.conn.execute(del_all)
+        self.conn.execute(counters.delete().where(counters.c.name == "users"))
+        self.conn.execute(bought_products.delete())
+        self.conn.execute(product_sales.delete())
+        self.invalidate("users", "top")
 
 class ProductDatabaseHandler(BaseDBHandler):
 
@@ -457,16 +884,6 @@ class ProductDatabaseHandler(BaseDBHandler):
 
         super(ProductDatabaseHandler, self).__init__(*args, **kwargs)
 
-    def generate_product_uuid(self):
-        """
-        Generates unique product uuid 
-        """
-        try:
-            res = self.generate_unique_uuid(products.c.product_uuid)
-            return res
-        except:
-            raise
-
     # not needed
     # def product_exists(self, uuid):
     #     """
@@ -481,9 +898,8 @@ class ProductDatabaseHandler(BaseDBHandler):
         if not name:
             raise Exception("No product_name given")
 
-        sel = select([exists().where(products.c.product_name == name)])
         try:
-            res = self.conn.execute(sel).scalar()
+            res = self.check_exists(products.c.product_name, name)
             return not res
         except:
             raise
@@ -512,10 +928,15 @@ class ProductDatabaseHandler(BaseDBHandler):
                raise Exception("Data not parsed properly, missing {0}".format(field))
        els_to_insert["product_uuid"] = els_to_insert["uuid"]
        del els_to_insert["uuid"]
+       els_to_insert["price_minor"] = parse_price(els_to_insert["price"])
        trans = self.conn.begin()
        try:
            res = self.conn.execute(products.insert().values(**els_to_insert))
+           self.bump_counter("products", 1)
+           if els_to_insert["category"] is not None:
+               self.bump_counter(self.category_counter(els_to_insert["category"]), 1)
            trans.commit()
+           self.invalidate("products")
            return res.inserted_primary_key[0]
        except Exception as e:
            trans.rollback()
@@ -535,7 +956,7 @@ class ProductDatabaseHandler(BaseDBHandler):
        data -- dictionary containing data to be inserted into database,
        must match fields defined in PRODUCT_FIELDS tuple in config.py
        (minus pk and uuid) (dict)
-       See save_product, product_unique and generate_product_uuid 
+       See save_product, product_unique and save_with_uuid
        for more info
        """
        # put authentication in controller
@@ -543,38 +964,81 @@ class ProductDatabaseHandler(BaseDBHandler):
        # if not unique:
        #     raise IntegrityError("Product name must be unique", data["product_name"], "create_product")
        try:
-           product_uuid = self.generate_product_uuid()
-       except:
-           raise
-           return
-       data["uuid"] = product_uuid
-       try:
-           res = self.save_product(data)
+           res = self.save_with_uuid(self.save_product, data, products.c.product_uuid)
            return res
        except:
            raise
 
-    def get_number_of_products(self):
+    def product_filter(self, category = None, min_price = None, max_price = None):
+        """
+        Returns sqlalchemy filter expression for given category
+        and price range (inclusive, in minor units, see helper_functions.parse_price)
+        or None if nothing is filtered,
+        products without parsable price are left out by price range
+        """
+        conditions = list()
+        if category:
+            conditions.append(products.c.category == category)
+        if min_price is not None:
+            conditions.append(products.c.price_minor >= min_price)
+        if max_price is not None:
+            conditions.append(products.c.price_minor <= max_price)
+        if not conditions:
+            return None
+        return and_(*conditions)
+
+    def get_number_of_products(self, category = None, min_price = None, max_price = None):
         """
         Get total number of products 
+        category -- (optional) get number of products in given category
+        min_price, max_price -- (optional) count only products in price range
+        (in minor units), counted by index range scan instead of maintained counters
         """
-        sel = select([func.count(products.c.product_id)])
         try:
-            res = self.conn.execute(sel).scalar()
-            return res
+            if min_price is not None or max_price is not None:
+                sel = select([func.count(products.c.product_id)])\
+                        .where(self.product_filter(category, min_price, max_price))
+                return self.conn.execute(sel).scalar()
+            if category:
+                return self.get_counter(self.category_counter(category))
+            return self.get_counter("products")
         except:
             raise
 
 
-    def get_product(self, identifier, uuid = True):
+    def get_category_counts(self):
+        """
+        Returns tuple containing dictionary of product counts per category
+        (categories without products are left out) and number of all products,
+        read from maintained counters in single primary key range scan
+        instead of grouping products
+        """
+        prefix = self.category_counter("")
+        # counter names following prefix sort between it and prefix with last character incremented
+        sel = select([counters.c.name, counters.c.value])\
+                .where(or_(
+                    counters.c.name == "products",
+                    and_(counters.c.name > prefix, counters.c.name < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+                ))
+        total = 0
+        categories = dict()
+        for name, value in self.conn.execute(sel):
+            if name == "products":
+                total = value
+            elif value > 0:
+                categories[name[len(prefix):]] = value
+        return categories, total
+
+    def get_product(self, identifier, uuid = True, fields = None):
         """
         Get product with given uuid 
+        fields -- (optional) list of PRODUCT_FIELDS to return, all if None
         """
         if uuid:
             haystack = products.c.product_uuid
         else:
             haystack = products.c.product_name
-        return self.get_row(products, haystack, identifier, PRODUCT_FIELDS)
+        return self.get_row(products, haystack, identifier, PRODUCT_FIELDS, fields)
 
 
 
@@ -586,7 +1050,28 @@ class ProductDatabaseHandler(BaseDBHandler):
             haystack = products.c.product_uuid
         else:
             haystack = products.c.product_name
-        self.delete_row(products, haystack, identifier)
+        categories = select([products.c.category, func.count(products.c.product_id)])\
+                .where(haystack == identifier)\
+                .group_by(products.c.category)
+        uuids = select([products.c.product_uuid]).where(haystack == identifier)
+        trans = self.conn.begin()
+        try:
+            deleted = self.conn.execute(categories).fetchall()
+            deleted_uuids = [row[0] for row in self.conn.execute(uuids)]
+            product_ids = select([products.c.product_id]).where(haystack == identifier)
+            self.conn.execute(product_sales.delete().where(product_sales.c.product_id.in_(product_ids)))
+            self.delete_row(products, haystack, identifier)
+            for category, number in deleted:
+                self.bump_counter("products", -number)
+                if category is not None:
+                    self.bump_counter(self.category_counter(category), -number)
+            trans.commit()
+            if deleted_uuids:
+                self.invalidate("products", "top", *["product:" + product_uuid for product_uuid in deleted_uuids])
+        except:
+            trans.rollback()
+            logging.error("Error deleting product")
+            raise
 
     def update_product(self, uuid, data):
         """
@@ -603,12 +1088,34 @@ class ProductDatabaseHandler(BaseDBHandler):
         for key, value in data.items():
             if key in CUSTOM_PRODUCT_FIELDS:
                 items_to_update[key] = value
+        if "price" in items_to_update:
+            items_to_update["price_minor"] = parse_price(items_to_update["price"])
         update_q = products.update().where(products.c.product_uuid == uuid).values(**items_to_update)
-        res = self.conn.execute(update_q)
-        return res.last_updated_params()
+        trans = self.conn.begin()
+        try:
+            old_category = None
+            if "category" in items_to_update:
+                old_category = self.conn.execute(select([products.c.category])\
+                        .where(products.c.product_uuid == uuid)).fetchone()
+            res = self.conn.execute(update_q)
+            if old_category and old_category[0] != items_to_update["category"]:
+                if old_category[0] is not None:
+                    self.bump_counter(self.category_counter(old_category[0]), -1)
+                if items_to_update["category"] is not None:
+                    self.bump_counter(self.category_counter(items_to_update["category"]), 1)
+            trans.commit()
+            if res.rowcount:
+                self.invalidate("products", "top", "product:" + uuid)
+            updated = dict(res.last_updated_params())
+            updated.pop("price_minor", None)
+            return updated
+        except:
+            trans.rollback()
+            raise
 
 
-    def get_product_list(self, limit, offset, category = None):
+    def get_product_list(self, limit, offset, category = None, fields = None, columnar = False,
+                         min_price = None, max_price = None, sort = None):
         """
         Get a dictionary of products returned from db 
         Returns: dict
@@ -616,18 +1123,102 @@ class ProductDatabaseHandler(BaseDBHandler):
         Keyword Arguments:
         limit, offset -- int
         category -- (optional) limits query to given category
+        fields -- (optional) list of PRODUCT_FIELDS to return, all if None
+        columnar -- returns columnar format, see get_all_rows
+        min_price, max_price -- (optional) price range in minor units
+        sort -- (optional) "price" or "-price" (descending), sorted products
+        are returned as list (see get_all_rows), products without parsable
+        price come first in ascending order
+
+        """
+        where = self.product_filter(category, min_price, max_price)
+        order_by = None
+        if sort == "price":
+            order_by = [products.c.price_minor, products.c.product_id]
+        elif sort == "-price":
+            order_by = [desc(products.c.price_minor), desc(products.c.product_id)]
+        elif sort is not None:
+            raise ValueError("Unknown sort: " + sort)
+        return self.get_all_rows(products, PRODUCT_FIELDS, limit, offset, fields, where = where, columnar = columnar,
+                                 order_by = order_by)
 
+
+    def get_products_after(self, limit, after = None, category = None, fields = None, columnar = False,
+                           min_price = None, max_price = None):
         """
-        # more specific
+        Returns tuple containing dictionary of products and product_id
+        of the last one, see get_rows_after for details
+
+        Keyword Arguments:
+        limit -- int
+        after -- product_id of last product from previous page or None
+        category -- (optional) limits query to given category
+        fields -- (optional) list of PRODUCT_FIELDS to return, all if None
+        columnar -- returns columnar format, see get_rows_after
+        min_price, max_price -- (optional) price range in minor units
+        """
+        where = self.product_filter(category, min_price, max_price)
+        return self.get_rows_after(products, products.c.product_id, PRODUCT_FIELDS, limit, after, where, fields,
+                                   columnar = columnar)
+
+    def search_products(self, query, limit, offset, category = None, fields = None, columnar = False):
+        """
+        Full text search in product names and descriptions (see models.products_search),
+        every word of query has to match, FTS5 query syntax is not interpreted
+        Returns tuple containing list of product dicts ordered by relevance
+        (including uuid) and True if more results follow
+        raises ValueError if query contains no words
+
+        Keyword Arguments:
+        query -- words to look for (str)
+        limit, offset -- int
+        category -- (optional) limits search to given category
+        fields -- (optional) list of PRODUCT_FIELDS to return, all if None
+        columnar -- returns columnar format (see columnar_rows) instead of list
+        """
+        terms = query.split()
+        if not terms:
+            raise ValueError("No search terms given")
+        match = " ".join(u'"{0}"'.format(term.replace(u'"', u'""')) for term in terms)
+        names, columns, keep_key = self.get_key_columns(products, PRODUCT_FIELDS, fields)
         if category:
-            sel = select([products])\
-            .where(products.c.category == category)\
-                    .limit(limit)\
-                    .offset(offset)
-            res = self.conn.execute(sel).fetchall()
-            return self.parse_list_query_data(res, PRODUCT_FIELDS)
-        return self.get_all_rows(products, PRODUCT_FIELDS, limit, offset)
+            sel = select(columns)\
+                    .select_from(products_search.join(products, products.c.product_id == products_search.c.rowid))\
+                    .where(products_search.c.products_search.match(match))\
+                    .where(products.c.category == category)\
+                    .order_by(products_search.c.rank)\
+                    .limit(limit + 1).offset(offset)
+        else:
+            # without filter products rows are read only for the page, not for every match
+            found = select([products_search.c.rowid, products_search.c.rank])\
+                    .where(products_search.c.products_search.match(match))\
+                    .order_by(products_search.c.rank)\
+                    .limit(limit + 1).offset(offset).alias("found")
+            sel = select(columns)\
+                    .select_from(found.join(products, products.c.product_id == found.c.rowid))\
+                    .order_by(found.c.rank)
+        res = self.conn.execute(sel).fetchall()
+        more = len(res) > limit
+        res = res[:limit]
+        if columnar:
+            return self.columnar_rows(res, names), more
+        return [dict(zip(names, row)) for row in res], more
 
+    def export_products(self, limit, after = None, category = None, fields = None):
+        """
+        Returns tuple containing list of products ordered by product_id
+        and product_id of the last one, see export_rows_after for details
+
+        Keyword Arguments:
+        limit -- int
+        after -- product_id of last product from previous chunk or None
+        category -- (optional) limits query to given category
+        fields -- (optional) list of PRODUCT_FIELDS to return, all if None
+        """
+        where = None
+        if category:
+            where = products.c.category == category
+        return self.export_rows_after(products, products.c.product_id, PRODUCT_FIELDS, limit, after, where, fields)
 
     def get_all_sold_products(self, limit = None):
 
@@ -649,11 +1240,32 @@ class ProductDatabaseHandler(BaseDBHandler):
         """
         del_all = products.delete()
         self.conn.execute(del_all)
+        self.conn.execute(counters.delete().where(counters.c.name.like("products%")))
+        self.conn.execute(product_sales.delete())
+        if self.cache is not None:
+            self.cache.clear()
 
     def _get_all_products(self):
         sel = select([products])
         return self.parse_list_query_data(self.conn.execute(sel), PRODUCT_FIELDS, "product_name")
 
+# requires unique index on bought_products (user_id, product_id)
+UPSERT_BOUGHT_PRODUCT = """
+    INSERT INTO bought_products (quantity, user_id, product_id)
+    SELECT :quantity, users.user_id, products.product_id
+    FROM users, products
+    WHERE users.{user_column} = :user AND products.{product_column} = :product
+    ORDER BY products.product_id
+    LIMIT 1
+    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+"""
+
+UPSERT_BOUGHT_PRODUCT_IDS = """
+    INSERT INTO bought_products (quantity, user_id, product_id)
+    VALUES (:quantity, :user_id, :product_id)
+    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+"""
+
 class BoughtDBHandler(BaseDBHandler):
 
     def increase_bought_qty(self, amount, id):
@@ -665,17 +1277,20 @@ class BoughtDBHandler(BaseDBHandler):
         amount -- amount to increase (int),
         id -- unique bought_item primary key (int)
         """
-        current = self.conn.execute(select([bought_products.c.quantity])\
-                                    .where(bought_products.c.bought_id == id))\
-                                    .scalar() # get current amount
         update = bought_products.update()\
                 .where(bought_products.c.bought_id == id)\
-                .values(quantity = (current + amount))
+                .values(quantity = bought_products.c.quantity + amount)
+        product_id = select([bought_products.c.product_id])\
+                .where(bought_products.c.bought_id == id).as_scalar()
         trans = self.conn.begin()
         try:
-            self.conn.execute(update)
+            increased = self.conn.execute(update).rowcount
+            if increased:
+                self.bump_product_sales(product_id, amount)
             trans.commit()
-        except Exceptions as e:
+            if increased:
+                self.invalidate("top")
+        except Exception as e:
             logging.error(sys.exc_info()[0])
             trans.rollback()
             raise
@@ -708,7 +1323,11 @@ class BoughtDBHandler(BaseDBHandler):
         except:
             raise
 
-    def get_users_bought_products(self, identifier, uuid = True):
+    def get_users_bought_products(self, identifier, uuid = True, columnar = False):
+        """
+        Returns products bought by user keyed by product_name
+        or in columnar format (see columnar_rows) if columnar is True
+        """
         if uuid:
             haystack = users.c.user_uuid
         else:
@@ -717,12 +1336,19 @@ class BoughtDBHandler(BaseDBHandler):
                 .where(haystack == identifier)
 
         res = self.conn.execute(sel).fetchall()
+        if columnar:
+            return self.columnar_rows(res, PRODUCT_FIELDS, start = 1)
         return self.parse_list_query_data(res, PRODUCT_FIELDS, key = "product_name")
 
-    def get_users_sold_products(self, username):
-
+    def get_users_sold_products(self, username, columnar = False):
+        """
+        Returns products sold by user keyed by product_name
+        or in columnar format (see columnar_rows) if columnar is True
+        """
         sel = select([products]).where(products.c.seller == username)
         res = self.conn.execute(sel).fetchall()
+        if columnar:
+            return self.columnar_rows(res, PRODUCT_FIELDS, start = 1)
         return self.parse_list_query_data(res, PRODUCT_FIELDS, key = "product_name")
 
     def create_bought_product(self, qty, user_uuid, product_uuid):
@@ -751,7 +1377,9 @@ class BoughtDBHandler(BaseDBHandler):
             trans = self.conn.begin()
             try:
                 res = self.conn.execute(ins)
+                self.bump_product_sales(product_id, qty)
                 trans.commit()
+                self.invalidate("top")
                 return res.inserted_primary_key[0]
             except Exception as e:
                 trans.rollback()
@@ -761,33 +1389,140 @@ class BoughtDBHandler(BaseDBHandler):
             return
 
 
-    def add_bought_product(self, quantity, user_uuid, product_uuid):
+    def add_bought_product(self, quantity, user, product, user_uuid = True, product_uuid = True):
 
         """
-        Wrapper for create_bought_product, and increase_bought_quantity,
-        if item is already bought by user increase quantity
-        else create new record.
+        Adds bought item in a single atomic statement,
+        if item is already bought by user quantity is increased
+        in the database (quantity = quantity + n) so concurrent purchases
+        dont lose updates, else new record is created.
+        User and product ids are resolved with subselects
+
+        Returns True if bought or False if user or product doesnt exist,
+        raises ValueError if quantity is not a positive int
         
         Keyword Arguments:
-        quantity -- amount of items bought (int),
-        user_uuid -- unique user uuid (str),
-        product_uuid -- unique product uuid (str)
-
-        """
+        quantity -- amount of items bought (int, at least 1),
+        user -- unique user uuid or username (str),
+        product -- unique product uuid or product_name (str)
+        user_uuid -- if True looks user by user_uuid else by username
+        product_uuid -- if True looks product by product_uuid else by product_name
+
+        """
+        if type(quantity) not in (int, long) or quantity < 1:
+            raise ValueError("Invalid quantity")
+        user_column = users.c.user_uuid if user_uuid else users.c.username
+        product_column = products.c.product_uuid if product_uuid else products.c.product_name
+        upsert = text(UPSERT_BOUGHT_PRODUCT.format(user_column = user_column.name,
+                                                   product_column = product_column.name))
+        # same product the upsert picked (lowest id if name is not unique)
+        product_id = select([products.c.product_id])\
+                .where(product_column == product)\
+                .order_by(products.c.product_id).limit(1).as_scalar()
+        trans = self.conn.begin()
         try:
-            bought = self.check_user_bought_product(user_uuid, product_uuid) # check if user bought item    
+            res = self.conn.execute(upsert, quantity = quantity, user = user, product = product)
+            if res.rowcount:
+                self.bump_product_sales(product_id, quantity)
+            trans.commit()
+            if res.rowcount:
+                self.invalidate("top")
+            return bool(res.rowcount)
         except:
+            trans.rollback()
+            logging.error("Error adding bought product")
             raise
-        if bought:
-            try:
-                self.increase_bought_qty(quantity, bought) # if yes increase quantity
-            except:
-                raise
-        else:
+
+
+
+    def get_product_ids(self, uuids = (), names = ()):
+        """
+        Resolves product ids in a single query
+        Returns tuple of dictionaries (uuid -> product_id, product_name -> product_id)
+
+        Keyword Arguments:
+        uuids -- iterable of product uuids
+        names -- iterable of product names
+        """
+        conditions = list()
+        if uuids:
+            conditions.append(products.c.product_uuid.in_(list(uuids)))
+        if names:
+            conditions.append(products.c.product_name.in_(list(names)))
+        by_uuid, by_name = dict(), dict()
+        if not conditions:
+            return by_uuid, by_name
+        sel = select([products.c.product_id, products.c.product_uuid, products.c.product_name])\
+                .where(or_(*conditions))
+        for product_id, product_uuid, product_name in self.conn.execute(sel):
+            by_uuid[product_uuid] = product_id
+            by_name.setdefault(product_name, product_id)
+        return by_uuid, by_name
+
+    def add_bought_products(self, user, items, user_uuid = True):
+        """
+        Buys many products at once (eg. cart checkout),
+        product ids are resolved in one query and all quantities
+        are added in a single transaction
+
+        Returns list containing result for every item:
+            {"product": identifier, "quantity": n, "status": code}
+        where status is 201 if bought, 404 if product doesnt exist
+        or 400 if item is malformed, returns None if user doesnt exist
+        
+        Keyword Arguments:
+        user -- unique user uuid or username (str),
+        items -- list of dicts containing product_uuid or product_name and quantity
+        user_uuid -- if True looks user by user_uuid else by username
+        """
+        user_column = users.c.user_uuid if user_uuid else users.c.username
+        user_id = self.conn.execute(select([users.c.user_id]).where(user_column == user)).scalar()
+        if not user_id:
+            return None
+
+        uuids = [item["product_uuid"] for item in items
+                 if isinstance(item, dict) and not item.get("product_name") and item.get("product_uuid")]
+        names = [item["product_name"] for item in items
+                 if isinstance(item, dict) and item.get("product_name")]
+        by_uuid, by_name = self.get_product_ids(uuids, names)
+
+        results, rows = list(), list()
+        for item in items:
+            if not isinstance(item, dict):
+                results.append(dict(product = None, quantity = None, status = 400))
+                continue
+            identifier = item.get("product_name") or item.get("product_uuid")
+            quantity = item.get("quantity")
+            if item.get("product_name"):
+                product_id = by_name.get(identifier)
+            else:
+                product_id = by_uuid.get(identifier)
+            result = dict(product = identifier, quantity = quantity)
+            if not identifier or type(quantity) not in (int, long) or quantity < 1:
+                result["status"] = 400
+            elif not product_id:
+                result["status"] = 404
+            else:
+                result["status"] = 201
+                rows.append(dict(quantity = quantity, user_id = user_id, product_id = product_id))
+            results.append(result)
+
+        if rows:
+            trans = self.conn.begin()
             try:
-                self.create_bought_product(quantity, user_uuid, product_uuid) # else create new record
+                self.conn.execute(text(UPSERT_BOUGHT_PRODUCT_IDS), rows)
+                sold = dict()
+                for row in rows:
+                    sold[row["product_id"]] = sold.get(row["product_id"], 0) + row["quantity"]
+                for product_id, quantity in sold.items():
+                    self.bump_product_sales(product_id, quantity)
+                trans.commit()
+                self.invalidate("top")
             except:
+                trans.rollback()
+                logging.error("Error adding bought products")
                 raise
+        return results
 
 
 
@@ -797,21 +1532,54 @@ class MiscDBHandler(BaseDBHandler):
     """
 
 
-    def get_top_selling_products(self, limit=10):
+    def get_top_selling_products(self, limit=10, columnar = False):
         """
-        Returns list of most selled products
+        Returns list of most selled products,
+        reads maintained product_sales walking its quantity index
         limit -- (optional) limit the results, defaults to 10
+        columnar -- if True returns columnar format (see columnar_rows),
+        ordered by quantity
         """
-        sel = select([products.c.product_name, products.c.product_uuid, func.sum(bought_products.c.quantity).label("sum")])\
-                .select_from(products.join(bought_products))\
-                .group_by(bought_products.c.product_id)\
-                .order_by(desc("sum")).limit(limit)
+        sel = select([products.c.product_name, products.c.product_uuid, product_sales.c.quantity])\
+                .select_from(product_sales.join(products))\
+                .where(product_sales.c.quantity > 0)\
+                .order_by(desc(product_sales.c.quantity)).limit(limit)
 
         top_products = self.conn.execute(sel).fetchall()
-
+        if columnar:
+            return self.columnar_rows(top_products, ("product_name", "product_uuid", "quantity"))
         return self.parse_list_query_data(top_products, ("product_name", "product_uuid", "quantity"), "product_name", True)
 
 
+    def reconcile_counters(self):
+        """
+        Recounts all maintained counters and product sales from tables,
+        used for databases created before counters existed
+        or modified outside of db handlers
+        """
+        trans = self.conn.begin()
+        try:
+            self.conn.execute(counters.delete())
+            rows = [dict(name = "users", value = self.conn.execute(self.counter_seed("users")).scalar()),
+                    dict(name = "products", value = self.conn.execute(self.counter_seed("products")).scalar())]
+            sel = select([products.c.category, func.count(products.c.product_id)])\
+                    .where(products.c.category != None)\
+                    .group_by(products.c.category)
+            for category, number in self.conn.execute(sel):
+                rows.append(dict(name = self.category_counter(category), value = number))
+            self.conn.execute(counters.insert(), rows)
+            self.conn.execute(product_sales.delete())
+            sold = select([bought_products.c.product_id, func.sum(bought_products.c.quantity)])\
+                    .select_from(bought_products.join(products))\
+                    .group_by(bought_products.c.product_id)
+            self.conn.execute(product_sales.insert().from_select(["product_id", "quantity"], sold))
+            trans.commit()
+            self.invalidate("users", "products", "top")
+        except:
+            trans.rollback()
+            raise
+
+
 class AuthDBHandler(object):
     """
     Simple class implementing methods
@@ -829,9 +1597,10 @@ class AuthDBHandler(object):
         else:
             haystack = users.c.username
 
-        sel = select([users.c.password]).where(haystack == username)
         try:
-            res = self.conn.execute(sel).scalar()
+            res = execute(self.conn, ("scalar", users.c.password, haystack),
+                          lambda: select([users.c.password]).where(haystack == bindparam("value")),
+                          value = username).scalar()
             if res:
                 return res
             return False
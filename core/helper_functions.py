@@ -1,37 +1,221 @@
 import hashlib
-from config import SECRET_KEY
+import hmac
+import os
+import time
+import base64
+import re
+import simplejson as json
+from config import SECRET_KEY, PASSWORD_HASH_ALGORITHM, PASSWORD_HASH_ITERATIONS
+from config import SESSION_KEYS, SESSION_KEY_ID, SESSION_MAX_AGE
 
+# number with optional thousands separators (comma, dot or space before
+# group of three digits) and decimal part, see parse_price
+PRICE_PATTERN = re.compile(ur"\d+(?:(?:[.,]|[ \u00a0](?=\d{3}(?!\d)))\d+)*")
 
 
-def generate_password_hash(password):
+
+def sha1_hash(password, salt = None, iterations = None):
 
     """
-    Generates password using sha1 algorithm 
+    Legacy single round sha1 hash salted with SECRET_KEY,
+    stored without algorithm prefix
     """
 
     return hashlib.sha1(password + "," + SECRET_KEY).hexdigest()
 
+def pbkdf2_sha256_hash(password, salt = None, iterations = PASSWORD_HASH_ITERATIONS):
+
+    """
+    PBKDF2-HMAC-SHA256 hash stored as:
+        pbkdf2_sha256$iterations$salt$hash
+    """
+
+    if salt is None:
+        salt = base64.b64encode(os.urandom(12))
+    # salt read from database comes as unicode
+    salt = str(salt)
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    digest = hashlib.pbkdf2_hmac("sha256", password, salt, int(iterations))
+    return "pbkdf2_sha256${0}${1}${2}".format(iterations, salt, base64.b64encode(digest))
+
+# algorithm name -> function(password, salt, iterations)
+PASSWORD_HASHERS = dict(
+    sha1 = sha1_hash,
+    pbkdf2_sha256 = pbkdf2_sha256_hash
+)
+
+def parse_password_hash(signature):
+    """
+    Returns tuple (algorithm, iterations, salt) of stored hash,
+    hashes without prefix are legacy sha1
+    """
+
+    if "$" not in signature:
+        return "sha1", None, None
+    algorithm, iterations, salt, digest = signature.split("$", 3)
+    return algorithm, int(iterations), salt
+
+def generate_password_hash(password, algorithm = PASSWORD_HASH_ALGORITHM, iterations = PASSWORD_HASH_ITERATIONS):
+
+    """
+    Generates password hash using given algorithm (see PASSWORD_HASHERS)
+    with random salt, cost defaults to one from config.py
+    """
+
+    if algorithm == "sha1":
+        return sha1_hash(password)
+    return PASSWORD_HASHERS[algorithm](password, iterations = iterations)
+
 def check_password_hash(password, signature):
     """
-    Verifies that hash matches password 
+    Verifies that hash matches password,
+    algorithm and cost are read from the stored hash
+    """
+
+    if not signature:
+        return False
+    try:
+        algorithm, iterations, salt = parse_password_hash(signature)
+        expected = PASSWORD_HASHERS[algorithm](password, salt, iterations)
+    except (KeyError, ValueError):
+        return False
+    return hmac.compare_digest(str(signature), expected)
+
+def password_needs_rehash(signature, cost = PASSWORD_HASH_ITERATIONS):
+    """
+    Returns True if hash was made with different algorithm
+    or lower cost than currently configured (or given)
+    """
+
+    algorithm, iterations, salt = parse_password_hash(signature)
+    if algorithm != PASSWORD_HASH_ALGORITHM:
+        return True
+    return algorithm != "sha1" and iterations < cost
+
+def generate_session_token(username, user_uuid, password_hash, key_id = SESSION_KEY_ID, max_age = SESSION_MAX_AGE):
+    """
+    Generates signed, expiring session token:
+        key_id.expires.issued.username.user_uuid.fingerprint.signature
+    issued is time of issue in microseconds, username is urlsafe
+    base64 encoded, fingerprint is keyed hash of user's password hash
+    (see session_fingerprint), signature is HMAC-SHA256 of the rest
+    of the token using key from SESSION_KEYS
     """
 
-    return signature == generate_password_hash(password)
+    if isinstance(username, unicode):
+        username = username.encode("utf-8")
+    now = time.time()
+    key = SESSION_KEYS[key_id]
+    payload = "{0}.{1}.{2}.{3}.{4}.{5}".format(key_id, int(now + max_age), int(now * 1000000),
+                                               base64.urlsafe_b64encode(username).rstrip("="), user_uuid,
+                                               session_fingerprint(key, password_hash))
+    return payload + "." + _sign_session(key, payload)
 
-def generate_secure_cookie(username):
+def decode_session_token(token):
     """
-    NOTE: this cookie is not at all secure
-    generates cookie based on username and secret_key
+    Returns tuple (username, user_uuid, issued, fingerprint) read from
+    session token or None if token is malformed, expired, tampered with
+    or signed with key no longer in SESSION_KEYS, doesnt touch the database
     """
 
-    return hashlib.sha1(username + ";session;" + SECRET_KEY).hexdigest()
+    try:
+        payload, signature = str(token).rsplit(".", 1)
+        key_id, expires, issued, username, user_uuid, fingerprint = payload.split(".")
+        key = SESSION_KEYS[key_id]
+        if not hmac.compare_digest(signature, _sign_session(key, payload)):
+            return None
+        if int(expires) < time.time():
+            return None
+        username = base64.urlsafe_b64decode(username + "=" * (-len(username) % 4)).decode("utf-8")
+        return username, user_uuid, int(issued) / 1000000.0, fingerprint
+    except (KeyError, TypeError, ValueError, UnicodeError):
+        return None
 
-def check_secure_cookie(cookie, username):
+def session_fingerprint(key, password_hash):
     """
-    Validates the cookie 
+    Returns short keyed hash of user's password hash, signed into
+    session tokens so they stop working once password changes
+    or account is deleted and registered again, the hash itself
+    cant be read from the token
     """
 
-    return cookie == generate_secure_cookie(username)
+    if isinstance(password_hash, unicode):
+        password_hash = password_hash.encode("utf-8")
+    return _sign_session(key, "fingerprint." + str(password_hash))[:16]
 
+def check_session_token(token, credentials, revocations = None):
+    """
+    Validates that token is valid session token of user with given
+    credentials -- tuple (username, password_hash, user_uuid)
+    as returned by BaseDBHandler.get_credentials, token has to name
+    the same account (username and uuid) and be issued for its current
+    password. Given revocations (see cache.SessionRevocations) tokens
+    issued before user's password changed or user was deleted
+    are rejected as well
+    """
+
+    if not credentials or not credentials[1]:
+        return False
+    username, password_hash, user_uuid = credentials[:3]
+    decoded = decode_session_token(token)
+    if decoded is None or decoded[0] != username or decoded[1] != str(user_uuid):
+        return False
+    key = SESSION_KEYS[str(token).split(".", 1)[0]]
+    if not hmac.compare_digest(decoded[3], session_fingerprint(key, password_hash)):
+        return False
+    return revocations is None or not revocations.revoked(decoded[2], username, user_uuid)
 
+def _sign_session(key, payload):
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
 
+
+def encode_cursor(key):
+    """
+    Encodes key of the last row on the page (eg. primary key)
+    into opaque url safe pagination cursor
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(key)).rstrip("=")
+
+def decode_cursor(cursor):
+    """
+    Decodes cursor generated by encode_cursor,
+    raises ValueError if cursor is malformed
+    """
+
+    try:
+        cursor = str(cursor)
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor")
+
+def parse_price(price):
+    """
+    Returns price in minor units (eg. grosze, cents) read from
+    free form price string such as "120zl", "30$", "12,50 PLN"
+    or "1 000,50 zl", first number found is used.
+    Last dot or comma followed by one or two digits is decimal separator,
+    other separators have to be the same thousands separator
+    followed by groups of three digits ("1,000" is 1000).
+    None if there is no number or it is ambiguous (eg. "1,2345", "1.5.3")
+    """
+    if price is None:
+        return None
+    match = PRICE_PATTERN.search(unicode(price))
+    if not match:
+        return None
+    groups = re.split(r"\D", match.group())
+    separators = re.findall(r"\D", match.group())
+    minor = u"0"
+    if separators and separators[-1] in u".," and len(groups[-1]) <= 2:
+        minor = groups.pop()
+        # decimal separator cant be also thousands separator
+        if separators.pop() in separators:
+            return None
+    if separators:
+        if len(set(separators)) > 1 or groups[0].startswith(u"0") or len(groups[0]) > 3:
+            return None
+        if any(len(group) != 3 for group in groups[1:]):
+            return None
+    return int(u"".join(groups)) * 100 + int(minor.ljust(2, u"0"))
@@ -1,9 +1,15 @@
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, String, Unicode, Integer, MetaData, ForeignKey, UniqueConstraint, ForeignKeyConstraint, DateTime
+import time
+import threading
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import create_engine, DDL
+from sqlalchemy.sql import table, column
+from sqlalchemy import Table, Column, String, Unicode, Integer, MetaData, ForeignKey, UniqueConstraint, ForeignKeyConstraint, DateTime, Index
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 from config import *
 
 
-engine = create_engine(DATABASE_PATH)
 metadata = MetaData()
 
 
@@ -12,12 +18,18 @@ users = Table("users", metadata,
               Column("user_id", Integer, primary_key = True),
               Column("user_uuid", String, nullable = False),
               Column("username", String(40), nullable = False),
-              Column("password", String(40)),
+              Column("password", String(128)),
               Column("email", String(40), nullable = False),
               Column("joined", String),
               UniqueConstraint("user_uuid", "username", "email")
              )
 
+# lookups by uuid, username (get_scalar, get_credentials) and email (credentials_unique),
+# uuid index is unique so inserts can skip checking for collisions (see save_with_uuid)
+Index("ix_users_user_uuid", users.c.user_uuid, unique = True)
+Index("ix_users_username", users.c.username)
+Index("ix_users_email", users.c.email)
+
 bought_products = Table("bought_products", metadata, 
                         Column("bought_id", Integer, primary_key = True),
                         Column("quantity", Integer, nullable = False),
@@ -32,6 +44,12 @@ bought_products = Table("bought_products", metadata,
                         #  )
                        )
 
+# one row per user and product, purchases increase its quantity
+# (also serves lookups by user_id alone)
+Index("ix_bought_products_user_product", bought_products.c.user_id, bought_products.c.product_id, unique = True)
+# joins from products and grouping by product
+Index("ix_bought_products_product_id", bought_products.c.product_id)
+
 products = Table("products", metadata,
                  Column("product_id", Integer, primary_key = True),
                  Column("product_uuid", String, nullable = False),
@@ -41,9 +59,39 @@ products = Table("products", metadata,
                  Column("price", String),
                  # Column("seller", ForeignKey("users.user_id")),
                  Column("seller", String(30)),
+                 # price in minor units parsed from price (see helper_functions.parse_price),
+                 # used for filtering and sorting, not returned to clients
+                 Column("price_minor", Integer),
                  UniqueConstraint("product_uuid", "product_name")
                 )
 
+# lookups by uuid (unique, see save_with_uuid), name and seller (get_users_sold_products)
+Index("ix_products_product_uuid", products.c.product_uuid, unique = True)
+Index("ix_products_product_name", products.c.product_name)
+Index("ix_products_seller", products.c.seller)
+# category filter, ordered by primary key for keyset pagination
+Index("ix_products_category", products.c.category, products.c.product_id)
+# price range filters and ordering by price, with and without category
+Index("ix_products_price_minor", products.c.price_minor, products.c.product_id)
+Index("ix_products_category_price_minor", products.c.category, products.c.price_minor, products.c.product_id)
+
+# maintained row counts, updated in the same transaction as the rows they count
+# names: "users", "products" and "products:<category>" for each category
+counters = Table("counters", metadata,
+                 Column("name", String(80), primary_key = True),
+                 Column("value", Integer, nullable = False, default = 0)
+                )
+
+# total quantity sold per product, maintained together with bought_products
+# so top sellers are read from the quantity index instead of aggregating purchases
+product_sales = Table("product_sales", metadata,
+                      Column("product_id", Integer, ForeignKey("products.product_id", ondelete="CASCADE"),
+                             primary_key = True),
+                      Column("quantity", Integer, nullable = False, default = 0)
+                     )
+
+Index("ix_product_sales_quantity", product_sales.c.quantity)
+
 """
 add event for properly handling cascading in sqlite 
 
@@ -54,5 +102,227 @@ def on_connect(conn, record):
 
 
 from sqlalchemy import event 
-event.listen(engine, "connect", on_connect)
+
+
+"""
+full text index of product names and descriptions (sqlite FTS5),
+external content table reading rows from products by rowid (product_id),
+triggers keep it in sync with products
+
+"""
+
+products_search = table("products_search", column("rowid"), column("rank"), column("products_search"))
+
+PRODUCTS_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE products_search USING fts5("
+    "product_name, product_desc, content='products', content_rowid='product_id')",
+    "CREATE TRIGGER products_search_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO products_search (rowid, product_name, product_desc) "
+    "VALUES (new.product_id, new.product_name, new.product_desc); END",
+    "CREATE TRIGGER products_search_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO products_search (products_search, rowid, product_name, product_desc) "
+    "VALUES ('delete', old.product_id, old.product_name, old.product_desc); END",
+    "CREATE TRIGGER products_search_update AFTER UPDATE OF product_name, product_desc ON products BEGIN "
+    "INSERT INTO products_search (products_search, rowid, product_name, product_desc) "
+    "VALUES ('delete', old.product_id, old.product_name, old.product_desc); "
+    "INSERT INTO products_search (rowid, product_name, product_desc) "
+    "VALUES (new.product_id, new.product_name, new.product_desc); END",
+)
+
+PRODUCTS_SEARCH_DROP_DDL = (
+    "DROP TRIGGER IF EXISTS products_search_insert",
+    "DROP TRIGGER IF EXISTS products_search_delete",
+    "DROP TRIGGER IF EXISTS products_search_update",
+    "DROP TABLE IF EXISTS products_search",
+)
+
+for ddl in PRODUCTS_SEARCH_DDL:
+    event.listen(products, "after_create", DDL(ddl).execute_if(dialect = "sqlite"))
+for ddl in PRODUCTS_SEARCH_DROP_DDL:
+    event.listen(products, "before_drop", DDL(ddl).execute_if(dialect = "sqlite"))
+
+
+def create_db_engine(path = DATABASE_PATH):
+    """
+    Creates engine using connection pool configured in config.py,
+    in-memory sqlite databases keep sqlalchemy default pool
+    (there is only one connection to share anyway)
+    """
+    url = make_url(path)
+    options = dict()
+    if not (url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:")):
+        options = dict(
+            poolclass = QueuePool,
+            pool_size = DB_POOL_SIZE,
+            max_overflow = DB_MAX_OVERFLOW,
+            pool_timeout = DB_POOL_TIMEOUT,
+        )
+        if url.drivername.startswith("sqlite"):
+            # pooled connections are handed between IOLoop and db threads
+            options["connect_args"] = dict(check_same_thread = False)
+    db_engine = create_engine(url, **options)
+    event.listen(db_engine, "connect", on_connect)
+    track_queries(db_engine)
+    return db_engine
+
+
+"""
+per request statement counting, statements executed while QueryStats
+are collected (see collect_queries) are added to them
+
+"""
+
+_query_context = threading.local()
+
+
+class QueryStats(object):
+
+    """
+    Number of statements executed for single request
+    and time spent executing them,
+    statements may be run by many db threads at once
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self._lock:
+            self.count += 1
+            self.time += elapsed
+
+
+def current_query_stats():
+    """
+    Returns QueryStats collected in current thread or None
+    """
+    return getattr(_query_context, "stats", None)
+
+
+@contextmanager
+def collect_queries(stats):
+    """
+    Adds statements executed by current thread inside the block to stats,
+    restores previously collected stats on exit
+    """
+    previous = current_query_stats()
+    _query_context.stats = stats
+    try:
+        yield stats
+    finally:
+        _query_context.stats = previous
+
+
+def on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on execution context, which is discarded with it if statement fails
+    if context is not None:
+        context._query_start = time.time()
+
+
+def on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is None:
+        return
+    elapsed = time.time() - start
+    stats = current_query_stats()
+    if stats is not None:
+        stats.add(elapsed)
+
+
+def track_queries(bind):
+    """
+    Counts statements executed through given engine or connection,
+    connections listen to their engine's events only if created
+    after the engine started listening so they get their own listeners
+    """
+    for target in (bind.engine, bind):
+        if event.contains(target, "before_cursor_execute", on_before_execute):
+            return
+    event.listen(bind, "before_cursor_execute", on_before_execute)
+    event.listen(bind, "after_cursor_execute", on_after_execute)
+
+
+engine = create_db_engine()
+
+
+class PoolStats(object):
+
+    """
+    Collects connection pool statistics for given engine:
+    number of connections checked out, pool overflow
+    and time spent waiting for a connection,
+    use pool_stats to get the instance attached to an engine
+    """
+
+    def __init__(self, engine):
+        # weak so _pool_stats entry doesnt keep the engine alive
+        self._engine = weakref.ref(engine)
+        # checkin and checkout events come from db executor threads
+        self.lock = threading.Lock()
+        self.checked_out = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+
+    def on_checkout(self, dbapi_conn, record, proxy):
+        with self.lock:
+            self.checked_out += 1
+
+    def on_checkin(self, dbapi_conn, record):
+        with self.lock:
+            self.checked_out -= 1
+
+    @property
+    def engine(self):
+        return self._engine()
+
+    def connect(self):
+        """
+        Checks out connection from the pool measuring wait time
+        """
+        start = time.time()
+        conn = self.engine.connect()
+        waited = time.time() - start
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def as_dict(self):
+        pool = self.engine.pool
+        stats = dict(
+            pool = type(pool).__name__,
+            checked_out = self.checked_out,
+            checkouts = self.checkouts,
+            wait_total_ms = round(self.wait_total * 1000, 3),
+            wait_avg_ms = round(self.wait_total * 1000 / max(self.checkouts, 1), 3),
+            wait_max_ms = round(self.wait_max * 1000, 3),
+        )
+        if isinstance(pool, QueuePool):
+            stats["size"] = pool.size()
+            stats["overflow"] = max(pool.overflow(), 0)
+            stats["checked_in"] = pool.checkedin()
+        return stats
+
+
+# engine -> PoolStats listening to its pool events
+_pool_stats = weakref.WeakKeyDictionary()
+_pool_stats_lock = threading.Lock()
+
+
+def pool_stats(engine):
+    """
+    Returns PoolStats of given engine, attaching it on first call
+    so applications sharing an engine dont add listeners each
+    """
+    with _pool_stats_lock:
+        stats = _pool_stats.get(engine)
+        if stats is None:
+            stats = _pool_stats[engine] = PoolStats(engine)
+        return stats
 
@@ -0,0 +1,83 @@
+'''
+File: serializers.py
+Author: Konrad Wasowicz
+Description: JSON encoding of responses using fastest available
+library and pre-encoded status envelopes
+'''
+
+import logging
+from functools import partial
+import simplejson
+
+from config import *
+
+
+def _ujson():
+    import ujson
+    # simplejson doesnt escape slashes either
+    return partial(ujson.dumps, escape_forward_slashes = False)
+
+def _rapidjson():
+    import rapidjson
+    return rapidjson.dumps
+
+def _simplejson():
+    return simplejson.dumps
+
+# library name -> function importing it and returning its dumps
+ENCODERS = dict(
+    ujson = _ujson,
+    rapidjson = _rapidjson,
+    simplejson = _simplejson
+)
+
+# encoded by every encoder once when loaded, encoders that fail
+# (eg. ujson build without escape_forward_slashes) or dont round trip are skipped
+ENCODER_PROBE = {"url": "/products?limit=10", "name": u"\u0142", "price": 1.5, "items": [1, None, True]}
+
+def load_encoder(names = JSON_ENCODERS):
+    """
+    Returns tuple (name, dumps) of first encoder from names
+    that can be imported and encodes ENCODER_PROBE, simplejson if none can
+    """
+    for name in names:
+        try:
+            encoder = ENCODERS[name]()
+            if simplejson.loads(encoder(ENCODER_PROBE)) != ENCODER_PROBE:
+                continue
+            return name, encoder
+        except (ImportError, KeyError, TypeError, ValueError, OverflowError):
+            continue
+    return "simplejson", simplejson.dumps
+
+encoder_name, _dumps = load_encoder()
+logging.info("Using {0} for JSON encoding".format(encoder_name))
+
+
+def dumps(obj):
+    """
+    Encodes obj to JSON with encoder picked at startup,
+    objects it cant encode (eg. Decimal) are encoded by simplejson
+    """
+    try:
+        return _dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        return simplejson.dumps(obj)
+
+
+# (status, message) -> encoded beginning of the envelope, up to _meta value
+_envelopes = dict()
+
+def response_envelope(status, message, _meta = None):
+    """
+    Returns JSON of generic response:
+        {"status": 200, "message": "OK", "_meta": null}
+    beginning of the envelope is encoded once for every status
+    and reused, only _meta is encoded on each call
+    """
+    prefix = _envelopes.get((status, message))
+    if prefix is None:
+        prefix = _envelopes[(status, message)] = '{{"status": {0}, "message": {1}, "_meta": '.format(int(status), dumps(message))
+    if _meta is None:
+        return prefix + "null}"
+    return prefix + dumps(_meta) + "}"
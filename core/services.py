@@ -0,0 +1,46 @@
+'''
+File: services.py
+Author: Konrad Wasowicz
+Description: In-process authentication and lookup services used by views
+'''
+
+from config import *
+from db_base import UserDatabaseHandler, ProductDatabaseHandler
+
+
+class LocalService(object):
+
+    """
+    Implements the same lookups that /auth and /product expose
+    over http, but calls database handlers directly so views dont
+    have to make requests to themselves. Lookups run on application
+    db executor and return futures to be yielded
+
+    sample usage inside coroutine:
+        item_data = yield self.service.get_item_data(u"wiertarka")
+    """
+
+    def __init__(self, async_db):
+        """
+        async_db -- function returning AsyncDBHandler for given
+        database handler class (see BaseHandler.async_db)
+        """
+        self.async_db = async_db
+
+    def get_credentials(self, identifier):
+        """
+        Returns future of (username, password hash, user_uuid)
+        of user with given username or uuid, None if not found
+        """
+        return self.async_db(UserDatabaseHandler).get_credentials(identifier)
+
+    def get_item_data(self, identifier, direct = 0):
+        """
+        Returns future of product information or empty dict if not found
+        if direct == 1 looks by product_uuid else by product_name
+        """
+        try:
+            direct = bool(int(direct))
+        except:
+            direct = False
+        return self.async_db(ProductDatabaseHandler).get_product(identifier, direct)
@@ -0,0 +1,53 @@
+'''
+File: statements.py
+Author: Konrad Wasowicz
+Description: Registry of prebuilt statements for hot lookups,
+built with bindparam placeholders once and compiled once per dialect
+'''
+
+
+# key -> statement built by first caller
+_statements = dict()
+# (key, dialect name, paramstyle) -> compiled statement
+_compiled = dict()
+
+
+def statement(key, build):
+    """
+    Returns statement registered under key,
+    building it with build() on first use
+
+    Keyword Arguments:
+    key -- hashable identifying the statement, tables and columns
+    it depends on should be part of it (eg. ("scalar", output, column))
+    build -- function returning sqlalchemy statement using bindparam
+    for every value that changes between calls
+    """
+    sel = _statements.get(key)
+    if sel is None:
+        sel = _statements.setdefault(key, build())
+    return sel
+
+
+def compiled(key, build, dialect):
+    """
+    Returns statement registered under key compiled for given dialect
+    """
+    compiled_key = (key, dialect.name, dialect.paramstyle)
+    result = _compiled.get(compiled_key)
+    if result is None:
+        result = _compiled.setdefault(compiled_key, statement(key, build).compile(dialect = dialect))
+    return result
+
+
+def execute(conn, key, build, **params):
+    """
+    Executes statement registered under key on given connection
+    with params bound to its placeholders, returns result proxy
+
+    sample usage:
+        execute(conn, ("scalar", users.c.username, users.c.user_uuid),
+                lambda: select([users.c.username]).where(users.c.user_uuid == bindparam("value")),
+                value = user_uuid).scalar()
+    """
+    return conn.execute(compiled(key, build, conn.dialect), **params)
@@ -1,17 +1,23 @@
 import unittest
 import os, sys
 import uuid
+import tempfile
+import threading
 from datetime import datetime
 
 sys.path.append("..")
+import db_base
+import statements
 from db_base import BaseDBHandler, UserDatabaseHandler, ProductDatabaseHandler, MiscDBHandler, BoughtDBHandler
+from async_db import AsyncDBHandler, ThreadedDBExecutor, InlineDBExecutor, create_db_executor
 from config import *
+from helper_functions import parse_price
 
-from models import users, products, metadata, bought_products
+from models import users, products, metadata, bought_products, counters, product_sales, create_db_engine
 from sqlalchemy import create_engine
 from sqlalchemy.sql import select, exists
 
-from sqlalchemy import distinct, func
+from sqlalchemy import distinct, func, event
 from sqlalchemy.exc import IntegrityError
 
 
@@ -96,6 +102,17 @@ class TestDBUtilities(unittest.TestCase):
 
         self.assertEquals(5, self.user_handler.get_number_of_users())
 
+    def test_counting_deleted_users(self):
+
+        self.user_handler = UserDatabaseHandler(conn = self.conn)
+        self.assertEquals(2, self.user_handler.get_number_of_users())
+        self.user_handler.delete_user(u"konrad", uuid = False)
+        self.assertEquals(1, self.user_handler.get_number_of_users())
+        self.user_handler.delete_user(u"konrad", uuid = False)
+        self.assertEquals(1, self.user_handler.get_number_of_users())
+        self.user_handler.delete_user(self.uuid2)
+        self.assertEquals(0, self.user_handler.get_number_of_users())
+
     def test_adding_user(self):
 
         self.user_handler = UserDatabaseHandler(conn = self.conn)
@@ -119,6 +136,25 @@ class TestDBUtilities(unittest.TestCase):
 
 
         #TODO think about replacing generic uuid with user_uuid in user_fields
+
+    def test_creating_many_users(self):
+
+        self.user_handler = UserDatabaseHandler(conn = self.conn)
+        records = [
+            dict(username = u"kuba", password = "kuba", email = "kuba@gmail.com"),
+            dict(username = u"konrad", password = "konrad", email = "other@gmail.com"),
+            dict(username = u"ola", password = "ola", email = "kuba@gmail.com"),
+            dict(username = u"ola", password = "ola", email = "ola@gmail.com"),
+            dict(username = u"nopassword", email = "nopassword@gmail.com")
+        ]
+        results = self.user_handler.create_users(records, hash_passwords = lambda passwords: [p[::-1] for p in passwords])
+        self.assertEquals([201, 409, 409, 201, 400], [r["status"] for r in results])
+        self.assertEquals(4, self.user_handler.get_number_of_users())
+
+        sel = select([users.c.user_uuid, users.c.password]).where(users.c.username == u"ola")
+        ola = self.conn.execute(sel).fetchone()
+        self.assertEquals(results[3]["uuid"], ola[0])
+        self.assertEquals("alo", ola[1])
         #TODO also implement validators to be called before insert
 
         #test adding with not enough fields
@@ -174,6 +210,19 @@ class TestDBUtilities(unittest.TestCase):
         self.assertEquals("zmieniony", updated_user[3])
         self.assertEquals("zmieniony@gmail.com", updated_user[4])
 
+    def test_reusing_compiled_statements(self):
+        key = ("scalar", users.c.username, users.c.user_uuid)
+        self.assertEquals(u"konrad", self.db_handler.get_username_by_uuid(self.uuid1))
+        compiled = statements._compiled[(key, self.conn.dialect.name, self.conn.dialect.paramstyle)]
+        # following calls bind new values to the same compiled statement
+        self.assertEquals(u"malgosia", self.db_handler.get_username_by_uuid(self.uuid2))
+        self.assertFalse(self.db_handler.get_username_by_uuid("missing"))
+        self.assertIs(compiled, statements.compiled(key, None, self.conn.dialect))
+        self.assertEquals((u"konrad", "deprofundis", self.uuid1), tuple(self.db_handler.get_credentials(self.uuid1)))
+        self.assertEquals(u"malgosia", self.db_handler.get_credentials(u"malgosia")[0])
+        self.assertTrue(self.db_handler.check_exists(users.c.email, "malgosia@gmail.com"))
+        self.assertFalse(self.db_handler.check_exists(users.c.email, "konrad@gmail.com"))
+
 class TestProductsDB(unittest.TestCase):
 
     def setUp(self):
@@ -225,15 +274,143 @@ class TestProductsDB(unittest.TestCase):
 
 
 
-        # TODO integrity error not risen, even though it says so
         data = dict(uuid = pr_uuid, product_name = u"nowy5", product_desc = u"random", category = "all", seller = "konrad", price = "30$")
-        self.assertRaises(self.product_handler.save_product(data))
+        self.assertRaises(IntegrityError, lambda: self.product_handler.save_product(data))
+        self.assertEquals(2, self.product_handler.get_number_of_products())
         sel = select([products])
         # print self.conn.execute(sel).fetchall()
                 
         # TODO unique contraint not working natively (probably because of sqlite)
         data = dict(uuid = str(uuid.uuid4()), product_name = u"nowy", product_desc = u"t", category = "all", seller = "konrad", price = "30$")
         self.product_handler.save_product(data)
+    def test_maintained_counters(self):
+        for i in range(5):
+            category = "rtv" if i < 3 else "agd"
+            data = dict(product_name = u"product{0}".format(i), product_desc = u"test", category = category, seller = "konrad", price = "30$")
+            self.product_handler.create_product(data)
+
+        self.assertEquals(5, self.product_handler.get_number_of_products())
+        self.assertEquals(3, self.product_handler.get_number_of_products("rtv"))
+        self.assertEquals(2, self.product_handler.get_number_of_products("agd"))
+        self.assertEquals(0, self.product_handler.get_number_of_products("none"))
+        # reading unknown category doesnt create its counter
+        self.assertEquals(0, self.conn.execute(select([func.count()]).select_from(counters)
+                                               .where(counters.c.name.like(u"%none"))).scalar())
+
+        # totals are read from counters table, not counted
+        self.conn.execute(counters.update().where(counters.c.name == "products").values(value = 100))
+        self.assertEquals(100, self.product_handler.get_number_of_products())
+        MiscDBHandler(self.conn).reconcile_counters()
+        self.assertEquals(5, self.product_handler.get_number_of_products())
+
+        self.product_handler.delete_product(u"product0", uuid = False)
+        self.assertEquals(4, self.product_handler.get_number_of_products())
+        self.assertEquals(2, self.product_handler.get_number_of_products("rtv"))
+
+        # deleting nonexistent product doesnt change counters
+        self.product_handler.delete_product(u"nonexistent", uuid = False)
+        self.assertEquals(4, self.product_handler.get_number_of_products())
+
+        product_uuid = self.product_handler.get_uuid_by_product_name(u"product1")
+        self.product_handler.update_product(product_uuid, dict(category = "agd"))
+        self.assertEquals(1, self.product_handler.get_number_of_products("rtv"))
+        self.assertEquals(3, self.product_handler.get_number_of_products("agd"))
+        self.product_handler.update_product(product_uuid, dict(product_desc = u"changed"))
+        self.assertEquals(3, self.product_handler.get_number_of_products("agd"))
+        self.assertEquals(4, self.product_handler.get_number_of_products())
+
+    def test_keyset_pagination(self):
+        for i in range(7):
+            category = "even" if i % 2 == 0 else "odd"
+            data = dict(product_name = u"product{0}".format(i), product_desc = u"test", category = category, seller = "konrad", price = "30$")
+            self.product_handler.create_product(data)
+
+        page, last = self.product_handler.get_products_after(3)
+        self.assertEquals(3, len(page))
+        self.assertEquals(3, last)
+        page, last = self.product_handler.get_products_after(3, last)
+        self.assertEquals(set([u"product3", u"product4", u"product5"]), set(p["product_name"] for p in page.values()))
+        page, last = self.product_handler.get_products_after(3, last)
+        self.assertEquals(1, len(page))
+        self.assertEquals(None, last)
+
+        page, last = self.product_handler.get_products_after(10, None, category = "even")
+        self.assertEquals(4, len(page))
+        self.assertEquals(None, last)
+        page, last = self.product_handler.get_products_after(2, 3, category = "even")
+        self.assertEquals(set([u"product4", u"product6"]), set(p["product_name"] for p in page.values()))
+
+    def test_selecting_only_requested_fields(self):
+        data = dict(product_name = u"wiertarka", product_desc = u"x" * 10000, category = "all", seller = "konrad", price = "30$")
+        self.product_handler.create_product(data)
+        statements = list()
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(self.conn, "before_cursor_execute", record)
+        try:
+            product = self.product_handler.get_product(u"wiertarka", uuid = False, fields = ["product_name", "price"])
+            self.assertEquals(dict(product_name = u"wiertarka", price = u"30$"), product)
+            page = self.product_handler.get_product_list(10, 0, "all", fields = ["price"])
+            # listing is still keyed by uuid
+            self.assertEquals([dict(price = u"30$")], page.values())
+            page, last = self.product_handler.get_products_after(10, fields = ["product_name"])
+            self.assertEquals([dict(product_name = u"wiertarka")], page.values())
+        finally:
+            event.remove(self.conn, "before_cursor_execute", record)
+        self.assertEquals(3, len(statements))
+        for statement in statements:
+            self.assertNotIn("product_desc", statement)
+
+        self.assertRaises(ValueError, self.product_handler.get_product, u"wiertarka", False, ["password"])
+        user_handler = UserDatabaseHandler(self.conn)
+        user_handler.save_user(dict(uuid = str(uuid.uuid4()), username = u"konrad", password = "x", email = "konrad@gmail.com", joined = "2014-03-02"))
+        self.assertEquals(dict(username = u"konrad"), user_handler.get_user(u"konrad", safe = True, direct = True,
+                                                                           fields = ["username", "email"]))
+        self.assertRaises(ValueError, user_handler.get_user, u"konrad", True, True, ["email"])
+
+    def test_keeping_search_index_in_sync(self):
+        for name in (u"wiertarka", u"pralka"):
+            self.product_handler.create_product(dict(product_name = name, product_desc = u"bosch " + name,
+                                                     category = "all", seller = "konrad", price = "30$"))
+        found, more = self.product_handler.search_products(u"bosch", 10, 0)
+        self.assertEquals(set([u"wiertarka", u"pralka"]), set(product["product_name"] for product in found))
+        self.assertFalse(more)
+
+        self.product_handler.update_product(self.product_handler.get_uuid_by_product_name(u"pralka"),
+                                            dict(product_desc = u"amica"))
+        found, more = self.product_handler.search_products(u"bosch", 10, 0)
+        self.assertEquals([u"wiertarka"], [product["product_name"] for product in found])
+        self.assertEquals(1, len(self.product_handler.search_products(u"amica", 10, 0)[0]))
+
+        self.product_handler.delete_product(u"wiertarka", uuid = False)
+        self.assertEquals(([], False), self.product_handler.search_products(u"bosch", 10, 0))
+        self.assertRaises(ValueError, self.product_handler.search_products, u"  ", 10, 0)
+
+    def test_maintaining_numeric_price(self):
+        self.assertEquals([12000, 1999, 1250, 700, None],
+                          [parse_price(price) for price in ("120zl", "19,99 zl", "$12.5", "7", "za darmo")])
+        # thousands separators
+        self.assertEquals([100000, 100050, 100050, 100000, 123456700],
+                          [parse_price(price) for price in ("1,000 zl", "1.000,50 zl", "1,000.50$",
+                                                            u"1\u00a0000 zl", "1 234 567")])
+        # ambiguous numbers are left without numeric price
+        self.assertEquals([None, None, None, None],
+                          [parse_price(price) for price in ("1,2345", "1.5.3", "0,500", "1,000,5")])
+        self.product_handler.create_product(dict(product_name = u"wiertarka", product_desc = u"x", category = "all",
+                                                 seller = "konrad", price = "120zl"))
+        price_minor = lambda: self.conn.execute(select([products.c.price_minor])).scalar()
+        self.assertEquals(12000, price_minor())
+        updated = self.product_handler.update_product(self.product_handler.get_uuid_by_product_name(u"wiertarka"),
+                                                      dict(price = "99,90zl"))
+        self.assertNotIn("price_minor", updated)
+        self.assertEquals(9990, price_minor())
+        self.assertEquals(1, self.product_handler.get_number_of_products(min_price = 9990, max_price = 9990))
+        self.assertEquals(0, self.product_handler.get_number_of_products("all", min_price = 10000))
+        self.assertRaises(ValueError, self.product_handler.get_product_list, 10, 0, sort = "name")
+        self.product_handler.create_product(dict(product_name = u"pralka", product_desc = u"x", category = "all",
+                                                 seller = "konrad", price = "1,200 zl"))
+        page = self.product_handler.get_product_list(10, 0, sort = "-price", fields = ["product_name"])
+        self.assertEquals([u"pralka", u"wiertarka"], [product["product_name"] for product in page])
+
     def test_checking_if_product_unique(self):
 
         data = dict(uuid = str(uuid.uuid4()), product_name = u"nowy", product_desc = u"nowy produkt", category = "all", seller = "konrad", price = "30$" )
@@ -285,6 +462,28 @@ class TestProductsDB(unittest.TestCase):
         self.assertEquals(res["deprofundis"]["product_desc"], u"error")
         self.assertNotIn("random_arg", res["deprofundis"].keys())
 
+    def test_retrying_colliding_uuid(self):
+        data = dict(product_name = u"first", product_desc = u"sample", category = "all", seller = "konrad", price = "30$")
+        self.product_handler.create_product(data)
+        taken = self.conn.execute(select([products.c.product_uuid])).scalar()
+        fresh = uuid.uuid4()
+
+        original_uuid4 = db_base.uuid.uuid4
+        samples = [uuid.UUID(taken), uuid.UUID(taken), fresh]
+        db_base.uuid.uuid4 = lambda: samples.pop(0)
+        try:
+            data = dict(product_name = u"second", product_desc = u"sample", category = "all", seller = "konrad", price = "30$")
+            self.assertEquals(2, self.product_handler.create_product(data))
+            self.assertEquals(str(fresh), self.product_handler.get_product(u"second", False)["uuid"])
+
+            # gives up after UUID_RETRIES collisions
+            db_base.uuid.uuid4 = lambda: uuid.UUID(taken)
+            data = dict(product_name = u"third", product_desc = u"sample", category = "all", seller = "konrad", price = "30$")
+            self.assertRaises(IntegrityError, lambda: self.product_handler.create_product(data))
+        finally:
+            db_base.uuid.uuid4 = original_uuid4
+        self.assertEquals(2, self.product_handler.get_number_of_products())
+
     def test_getting_top_products(self):
 
         data = dict(product_name = u"wiertarka", product_desc = u"test", category = "all", seller = "konrad", price = "30$")
@@ -559,6 +758,176 @@ class TestBoughtProductsDB(unittest.TestCase):
         q = self.conn.execute(bought_quantity).scalar()
         self.assertEquals(q, 12)
 
+    def test_adding_many_bought_products(self):
+
+        self.bought_handler = BoughtDBHandler(self.conn)
+        items = [
+            dict(product_name = u"pralka", quantity = 3),
+            dict(product_uuid = self.product_uuid2, quantity = 2),
+            dict(product_name = u"hantle", quantity = 1),
+            dict(product_name = u"wiertarka", quantity = 0),
+            "invalid"
+        ]
+        results = self.bought_handler.add_bought_products(self.uuid3, items)
+        self.assertEquals([201, 201, 404, 400, 400], [r["status"] for r in results])
+
+        sel = select([bought_products.c.product_id, bought_products.c.quantity])\
+                .where(bought_products.c.user_id == 3).order_by(bought_products.c.product_id)
+        self.assertEquals([(1, 2), (2, 2), (3, 3)], [tuple(r) for r in self.conn.execute(sel)])
+
+        # quantities are added to products already bought
+        self.bought_handler.add_bought_products(u"kuba", [dict(product_name = u"wiertarka", quantity = 5)], user_uuid = False)
+        sel = select([bought_products.c.quantity])\
+                .where(bought_products.c.user_id == 3).where(bought_products.c.product_id == 1)
+        self.assertEquals(7, self.conn.execute(sel).scalar())
+
+        self.assertIsNone(self.bought_handler.add_bought_products(u"nobody", items, user_uuid = False))
+
+    def assertSalesConsistent(self):
+        sel = select([bought_products.c.product_id, func.sum(bought_products.c.quantity)])\
+                .select_from(bought_products.join(products).join(users))\
+                .group_by(bought_products.c.product_id)
+        expected = dict((product_id, quantity) for product_id, quantity in self.conn.execute(sel))
+        sel = select([product_sales]).where(product_sales.c.quantity > 0)
+        self.assertEquals(expected, dict((product_id, quantity) for product_id, quantity in self.conn.execute(sel)))
+
+    def test_maintained_product_sales(self):
+
+        self.bought_handler = BoughtDBHandler(self.conn)
+        misc_handler = MiscDBHandler(self.conn)
+        # rows in setUp were inserted directly
+        misc_handler.reconcile_counters()
+        self.assertSalesConsistent()
+        self.assertEquals([u"wiertarka", u"suszarka", u"pralka"],
+                          [p for p, q in sorted(misc_handler.get_top_selling_products().items(),
+                                                key = lambda item: -item[1]["quantity"])])
+
+        self.conn.execute(product_sales.delete().where(product_sales.c.product_id == 2))
+        self.bought_handler.add_bought_product(3, self.uuid3, self.product_uuid2)
+        self.bought_handler.add_bought_products(self.uuid3, [dict(product_name = u"pralka", quantity = 4),
+                                                             dict(product_name = u"pralka", quantity = 1)])
+        self.bought_handler.increase_bought_qty(2, 1)
+        self.assertSalesConsistent()
+
+        UserDatabaseHandler(self.conn).delete_user(self.uuid1)
+        self.assertSalesConsistent()
+        top = misc_handler.get_top_selling_products()
+        self.assertEquals(13, top[u"wiertarka"]["quantity"])
+        self.assertEquals(5, top[u"pralka"]["quantity"])
+
+        ProductDatabaseHandler(self.conn).delete_product(u"suszarka", uuid = False)
+        self.assertNotIn(u"suszarka", misc_handler.get_top_selling_products())
+        self.assertFalse(self.conn.execute(select([product_sales]).where(product_sales.c.product_id == 2)).fetchall())
+
+class TestAsyncDB(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        self.engine = create_engine("sqlite:///" + self.path)
+        metadata.bind = self.engine
+        metadata.create_all()
+        self.conn = self.engine.connect()
+        self.conn.execute(users.insert().values(user_uuid = str(uuid.uuid4()), username = u"konrad", password = "test", email = "depro@depro.com"))
+
+    def tearDown(self):
+        self.conn.close()
+        metadata.drop_all()
+        os.remove(self.path)
+
+    def test_choosing_executor(self):
+        executor = create_db_executor(self.conn)
+        self.assertEquals(ThreadedDBExecutor, type(executor))
+        executor.shutdown()
+
+        memory_conn = create_engine("sqlite:///:memory:").connect()
+        self.assertEquals(InlineDBExecutor, type(create_db_executor(memory_conn)))
+        self.assertEquals(InlineDBExecutor, type(create_db_executor(self.conn, max_workers = 0)))
+
+    def test_running_handlers_on_thread_pool(self):
+        executor = ThreadedDBExecutor(self.engine, 2)
+        db = AsyncDBHandler(UserDatabaseHandler, executor)
+
+        future = db.get_number_of_users()
+        self.assertEquals(1, future.result())
+        self.assertEquals(u"konrad", db.list_all_users(10, 0).result().values()[0]["username"])
+
+        # every worker uses its own connection
+        conns = [executor.executor.submit(executor.connection).result() for i in range(10)]
+        self.assertNotIn(self.conn, conns)
+        self.assertRaises(AttributeError, lambda: db.nonexistent_method)
+        executor.shutdown()
+
+    def test_inline_executor(self):
+        db = AsyncDBHandler(UserDatabaseHandler, InlineDBExecutor(self.conn))
+        future = db.get_number_of_users()
+        self.assertTrue(future.done())
+        self.assertEquals(1, future.result())
+
+class TestConcurrentPurchases(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        self.engine = create_db_engine("sqlite:///" + self.path)
+        metadata.bind = self.engine
+        metadata.create_all()
+        self.conn = self.engine.connect()
+        self.user_uuid = str(uuid.uuid4())
+        self.product_uuid = str(uuid.uuid4())
+        self.conn.execute(users.insert().values(user_uuid = self.user_uuid, username = u"konrad", password = "test", email = "depro@depro.com"))
+        self.conn.execute(products.insert().values(product_uuid = self.product_uuid, product_name = u"wiertarka", product_desc = u"test"))
+
+    def tearDown(self):
+        self.conn.close()
+        metadata.drop_all()
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_upsert_by_name_and_uuid(self):
+        handler = BoughtDBHandler(self.conn)
+        self.assertTrue(handler.add_bought_product(2, u"konrad", u"wiertarka", user_uuid = False, product_uuid = False))
+        self.assertTrue(handler.add_bought_product(3, self.user_uuid, self.product_uuid))
+        self.assertFalse(handler.add_bought_product(3, u"nonexistent", u"wiertarka", user_uuid = False, product_uuid = False))
+        self.assertFalse(handler.add_bought_product(3, self.user_uuid, str(uuid.uuid4())))
+        for quantity in (0, -5, "2", 1.5, None):
+            self.assertRaises(ValueError, handler.add_bought_product, quantity, self.user_uuid, self.product_uuid)
+
+        rows = self.conn.execute(select([bought_products])).fetchall()
+        self.assertEquals(1, len(rows))
+        self.assertEquals(5, rows[0][bought_products.c.quantity])
+
+        # second row for the same user and product is not allowed
+        ins = bought_products.insert().values(quantity = 1, user_id = rows[0][bought_products.c.user_id], product_id = rows[0][bought_products.c.product_id])
+        self.assertRaises(IntegrityError, lambda: self.conn.execute(ins))
+
+    def test_no_lost_increments(self):
+        threads_number = 8
+        purchases = 25
+        errors = list()
+
+        def buy():
+            conn = self.engine.connect()
+            handler = BoughtDBHandler(conn)
+            try:
+                for i in range(purchases):
+                    handler.add_bought_product(1, self.user_uuid, self.product_uuid)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target = buy) for i in range(threads_number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        total = self.conn.execute(select([func.sum(bought_products.c.quantity)])).scalar()
+        self.assertEquals(threads_number * purchases, total)
+        self.assertEquals(1, self.conn.execute(select([func.count(bought_products.c.bought_id)])).scalar())
+
 if __name__ == "__main__":
     unittest.main()
 
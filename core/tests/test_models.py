@@ -2,11 +2,13 @@ import os, sys
 import unittest
 from sqlalchemy import create_engine
 from sqlalchemy.sql import select, exists
+from sqlalchemy.exc import IntegrityError
 import uuid
 
 sys.path.append("..")
 
 from models import users, bought_products, products, metadata
+from models import track_queries, collect_queries, QueryStats
 
 
 class BaseDatabaseHandler(unittest.TestCase):
@@ -56,7 +58,7 @@ class TestBasicUserOperations(BaseDatabaseHandler):
 
         # check unique uuid
         ins = users.insert().values(user_uuid = self.sample_uuid1, username = u"test", password = "test", email = "test@test.com")
-        self.assertRaises(self.conn.execute(ins))
+        self.assertRaises(IntegrityError, lambda: self.conn.execute(ins))
 
         #check unique username
         ins = users.insert().values(user_uuid = str(uuid.uuid4()), username = u"konrad", password = "test_pass", email = "test@test.com")
@@ -74,6 +76,17 @@ class TestBasicUserOperations(BaseDatabaseHandler):
         self.assertRaises(self.conn.execute(ins))
 
 
+    def test_tracking_failed_queries(self):
+        track_queries(self.conn)
+        with collect_queries(QueryStats()) as stats:
+            ins = users.insert().values(user_uuid = self.sample_uuid1, username = u"konrad",
+                                        password = "test", email = "depro@depro.com")
+            self.assertRaises(IntegrityError, self.conn.execute, ins)
+            self.conn.execute(select([users.c.username])).fetchall()
+        # failed statement left nothing behind on the connection
+        self.assertEquals(1, stats.count)
+        self.assertNotIn("query_start", self.conn.info)
+
     def test_updating(self):
 
         up = users.update().where(users.c.username == u"konrad").values(email = "zmieniony@depro.com")
@@ -114,7 +127,7 @@ class TestBasicProductOperations(BaseDatabaseHandler):
         
         #uuid
         ins = products.insert().values(product_uuid = self.sample_uuid1, product_name = u"mlot kowalski", product_desc = u"mlot nic dodac nic ujac")
-        self.assertRaises(self.conn.execute(ins))
+        self.assertRaises(IntegrityError, lambda: self.conn.execute(ins))
         #product_name
         ins = products.insert().values(product_uuid = str(uuid.uuid4()), product_name = u"wiertarka", product_desc = u"test")
         self.assertRaises(self.conn.execute(ins))
@@ -178,7 +191,10 @@ class TestBoughtProductsOperations(BaseDatabaseHandler):
 
         #Dodaj 10 wykalaczek
 
-        ins = bought_products.insert().values(quantity = 10, user_id = konrad[0], product_id = 1)
+        sel = select([products]).where(products.c.product_name == u"wykalaczka")
+        wykalaczka = self.conn.execute(sel).fetchone()
+
+        ins = bought_products.insert().values(quantity = 10, user_id = konrad[0], product_id = wykalaczka[0])
         self.conn.execute(ins)
 
 
@@ -209,7 +225,9 @@ class TestBoughtProductsOperations(BaseDatabaseHandler):
         add_siekiera = bought_products.insert().values(quantity = 1, user_id = konrad[0], product_id = siekiera[0])
 
         self.conn.execute(add_siekiera)
-        ins = bought_products.insert().values(quantity = 10, user_id = konrad[0], product_id = 1)
+        sel = select([products]).where(products.c.product_name == u"wykalaczka")
+        wykalaczka = self.conn.execute(sel).fetchone()
+        ins = bought_products.insert().values(quantity = 10, user_id = konrad[0], product_id = wykalaczka[0])
         self.conn.execute(ins)
         sel = select([bought_products])
         res = list(self.conn.execute(sel).fetchall())
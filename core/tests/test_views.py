@@ -1,18 +1,32 @@
 from tornado.testing import AsyncHTTPTestCase
 import tornado.testing
 import os, sys
+import tempfile
 import simplejson as json
 
 
 sys.path.append("..")
 
+from config import MAX_CART_ITEMS, PASSWORD_HASH_ITERATIONS, EXPORT_CHUNK_ROWS, PRODUCT_FIELDS
+from helper_functions import generate_password_hash, check_password_hash, password_needs_rehash
+from helper_functions import generate_session_token, decode_session_token, check_session_token
+import helper_functions
+import views
 from views import Application
+from cache import ResponseCache, AuthCache, SharedCounter, SessionRevocations
+from serializers import dumps, load_encoder, response_envelope
+import serializers
+from decimal import Decimal
 
-from models import users, bought_products, products, engine, metadata
+from models import users, bought_products, products, engine, metadata, create_db_engine
 from sqlalchemy import create_engine
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, func
 import uuid
 
+# cost of password hashes made by test applications,
+# production cost is checked in TestAuthentication
+TEST_HASH_ITERATIONS = 1000
+
 
 class TestUserOperations(AsyncHTTPTestCase):
 
@@ -21,7 +35,7 @@ class TestUserOperations(AsyncHTTPTestCase):
         metadata.bind = engine
         self.conn = engine.connect()
         metadata.create_all()
-        return Application(self.conn)
+        return Application(self.conn, hash_iterations = TEST_HASH_ITERATIONS)
 
     def tearDown(self):
         metadata.drop_all()
@@ -144,6 +158,83 @@ class TestUserOperations(AsyncHTTPTestCase):
         self.assertEquals(3, dump["_metadata"]["total"])
         self.assertEquals(3, len(dump["users"]))
 
+    def test_creating_many_users(self):
+
+        data = dict()
+        data["user"] = dict(
+            username = u"konrad",
+            password = "deprofundis",
+            email = "konrad@gmail.com"
+        )
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+
+        data = dict(users = [
+            dict(username = u"malgosia", password = "malgosia", email = "malgosia@gmail.com"),
+            dict(username = u"konrad", password = "konrad", email = "other@gmail.com"),
+            dict(username = u"kuba", password = "kuba")
+        ])
+        resp = self.fetch("/users", method = "POST", body = json.dumps(data))
+        self.assertEquals(201, resp.code)
+        results = json.loads(resp.body)["_meta"]
+        self.assertEquals([201, 409, 400], [r["status"] for r in results])
+
+        resp = self.fetch("/auth?username=malgosia&password=malgosia", method = "GET")
+        self.assertIn("1", resp.body)
+
+        resp = self.fetch("/users", method = "GET")
+        self.assertEquals(2, json.loads(resp.body)["_metadata"]["total"])
+
+        resp = self.fetch("/users", method = "POST", body = json.dumps(data))
+        self.assertEquals(409, resp.code)
+
+        resp = self.fetch("/users", method = "POST", body = json.dumps(dict(users = [])))
+        self.assertEquals(400, resp.code)
+
+    def test_paging_users_with_cursor(self):
+
+        for name in ("konrad", "malgosia", "kuba", "zenek", "janusz"):
+            data = dict()
+            data["user"] = dict(
+                username = name,
+                password = "deprofundis",
+                email = name + "@gmail.com"
+            )
+            self.fetch("/users", method = "POST", body = json.dumps(data))
+
+        seen = list()
+        resp = self.fetch("/users?limit=2&cursor=")
+        self.assertEquals(200, resp.code)
+        dump = json.loads(resp.body)
+        self.assertNotIn("offset", dump["_metadata"])
+        self.assertEquals(5, dump["_metadata"]["total"])
+        pages = 1
+        seen.extend(user["username"] for user in dump["users"].values())
+        while dump["_metadata"]["next_cursor"]:
+            resp = self.fetch("/users?limit=2&cursor=" + dump["_metadata"]["next_cursor"])
+            dump = json.loads(resp.body)
+            seen.extend(user["username"] for user in dump["users"].values())
+            pages += 1
+
+        self.assertEquals(3, pages)
+        self.assertEquals(sorted(["konrad", "malgosia", "kuba", "zenek", "janusz"]), sorted(seen))
+
+        # secure fields are still hidden
+        self.assertNotIn("password", dump["users"].values()[0])
+
+        resp = self.fetch("/users?cursor=invalid")
+        self.assertEquals(400, resp.code)
+        resp = self.fetch("/users?limit=x&cursor=")
+        self.assertEquals(400, resp.code)
+        for limit in ("-1", "0"):
+            resp = self.fetch("/users?cursor=&limit=" + limit)
+            self.assertEquals(400, resp.code)
+
+        # offset paging still works
+        resp = self.fetch("/users?limit=2&offset=4")
+        dump = json.loads(resp.body)
+        self.assertEquals(1, len(dump["users"]))
+        self.assertNotIn("next_cursor", dump["_metadata"])
+
     def test_getting_single_user_info(self):
         data = dict()
         data["user"] = dict(
@@ -317,7 +408,7 @@ class TestProductOperations(AsyncHTTPTestCase):
         metadata.bind = engine
         self.conn = engine.connect()
         metadata.create_all()
-        return Application(self.conn)
+        return Application(self.conn, hash_iterations = TEST_HASH_ITERATIONS)
 
     def tearDown(self):
         metadata.drop_all()
@@ -534,6 +625,12 @@ class TestProductOperations(AsyncHTTPTestCase):
         self.assertEquals(201, resp.code)
         resp = self.fetch("/products")
         q = json.loads(resp.body)
+        self.assertEquals(2, q["_metadata"]["total"])
+
+        resp = self.fetch("/products?category=ksiazki")
+        q = json.loads(resp.body)
+        self.assertEquals(1, q["_metadata"]["total"])
+        self.assertEquals(1, len(q["products"]))
 
         # list_of_products = q["products"]
         # metadata = q["_metadata"]
@@ -935,6 +1032,13 @@ class TestProductOperations(AsyncHTTPTestCase):
 
         # test for invalid data
 
+        for quantity in (0, -1, "15", 1.5):
+            data = dict()
+            data["user"] = dict(username = "malgosia", password = "malgosia")
+            data["product"] = dict(product_name = "wiertarka", quantity = quantity)
+            resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+            self.assertEquals(400, resp.code)
+
         data = dict()
         data["user"] = dict(
             username = "malgosia",
@@ -972,6 +1076,62 @@ class TestProductOperations(AsyncHTTPTestCase):
         resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
         self.assertEquals(404, resp.code)
 
+    def test_buying_many_products(self):
+        data = dict()
+        data["user"] = dict(
+            username = "konrad",
+            password = "deprofundis",
+            email = "exaroth@gmail.com"
+        )
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        for name in ("wiertarka", "suszarka"):
+            product_data = dict()
+            product_data["user"] = dict(username = "konrad", password = "deprofundis")
+            product_data["product"] = dict(
+                product_name = name,
+                product_desc = "wruumm",
+                category = "All",
+                price = "120zl"
+            )
+            resp = self.fetch("/products", method = "POST", body = json.dumps(product_data))
+            self.assertEquals(201, resp.code)
+
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis")
+        data["products"] = [
+            dict(product_name = "wiertarka", quantity = 2),
+            dict(product_name = "suszarka", quantity = 3),
+            dict(product_name = "pralka", quantity = 1),
+            dict(product_name = "wiertarka", quantity = "many")
+        ]
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(201, resp.code)
+        results = json.loads(resp.body)["_meta"]
+        self.assertEquals([201, 201, 404, 400], [r["status"] for r in results])
+
+        sel = select([func.sum(bought_products.c.quantity)]).where(bought_products.c.user_id == 1)
+        self.assertEquals(5, self.conn.execute(sel).scalar())
+
+        # nothing bought
+        data["products"] = [dict(product_name = "pralka", quantity = 1)]
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(404, resp.code)
+
+        data["products"] = []
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(400, resp.code)
+
+        data["products"] = [dict(product_name = "wiertarka", quantity = 1)] * (MAX_CART_ITEMS + 1)
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(400, resp.code)
+
+        data["products"] = [dict(product_name = "wiertarka", quantity = 1)]
+        data["user"]["password"] = "invalid"
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(403, resp.code)
+
+        self.assertEquals(5, self.conn.execute(sel).scalar())
+
     def test_getting_top_products(self):
         data = dict()
         data["user"] = dict(
@@ -1057,13 +1217,246 @@ class TestProductOperations(AsyncHTTPTestCase):
         resp = self.fetch("/user/malgosia/sold")
         self.assertEquals(404, resp.code)
 
+    def test_projecting_fields(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        data["product"] = dict(product_name = "wiertarka", product_desc = "wruumm", category = "All", price = "120zl")
+        self.fetch("/products", method = "POST", body = json.dumps(data))
+
+        resp = self.fetch("/products?fields=product_name,price")
+        self.assertEquals(200, resp.code)
+        self.assertEquals([dict(product_name = "wiertarka", price = "120zl")], json.loads(resp.body)["products"].values())
+        resp = self.fetch("/products?cursor=&fields=seller")
+        self.assertEquals([dict(seller = "konrad")], json.loads(resp.body)["products"].values())
+        resp = self.fetch("/product?id=wiertarka&fields=price")
+        self.assertEquals(dict(price = "120zl"), json.loads(resp.body)["product"])
+        resp = self.fetch("/product?id=wiertarka&fields=product_desc")
+        self.assertEquals(dict(product_desc = "wruumm"), json.loads(resp.body)["product"])
+        resp = self.fetch("/products?fields=product_name,password")
+        self.assertEquals(400, resp.code)
+
+        resp = self.fetch("/users?fields=username,email")
+        self.assertEquals([dict(username = "konrad")], json.loads(resp.body)["users"].values())
+        # private fields only
+        resp = self.fetch("/users?fields=email,password")
+        self.assertEquals(400, resp.code)
+        resp = self.fetch("/user?id=konrad&direct=1&fields=email")
+        self.assertEquals(400, resp.code)
+        resp = self.fetch("/user?id=konrad&direct=1&password=deprofundis&fields=email")
+        self.assertEquals(dict(email = "konrad@gmail.com"), json.loads(resp.body)["user"])
+        resp = self.fetch("/users/export?fields=joined")
+        self.assertEquals(["joined"], json.loads(resp.body.splitlines()[0]).keys())
+
+    def test_columnar_format(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        for name, quantity in (("wiertarka", 2), ("suszarka", 5)):
+            data["product"] = dict(product_name = name, product_desc = "wruumm", category = "All", price = "120zl")
+            self.fetch("/products", method = "POST", body = json.dumps(data))
+            data["product"] = dict(product_name = name, quantity = quantity)
+            self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+
+        resp = self.fetch("/products?format=columnar&fields=product_name,price")
+        self.assertEquals(200, resp.code)
+        page = json.loads(resp.body)["products"]
+        self.assertEquals(["product_name", "price", "uuid"], page["columns"])
+        self.assertEquals([["wiertarka", "120zl"], ["suszarka", "120zl"]], [row[:2] for row in page["rows"]])
+        resp = self.fetch("/products?format=columnar&cursor=&limit=1")
+        body = json.loads(resp.body)
+        self.assertEquals(list(PRODUCT_FIELDS), body["products"]["columns"])
+        self.assertEquals(1, len(body["products"]["rows"]))
+        self.assertTrue(body["_metadata"]["next_cursor"])
+
+        resp = self.fetch("/users?format=columnar")
+        self.assertEquals(dict(columns = ["username", "joined", "uuid"], rows = []),
+                          dict(json.loads(resp.body)["users"], rows = []))
+
+        # order by quantity is kept
+        resp = self.fetch("/products/top?format=columnar")
+        self.assertEquals([["suszarka", 5], ["wiertarka", 2]],
+                          [[row[0], row[2]] for row in json.loads(resp.body)["rows"]])
+        resp = self.fetch("/user/konrad/bought?format=columnar")
+        self.assertEquals(list(PRODUCT_FIELDS), json.loads(resp.body)["columns"])
+        self.assertEquals(2, len(json.loads(resp.body)["rows"]))
+        resp = self.fetch("/user/konrad/sold?format=columnar")
+        self.assertEquals(2, len(json.loads(resp.body)["rows"]))
+        resp = self.fetch("/user/malgosia/sold?format=columnar")
+        self.assertEquals(404, resp.code)
+        resp = self.fetch("/products?format=xml")
+        self.assertEquals(400, resp.code)
+
+    def test_searching_products(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        for name, desc in (("wiertarka", u"wiertarka udarowa bosch"), ("pralka", u"pralka bosch"),
+                           ("szlifierka", u"szlifierka katowa, bosch bosch bosch")):
+            data["product"] = dict(product_name = name, product_desc = desc, category = "All", price = "120zl")
+            self.fetch("/products", method = "POST", body = json.dumps(data))
+
+        resp = self.fetch("/products/search?q=bosch")
+        self.assertEquals(200, resp.code)
+        body = json.loads(resp.body)
+        # most relevant first
+        self.assertEquals("szlifierka", body["products"][0]["product_name"])
+        self.assertEquals(3, len(body["products"]))
+        self.assertIsNone(body["_metadata"]["next_offset"])
+        self.assertIn("uuid", body["products"][0])
+
+        resp = self.fetch("/products/search?q=BOSCH+udarowa&fields=product_name")
+        self.assertEquals([dict(product_name = "wiertarka", uuid = body["products"][2]["uuid"])],
+                          json.loads(resp.body)["products"])
+        resp = self.fetch("/products/search?q=bosch&limit=2")
+        self.assertEquals(2, json.loads(resp.body)["_metadata"]["next_offset"])
+        resp = self.fetch("/products/search?q=bosch&limit=2&offset=2&format=columnar")
+        self.assertEquals([["wiertarka"]], [row[1:2] for row in json.loads(resp.body)["products"]["rows"]])
+        # query syntax is not interpreted
+        resp = self.fetch("/products/search?q=%22bosch+OR+NOT")
+        self.assertEquals([], json.loads(resp.body)["products"])
+        resp = self.fetch("/products/search?q=bosch&category=Other")
+        self.assertEquals([], json.loads(resp.body)["products"])
+
+        # new products are found right away
+        data["product"] = dict(product_name = "lodowka", product_desc = u"lodowka bosch", category = "All", price = "1zl")
+        self.fetch("/products", method = "POST", body = json.dumps(data))
+        resp = self.fetch("/products/search?q=bosch")
+        self.assertEquals(4, len(json.loads(resp.body)["products"]))
+
+        for query in ("q=+", "q=bosch&limit=x", "q=bosch&offset=-1", "q=bosch&fields=password"):
+            resp = self.fetch("/products/search?" + query)
+            self.assertEquals(400, resp.code)
+
+    def test_counting_categories(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        for name, category in (("wiertarka", "narzedzia"), ("szlifierka", "narzedzia"), ("pralka", "agd")):
+            data["product"] = dict(product_name = name, product_desc = "wruumm", category = category, price = "120zl")
+            self.fetch("/products", method = "POST", body = json.dumps(data))
+
+        resp = self.fetch("/products/categories")
+        self.assertEquals(200, resp.code)
+        body = json.loads(resp.body)
+        self.assertEquals(dict(narzedzia = 2, agd = 1), body["categories"])
+        self.assertEquals(3, body["_metadata"]["total"])
+        etag = resp.headers["Etag"]
+        resp = self.fetch("/products/categories", headers = {"If-None-Match": etag})
+        self.assertEquals(304, resp.code)
+
+        data["update"] = dict(product_name = "szlifierka", category = "agd")
+        self.fetch("/product", method = "PUT", body = json.dumps(data))
+        resp = self.fetch("/products/categories", headers = {"If-None-Match": etag})
+        self.assertEquals(200, resp.code)
+        self.assertEquals(dict(narzedzia = 1, agd = 2), json.loads(resp.body)["categories"])
+
+        self.fetch("/product?id=wiertarka&name=konrad&password=deprofundis", method = "DELETE")
+        resp = self.fetch("/products/categories")
+        # empty categories are left out
+        self.assertEquals(dict(agd = 2), json.loads(resp.body)["categories"])
+        self.assertEquals(2, json.loads(resp.body)["_metadata"]["total"])
+
+    def test_filtering_by_price(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        for name, price, category in (("wiertarka", "120zl", "narzedzia"), ("mlotek", "19,99 zl", "narzedzia"),
+                                      ("pralka", "1200zl", "agd"), ("grabie", "za darmo", "ogrod")):
+            data["product"] = dict(product_name = name, product_desc = "wruumm", category = category, price = price)
+            self.fetch("/products", method = "POST", body = json.dumps(data))
+
+        resp = self.fetch("/products?min_price=19.99&max_price=120")
+        body = json.loads(resp.body)
+        self.assertEquals(set(["wiertarka", "mlotek"]), set(p["product_name"] for p in body["products"].values()))
+        self.assertEquals(2, body["_metadata"]["total"])
+        resp = self.fetch("/products?min_price=100&category=narzedzia&cursor=")
+        body = json.loads(resp.body)
+        self.assertEquals(["wiertarka"], [p["product_name"] for p in body["products"].values()])
+        self.assertEquals(1, body["_metadata"]["total"])
+
+        resp = self.fetch("/products?sort=-price&min_price=0&format=columnar&fields=product_name")
+        self.assertEquals([["pralka"], ["wiertarka"], ["mlotek"]],
+                          [row[:1] for row in json.loads(resp.body)["products"]["rows"]])
+        resp = self.fetch("/products?sort=price&limit=2&offset=1")
+        page = json.loads(resp.body)["products"]
+        self.assertEquals(["mlotek", "wiertarka"], [p["product_name"] for p in page])
+        self.assertTrue(all(p["uuid"] for p in page))
+
+        # price changes move product between ranges
+        data["update"] = dict(product_name = "pralka", price = "99.50")
+        self.fetch("/product", method = "PUT", body = json.dumps(data))
+        resp = self.fetch("/products?max_price=100&sort=price&format=columnar&fields=product_name")
+        self.assertEquals([["mlotek"], ["pralka"]], [row[:1] for row in json.loads(resp.body)["products"]["rows"]])
+
+        resp = self.fetch("/products?min_price=100&max_price=1,000")
+        self.assertEquals(["wiertarka"], [p["product_name"] for p in json.loads(resp.body)["products"].values()])
+
+        for query in ("min_price=abc", "max_price=10zl", "sort=name", "sort=price&cursor=",
+                      "cursor=&limit=-1", "min_price=1,0000"):
+            resp = self.fetch("/products?" + query)
+            self.assertEquals(400, resp.code)
+
+    def test_exporting_tables(self):
+        self.conn.execute(users.insert(), [
+            dict(user_uuid = str(uuid.uuid4()), username = u"user{0}".format(i), password = "x",
+                 email = u"user{0}@gmail.com".format(i), joined = "2014-03-02")
+            for i in range(7)])
+        self.conn.execute(products.insert(), [
+            dict(product_uuid = str(uuid.uuid4()), product_name = u"product{0}".format(i), product_desc = u"desc",
+                 category = u"rtv" if i % 2 else u"agd", price = u"10zl", seller = u"user0")
+            for i in range(5)])
+        views.ExportHandler.chunk_size = 3
+        try:
+            resp = self.fetch("/users/export")
+            self.assertEquals(200, resp.code)
+            self.assertEquals("application/x-ndjson", resp.headers["Content-Type"])
+            lines = [json.loads(line) for line in resp.body.splitlines()]
+            self.assertEquals(["user{0}".format(i) for i in range(7)], [line["username"] for line in lines[:-1]])
+            # private fields are filtered like in /users
+            self.assertEquals({"username", "joined"}, set(lines[0].keys()))
+            metadata_line = lines[-1]["_metadata"]
+            self.assertEquals(7, metadata_line["count"])
+
+            self.conn.execute(users.insert().values(user_uuid = str(uuid.uuid4()), username = u"newcomer",
+                                                    password = "x", email = u"newcomer@gmail.com"))
+            resp = self.fetch("/users/export?since=" + metadata_line["next_since"])
+            lines = [json.loads(line) for line in resp.body.splitlines()]
+            self.assertEquals(["newcomer"], [line["username"] for line in lines[:-1]])
+            resp = self.fetch("/users/export?since=" + lines[-1]["_metadata"]["next_since"])
+            self.assertEquals([dict(_metadata = dict(count = 0, next_since = lines[-1]["_metadata"]["next_since"]))],
+                              [json.loads(line) for line in resp.body.splitlines()])
+
+            resp = self.fetch("/products/export?category=rtv")
+            lines = [json.loads(line) for line in resp.body.splitlines()]
+            self.assertEquals(["product1", "product3"], [line["product_name"] for line in lines[:-1]])
+            self.assertIn("uuid", lines[0])
+
+            resp = self.fetch("/products/export?since=xyz")
+            self.assertEquals(400, resp.code)
+        finally:
+            views.ExportHandler.chunk_size = EXPORT_CHUNK_ROWS
+
+    def test_export_failing_first_chunk(self):
+        def export_chunk(handler, after, fields):
+            raise ValueError("database is gone")
+        original = views.UsersExportHandler.__dict__["export_chunk"]
+        views.UsersExportHandler.export_chunk = export_chunk
+        try:
+            resp = self.fetch("/users/export")
+        finally:
+            views.UsersExportHandler.export_chunk = original
+        self.assertEquals(500, resp.code)
+        self.assertNotEquals("application/x-ndjson", resp.headers["Content-Type"])
+        self.assertEquals(500, json.loads(resp.body)["status"])
+
 class TestAuthentication(AsyncHTTPTestCase):
     def get_app(self):
         engine = create_engine("sqlite:///:memory:")
         metadata.bind = engine
         self.conn = engine.connect()
         metadata.create_all()
-        return Application(self.conn)
+        return Application(self.conn, hash_iterations = TEST_HASH_ITERATIONS)
 
     def tearDown(self):
         metadata.drop_all()
@@ -1107,6 +1500,558 @@ class TestAuthentication(AsyncHTTPTestCase):
 
         res = self.fetch("/auth?username=konrad&password=deprofundis&persist=1", method = "GET" )
 
+    def test_password_hashers(self):
+        signature = generate_password_hash(u"deprofundis")
+        algorithm, iterations, salt, digest = signature.split("$")
+        self.assertEquals(("pbkdf2_sha256", PASSWORD_HASH_ITERATIONS), (algorithm, int(iterations)))
+        self.assertNotEquals(signature, generate_password_hash(u"deprofundis"))
+        self.assertTrue(check_password_hash(u"deprofundis", signature))
+        self.assertFalse(check_password_hash(u"deprofundi", signature))
+        self.assertFalse(password_needs_rehash(signature))
+        # cost is read from the hash
+        cheap = "$".join((algorithm, "1000", salt, digest))
+        self.assertFalse(check_password_hash(u"deprofundis", cheap))
+        self.assertTrue(password_needs_rehash(cheap))
+        self.assertFalse(check_password_hash(u"deprofundis", "unknown$1$salt$hash"))
+
+    def test_production_hash_cost(self):
+        app = Application(self.conn)
+        self.assertEquals(PASSWORD_HASH_ITERATIONS, app.hash_iterations)
+        signature = app.hash_executor.submit(generate_password_hash, u"deprofundis",
+                                             iterations = app.hash_iterations).result()
+        self.assertTrue(signature.startswith("pbkdf2_sha256${0}$".format(PASSWORD_HASH_ITERATIONS)))
+        # hashes made by test applications are upgraded on login in production
+        self.assertTrue(password_needs_rehash(generate_password_hash(u"deprofundis",
+                                                                     iterations = TEST_HASH_ITERATIONS)))
+
+    def test_rehashing_legacy_password(self):
+        legacy_hash = generate_password_hash("deprofundis", "sha1")
+        ins = users.insert().values(user_uuid = str(uuid.uuid4()), username = u"konrad",
+                                    password = legacy_hash, email = "konrad@gmail.com")
+        self.conn.execute(ins)
+        sel = select([users.c.password]).where(users.c.username == u"konrad")
+
+        res = self.fetch("/auth?username=konrad&password=wrong")
+        self.assertEquals(0, int(res.body))
+        self.assertEquals(legacy_hash, self.conn.execute(sel).scalar())
+
+        res = self.fetch("/auth?username=konrad&password=deprofundis")
+        self.assertEquals(1, int(res.body))
+        new_hash = self.conn.execute(sel).scalar()
+        self.assertTrue(new_hash.startswith("pbkdf2_sha256${0}$".format(TEST_HASH_ITERATIONS)))
+
+        res = self.fetch("/auth?username=konrad&password=deprofundis")
+        self.assertEquals(1, int(res.body))
+        self.assertEquals(new_hash, self.conn.execute(sel).scalar())
+
+    def test_session_tokens(self):
+        for name in ("konrad", "malgosia"):
+            user = dict(username = name, password = "deprofundis", email = name + "@gmail.com")
+            self.fetch("/users", method = "POST", body = json.dumps(dict(user = user)))
+
+        res = self.fetch("/auth?username=konrad&password=deprofundis&persist=1")
+        self.assertEquals(201, res.code)
+        token = res.body
+        self.assertEquals(u"konrad", decode_session_token(token)[0])
+        res = self.fetch("/auth?username=konrad&password=wrong&persist=1")
+        self.assertEquals(0, int(res.body))
+
+        # token replaces password
+        product = dict(product_name = "wiertarka", product_desc = "wiertarka", price = "120")
+        body = json.dumps(dict(user = dict(username = "konrad", token = token), product = product))
+        res = self.fetch("/products", method = "POST", body = body)
+        self.assertEquals(201, res.code)
+        body = json.dumps(dict(user = dict(username = "konrad"), product = dict(product_name = "wiertarka", quantity = 2)))
+        res = self.fetch("/products/buy", method = "POST", body = body,
+                         headers = {"Authorization": "Bearer " + token})
+        self.assertEquals(201, res.code)
+        res = self.fetch("/user?username=konrad&token=" + token, method = "PUT",
+                         body = json.dumps(dict(update = dict(email = "konrad@o2.pl"))))
+        self.assertEquals(201, res.code)
+
+        # token is valid only for user it was issued for
+        res = self.fetch("/user?username=malgosia&token=" + token, method = "PUT",
+                         body = json.dumps(dict(update = dict(email = "konrad@o2.pl"))))
+        self.assertEquals(403, res.code)
+        body = json.dumps(dict(user = dict(username = "malgosia", token = token),
+                               product = dict(product_name = "wiertarka", quantity = 2)))
+        res = self.fetch("/products/buy", method = "POST", body = body)
+        self.assertEquals(403, res.code)
+
+        # tampered, expired and unknown tokens
+        key_id, expires, issued, username, user_uuid, fingerprint, signature = token.split(".")
+        forged = ".".join((key_id, expires, issued, generate_session_token("malgosia", user_uuid, "x").split(".")[3],
+                           user_uuid, fingerprint, signature))
+        self.assertEquals(None, decode_session_token(forged))
+        self.assertEquals(None, decode_session_token(generate_session_token("konrad", user_uuid, "x", max_age = -1)))
+        self.assertEquals(None, decode_session_token("garbage"))
+        res = self.fetch("/user?id=konrad&token=" + forged, method = "DELETE")
+        self.assertEquals(403, res.code)
+
+    def test_revoking_session_tokens(self):
+        def create_user(password):
+            user = dict(username = "konrad", password = password, email = "konrad@gmail.com")
+            resp = self.fetch("/users", method = "POST", body = json.dumps(dict(user = user)))
+            self.assertEquals(201, resp.code)
+
+        def login(password):
+            resp = self.fetch("/auth?username=konrad&password={0}&persist=1".format(password))
+            self.assertEquals(201, resp.code)
+            return resp.body
+
+        def update_email(token):
+            return self.fetch("/user?username=konrad&token=" + token, method = "PUT",
+                              body = json.dumps(dict(update = dict(email = "konrad@o2.pl")))).code
+
+        create_user("deprofundis")
+        token = login("deprofundis")
+        self.assertEquals(201, update_email(token))
+        # changing other fields keeps the token
+        self.assertEquals(201, update_email(token))
+
+        # password change revokes tokens issued before
+        resp = self.fetch("/user?username=konrad&token=" + token, method = "PUT",
+                          body = json.dumps(dict(update = dict(password = "zmienione"))))
+        self.assertEquals(201, resp.code)
+        self.assertEquals(403, update_email(token))
+        token = login("zmienione")
+        self.assertEquals(201, update_email(token))
+
+        # deleted and registered again under the same name
+        user_uuid = decode_session_token(token)[1]
+        resp = self.fetch("/user?id=konrad&token=" + token, method = "DELETE")
+        self.assertEquals(200, resp.code)
+        create_user("deprofundis")
+        self.assertEquals(403, update_email(token))
+        product = dict(product_name = "wiertarka", product_desc = "wiertarka", price = "120")
+        body = json.dumps(dict(user = dict(username = "konrad", token = token), product = product))
+        self.assertEquals(403, self.fetch("/products", method = "POST", body = body).code)
+        token = login("deprofundis")
+        self.assertNotEquals(user_uuid, decode_session_token(token)[1])
+        self.assertEquals(201, update_email(token))
+
+        # revoked by uuid only
+        credentials = self.conn.execute(select([users.c.username, users.c.password, users.c.user_uuid])).fetchone()
+        revocations = SessionRevocations()
+        self.assertTrue(check_session_token(token, credentials, revocations))
+        revocations.revoke(credentials[2])
+        self.assertFalse(check_session_token(token, credentials, revocations))
+        self.assertTrue(check_session_token(generate_session_token(credentials[0], credentials[2], credentials[1]),
+                                            credentials, revocations))
+        # token of other account or for other password
+        self.assertFalse(check_session_token(generate_session_token(u"konrad", "uuid-1", credentials[1]),
+                                             credentials))
+        self.assertFalse(check_session_token(generate_session_token(u"konrad", credentials[2], "other-hash"),
+                                             credentials))
+
+    def test_session_tokens_without_revocations(self):
+        """
+        Tokens are checked against current credentials,
+        revocations lost with restart dont bring old tokens back
+        """
+        def create_user(password):
+            user = dict(username = "konrad", password = password, email = "konrad@gmail.com")
+            resp = self.fetch("/users", method = "POST", body = json.dumps(dict(user = user)))
+            self.assertEquals(201, resp.code)
+
+        def login(password):
+            resp = self.fetch("/auth?username=konrad&password={0}&persist=1".format(password))
+            self.assertEquals(201, resp.code)
+            return resp.body
+
+        def update_email(token):
+            return self.fetch("/user?username=konrad&token=" + token, method = "PUT",
+                              body = json.dumps(dict(update = dict(email = "konrad@o2.pl")))).code
+
+        def restart():
+            self._app.revocations = SessionRevocations()
+            self._app.auth_cache.clear()
+
+        create_user("deprofundis")
+        token = login("deprofundis")
+        resp = self.fetch("/user?username=konrad&token=" + token, method = "PUT",
+                          body = json.dumps(dict(update = dict(password = "zmienione"))))
+        self.assertEquals(201, resp.code)
+        restart()
+        self.assertEquals(403, update_email(token))
+
+        token = login("zmienione")
+        resp = self.fetch("/user?id=konrad&token=" + token, method = "DELETE")
+        self.assertEquals(200, resp.code)
+        restart()
+        # registered again with the same name and password
+        create_user("zmienione")
+        self.assertEquals(403, update_email(token))
+        product = dict(product_name = "wiertarka", product_desc = "wiertarka", price = "120")
+        body = json.dumps(dict(user = dict(username = "konrad"), product = product))
+        resp = self.fetch("/products", method = "POST", body = body,
+                          headers = {"Authorization": "Bearer " + token})
+        self.assertEquals(403, resp.code)
+        self.assertEquals(201, update_email(login("zmienione")))
+
+    def test_session_key_rotation(self):
+        keys = dict(helper_functions.SESSION_KEYS)
+        try:
+            old_token = generate_session_token("konrad", "uuid-1", "hash")
+            helper_functions.SESSION_KEYS["2"] = "rotated-session-key"
+            new_token = generate_session_token("konrad", "uuid-1", "hash", key_id = "2")
+            self.assertTrue(new_token.startswith("2."))
+            self.assertEquals((u"konrad", "uuid-1"), decode_session_token(old_token)[:2])
+            self.assertEquals((u"konrad", "uuid-1"), decode_session_token(new_token)[:2])
+            del helper_functions.SESSION_KEYS["1"]
+            self.assertEquals(None, decode_session_token(old_token))
+            self.assertEquals((u"konrad", "uuid-1"), decode_session_token(new_token)[:2])
+        finally:
+            helper_functions.SESSION_KEYS.clear()
+            helper_functions.SESSION_KEYS.update(keys)
+
+class TestConnectionPool(AsyncHTTPTestCase):
+
+    def get_app(self):
+        fd, self.path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        self.engine = create_db_engine("sqlite:///" + self.path)
+        metadata.bind = self.engine
+        metadata.create_all()
+        return Application(self.engine, hash_iterations = TEST_HASH_ITERATIONS)
+
+    def tearDown(self):
+        super(TestConnectionPool, self).tearDown()
+        self._app.db_executor.shutdown()
+        self._app.hash_executor.shutdown()
+        metadata.drop_all()
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_connection_per_request(self):
+        for name in ("konrad", "malgosia"):
+            data = dict()
+            data["user"] = dict(
+                username = name,
+                password = "deprofundis",
+                email = name + "@gmail.com"
+            )
+            resp = self.fetch("/users", method = "POST", body = json.dumps(data))
+            self.assertEquals(201, resp.code)
+
+        resp = self.fetch("/auth?username=konrad&password=deprofundis")
+        self.assertEquals(1, int(resp.body))
+
+        resp = self.fetch("/users")
+        self.assertEquals(2, json.loads(resp.body)["_metadata"]["total"])
+
+        resp = self.fetch("/stats")
+        self.assertEquals(200, resp.code)
+        stats = json.loads(resp.body)["pool"]
+        self.assertEquals("QueuePool", stats["pool"])
+        # db threads check out their connections through pool stats
+        self.assertTrue(stats["checkouts"] >= 1)
+        self.assertTrue(stats["wait_total_ms"] > 0)
+        self.assertTrue(stats["wait_max_ms"] > 0)
+        # only db threads keep their connections
+        self.assertTrue(stats["checked_out"] <= 4)
+        self.assertIn("overflow", stats)
+        self.assertIn("wait_max_ms", stats)
+
+    def test_pool_stats_attached_once(self):
+        app = Application(self.engine, hash_iterations = TEST_HASH_ITERATIONS)
+        try:
+            self.assertIs(self._app.pool_stats, app.pool_stats)
+            self.assertEquals(1, len(self.engine.pool.dispatch.checkout))
+            conn = app.pool_stats.connect()
+            self.assertEquals(1, app.pool_stats.as_dict()["checkouts"])
+            self.assertEquals(1, app.pool_stats.as_dict()["checked_out"])
+            conn.close()
+            self.assertEquals(0, app.pool_stats.as_dict()["checked_out"])
+        finally:
+            app.db_executor.shutdown()
+            app.hash_executor.shutdown()
+
+class TestResponseCache(AsyncHTTPTestCase):
+
+    def get_app(self):
+        engine = create_engine("sqlite:///:memory:")
+        metadata.bind = engine
+        self.conn = engine.connect()
+        metadata.create_all()
+        return Application(self.conn, hash_iterations = TEST_HASH_ITERATIONS)
+
+    def tearDown(self):
+        metadata.drop_all()
+
+    def create_product(self, name):
+        product_data = dict()
+        product_data["user"] = dict(username = "konrad", password = "deprofundis")
+        product_data["product"] = dict(
+            product_name = name,
+            product_desc = "wruumm",
+            category = "All",
+            price = "120zl"
+        )
+        resp = self.fetch("/products", method = "POST", body = json.dumps(product_data))
+        self.assertEquals(201, resp.code)
+
+    def test_caching_responses(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        self.create_product("wiertarka")
+        cache = self._app.cache
+
+        resp = self.fetch("/products?limit=5&offset=0")
+        etag = resp.headers["Etag"]
+        self.assertEquals(1, cache.misses)
+        # argument order doesnt matter
+        resp = self.fetch("/products?offset=0&limit=5")
+        self.assertEquals(200, resp.code)
+        self.assertEquals(etag, resp.headers["Etag"])
+        self.assertIn("wiertarka", resp.body)
+        self.assertEquals(1, cache.hits)
+
+        resp = self.fetch("/products?limit=5&offset=0", headers = {"If-None-Match": etag})
+        self.assertEquals(304, resp.code)
+        self.assertEquals(2, cache.hits)
+
+        resp = self.fetch("/product?id=wiertarka")
+        product_etag = resp.headers["Etag"]
+        self.fetch("/products/top")
+
+        # buying changes only top products
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis")
+        data["product"] = dict(product_name = "wiertarka", quantity = 3)
+        resp = self.fetch("/products/buy", method = "POST", body = json.dumps(data))
+        self.assertEquals(201, resp.code)
+        resp = self.fetch("/products/top")
+        self.assertEquals(3, json.loads(resp.body)["wiertarka"]["quantity"])
+        resp = self.fetch("/product?id=wiertarka", headers = {"If-None-Match": product_etag})
+        self.assertEquals(304, resp.code)
+
+        # new product changes list of products
+        self.create_product("suszarka")
+        resp = self.fetch("/products?limit=5&offset=0", headers = {"If-None-Match": etag})
+        self.assertEquals(200, resp.code)
+        self.assertIn("suszarka", resp.body)
+
+        # update changes single product
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis")
+        data["update"] = dict(product_name = "wiertarka", product_desc = "zmieniona")
+        resp = self.fetch("/product", method = "PUT", body = json.dumps(data))
+        self.assertEquals(201, resp.code)
+        resp = self.fetch("/product?id=wiertarka", headers = {"If-None-Match": product_etag})
+        self.assertEquals(200, resp.code)
+        self.assertIn("zmieniona", resp.body)
+
+        # errors are not cached
+        self.fetch("/product?id=pralka")
+        self.assertFalse([key for key in cache.entries if "pralka" in key])
+
+        resp = self.fetch("/stats")
+        self.assertTrue(json.loads(resp.body)["cache"]["hits"] >= 3)
+
+    def test_evicting_least_recently_used(self):
+        cache = ResponseCache(max_bytes = 100)
+        cache.put("a", "x" * 40, ("products",), cache.generation)
+        cache.put("b", "x" * 40, ("users",), cache.generation)
+        cache.get("a")
+        cache.put("c", "x" * 40, ("users",), cache.generation)
+        self.assertEquals(["a", "c"], list(cache.entries))
+        self.assertEquals(1, cache.evictions)
+
+        # invalidated while response was computed
+        generation = cache.generation
+        cache.invalidate("users")
+        self.assertEquals(["a"], list(cache.entries))
+        cache.put("b", "x" * 40, ("users",), generation)
+        self.assertIsNone(cache.get("b"))
+
+    def test_invalidating_other_workers(self):
+        # caches of two worker processes sharing counter
+        counter = SharedCounter()
+        first, second = ResponseCache(shared = counter), ResponseCache(shared = counter)
+        first.put("a", "x", ("products",), first.generation)
+        second.put("a", "x", ("products",), second.generation)
+        generation = second.generation
+        first.invalidate("products")
+        self.assertIsNone(first.get("a"))
+        # second doesnt know the tag, drops everything
+        self.assertIsNone(second.get("a"))
+        second.put("a", "x", ("products",), generation)
+        self.assertEquals({}, dict(second.entries))
+        second.put("a", "x", ("products",), second.generation)
+        self.assertIsNotNone(second.get("a"))
+
+        counter = SharedCounter()
+        first_auth, second_auth = AuthCache(shared = counter), AuthCache(shared = counter)
+        second_auth.put("konrad", "a", "konrad", "uuid-1", second_auth.generation)
+        first_auth.invalidate("konrad")
+        self.assertIsNone(second_auth.get("konrad", "a"))
+
+    def test_caching_credentials(self):
+        data = dict()
+        data["user"] = dict(username = "konrad", password = "deprofundis", email = "konrad@gmail.com")
+        self.fetch("/users", method = "POST", body = json.dumps(data))
+        auth_cache = self._app.auth_cache
+
+        self.assertEquals(1, int(self.fetch("/auth?username=konrad&password=deprofundis").body))
+        self.assertEquals((0, 1), (auth_cache.hits, len(auth_cache.entries)))
+        self.assertEquals(1, int(self.fetch("/auth?username=konrad&password=deprofundis").body))
+        self.assertEquals(0, int(self.fetch("/auth?username=konrad&password=wrong").body))
+        self.assertEquals(1, auth_cache.hits)
+        self.assertNotIn("deprofundis", repr(auth_cache.entries))
+        self.create_product("wiertarka")
+        self.assertEquals(2, auth_cache.hits)
+
+        # password change forgets old password immediately
+        resp = self.fetch("/user?username=konrad&password=deprofundis", method = "PUT",
+                          body = json.dumps(dict(update = dict(password = "zmienione"))))
+        self.assertEquals(201, resp.code)
+        self.assertEquals(0, int(self.fetch("/auth?username=konrad&password=deprofundis").body))
+        self.assertEquals(1, int(self.fetch("/auth?username=konrad&password=zmienione").body))
+
+        resp = self.fetch("/user?id=konrad&password=zmienione", method = "DELETE")
+        self.assertEquals(200, resp.code)
+        self.assertEquals(0, int(self.fetch("/auth?username=konrad&password=zmienione").body))
+
+        stats = json.loads(self.fetch("/stats").body)["auth_cache"]
+        self.assertTrue(0 < stats["hit_rate"] < 1)
+        self.assertEquals(0, stats["entries"])
+
+    def test_expiring_credentials(self):
+        auth_cache = AuthCache(max_entries = 2, ttl = 60)
+        auth_cache.put("konrad", "a", "konrad", "uuid-1", auth_cache.generation)
+        auth_cache.put("uuid-1", "a", "konrad", "uuid-1", auth_cache.generation)
+        auth_cache.get("konrad", "a")
+        auth_cache.put("malgosia", "b", "malgosia", "uuid-2", auth_cache.generation)
+        self.assertEquals(1, auth_cache.evictions)
+        self.assertIsNone(auth_cache.get("uuid-1", "a"))
+        self.assertEquals(("konrad", "uuid-1"), auth_cache.get("konrad", "a"))
+        self.assertIsNone(auth_cache.get("konrad", "b"))
+
+        # invalidating by uuid drops entries keyed by username
+        auth_cache.invalidate("uuid-1")
+        self.assertIsNone(auth_cache.get("konrad", "a"))
+
+        auth_cache.ttl = -1
+        auth_cache.put("malgosia", "b", "malgosia", "uuid-2", auth_cache.generation)
+        self.assertIsNone(auth_cache.get("malgosia", "b"))
+        self.assertEquals(1, auth_cache.expirations)
+        self.assertEquals({}, auth_cache.users)
+
+    def test_response_envelopes(self):
+        envelope = response_envelope(404, "Not_Found")
+        self.assertEquals(dict(status = 404, message = "Not_Found", _meta = None), json.loads(envelope))
+        self.assertEquals(envelope[:-5] + "[1]}", response_envelope(404, "Not_Found", [1]))
+        self.assertEquals([u"\u0142", 1], json.loads(response_envelope(201, "Created", [u"\u0142", 1]))["_meta"])
+
+        resp = self.fetch("/product?id=pralka")
+        self.assertEquals(dict(status = 404, message = "Not_Found", _meta = None), json.loads(resp.body))
+        resp = self.fetch("/users?cursor=x")
+        self.assertEquals("Bad_Request", json.loads(resp.body)["message"])
+
+        self.assertEquals("simplejson", load_encoder(("missing", "simplejson"))[0])
+        self.assertEquals("simplejson", load_encoder(())[0])
+        # encoder is probed once when loaded, failing one is skipped
+        def unsupported_argument(obj):
+            raise TypeError("'escape_forward_slashes' is an invalid keyword argument")
+        serializers.ENCODERS["stub"] = lambda: unsupported_argument
+        try:
+            self.assertEquals("simplejson", load_encoder(("stub", "simplejson"))[0])
+            serializers.ENCODERS["stub"] = lambda: json.dumps
+            self.assertEquals("stub", load_encoder(("stub", "simplejson"))[0])
+        finally:
+            del serializers.ENCODERS["stub"]
+        # types fast encoders dont support fall back to simplejson
+        self.assertEquals([1.5], json.loads(dumps([Decimal("1.5")])))
+
+
+class TestQueryBudgets(AsyncHTTPTestCase):
+
+    """
+    Maximum number of statements endpoints may execute,
+    lists and lookups must not grow with number of returned rows
+    """
+
+    def get_app(self):
+        engine = create_engine("sqlite:///:memory:")
+        metadata.bind = engine
+        self.conn = engine.connect()
+        metadata.create_all()
+        app = Application(self.conn, hash_iterations = TEST_HASH_ITERATIONS)
+        app.settings["query_stats_headers"] = True
+        return app
+
+    def tearDown(self):
+        metadata.drop_all()
+
+    def assertQueryBudget(self, budget, path, **kwargs):
+        """
+        Fetches path and fails if it executed more than budget statements
+        """
+        resp = self.fetch(path, **kwargs)
+        count = int(resp.headers["X-Query-Count"])
+        self.assertLessEqual(count, budget, "%s %s executed %d statements, budget is %d" % (
+            kwargs.get("method", "GET"), path, count, budget))
+        return resp
+
+    def test_query_budgets(self):
+        for username in ("konrad", "malgosia"):
+            data = dict()
+            data["user"] = dict(username = username, password = "deprofundis", email = username + "@gmail.com")
+            resp = self.assertQueryBudget(5, "/users", method = "POST", body = json.dumps(data))
+            self.assertEquals(201, resp.code)
+        for name in ("wiertarka", "pralka", "lodowka", "odkurzacz"):
+            data = dict()
+            data["user"] = dict(username = "konrad", password = "deprofundis")
+            data["product"] = dict(product_name = name, product_desc = "wruumm", category = "All", price = "120zl")
+            resp = self.assertQueryBudget(9, "/products", method = "POST", body = json.dumps(data))
+            self.assertEquals(201, resp.code)
+            data = dict()
+            data["user"] = dict(username = "malgosia", password = "deprofundis")
+            data["product"] = dict(product_name = name, quantity = 2)
+            resp = self.assertQueryBudget(4, "/products/buy", method = "POST", body = json.dumps(data))
+            self.assertEquals(201, resp.code)
+
+        budgets = [
+            (2, "/users"),
+            (2, "/users?format=columnar&fields=username"),
+            (1, "/user?id=konrad&direct=1"),
+            (2, "/products"),
+            (2, "/products?category=All"),
+            (1, "/product?id=pralka"),
+            (1, "/products/top"),
+            (1, "/products/search?q=wruumm"),
+            (1, "/products/categories"),
+            (2, "/products?min_price=10&max_price=200&sort=-price"),
+            (1, "/user/malgosia/bought"),
+            (1, "/user/konrad/sold"),
+            (1, "/users/export"),
+            (1, "/products/export"),
+            (0, "/stats"),
+        ]
+        for budget, path in budgets:
+            resp = self.assertQueryBudget(budget, path)
+            self.assertEquals(200, resp.code)
+        self._app.auth_cache.clear()
+        resp = self.assertQueryBudget(1, "/auth?username=konrad&password=deprofundis")
+        self.assertEquals(200, resp.code)
+        # cached responses dont touch the database
+        resp = self.assertQueryBudget(0, "/products")
+        self.assertEquals("0.00ms", resp.headers["X-DB-Time"])
+
+    def test_log_function_setting(self):
+        logged = []
+        self._app.settings["log_function"] = logged.append
+        try:
+            resp = self.fetch("/users")
+            self.assertEquals(200, resp.code)
+        finally:
+            del self._app.settings["log_function"]
+        self.assertEquals(1, len(logged))
+        self.assertEquals(200, logged[0].get_status())
+
+
 if __name__ == "__main__":
     tornado.testing.main()
 
@@ -5,16 +5,24 @@ Description: Base views classes
 '''
 from tornado.ioloop import IOLoop
 from tornado.httpserver import HTTPServer
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.netutil import bind_sockets
+from tornado import process
 
 
 import tornado.options
 import tornado.web
 from tornado import gen
+from tornado import stack_context
+from tornado.log import access_log
 from tornado.options import define, options
 
+from config import *
+
 
 define("port", default = 8000, help = "set server port", type = int)
+define("workers", default = process.cpu_count(), type = int,
+       help = "number of worker processes sharing the port, defaults to number of cores")
+define("database", default = DATABASE_PATH, help = "sqlalchemy database url")
 
 import simplejson as json
 
@@ -24,10 +32,18 @@ import uuid
 import simplejson as json
 from datetime import datetime
 
-from config import *
-from models import users, bought_products, products, engine
+from models import users, bought_products, products, create_db_engine, pool_stats
+from models import QueryStats, collect_queries, track_queries
 from db_base import UserDatabaseHandler, ProductDatabaseHandler, AuthDBHandler, MiscDBHandler, BoughtDBHandler
-from helper_functions import generate_password_hash, check_password_hash, generate_secure_cookie, check_secure_cookie
+from helper_functions import generate_password_hash, check_password_hash, password_needs_rehash
+from helper_functions import generate_session_token, check_session_token
+from helper_functions import encode_cursor, decode_cursor, parse_price, PRICE_PATTERN
+from async_db import AsyncDBHandler, create_db_executor
+from services import LocalService
+from cache import ResponseCache, AuthCache, SharedCounter, SessionRevocations
+from serializers import dumps, response_envelope
+from async_hash import create_hash_executor, hash_passwords
+from functools import partial
 
 
 
@@ -43,6 +59,7 @@ status codes FAQ:
     404 -- Not Found
     401 -- Unauthorized
     403 -- Forbidden
+    409 -- Conflict
 """
 
 
@@ -50,29 +67,92 @@ class Application(tornado.web.Application):
 
     """
     Application class 
-    accepts (mandatory) sqlalchemy connection object in constructor
+    accepts (mandatory) sqlalchemy engine or connection object in constructor,
+    given an engine queries run on db executor threads, every thread checks out
+    its own connection from the pool (counted in /stats, see models.PoolStats),
+    given a connection all the requests share it
+
+    hash_processes -- (optional) size of process pool hashing passwords,
+    defaults to HASH_PROCESSES given an engine and 0 (inline) given a connection
+    cache_counters -- (optional) dict with SharedCounter for "cache" and "auth_cache"
+    and SessionRevocations for "revocations", given when running many worker
+    processes so invalidations and revoked session tokens reach all of them
+    hash_iterations -- (optional) cost of new password hashes, hashes with lower
+    cost are replaced on login, defaults to PASSWORD_HASH_ITERATIONS
     """
 
-    def __init__(self, conn):
+    def __init__(self, db, hash_processes = None, cache_counters = None,
+                 hash_iterations = PASSWORD_HASH_ITERATIONS):
         handlers = [
             (r"/", IndexHandler),
             (r"/users", UsersHandler),
+            (r"/users/export", UsersExportHandler),
             (r"/user", UserHandler),
             (r"/user/(\w{4,20})/bought", BoughtProductsHandler),
             (r"/user/(\w{4,20})/sold", SoldProductsHandler),
             (r"/products", ProductsHandler),
+            (r"/products/export", ProductsExportHandler),
+            (r"/products/search", ProductSearchHandler),
+            (r"/products/categories", CategoriesHandler),
             (r"/product", ProductHandler),
             (r"/products/buy", BuyProductsHandler),
             (r"/products/top", TopProductsHandler),
             (r"/auth", AuthenticationHandler),
+            (r"/stats", StatsHandler),
         ]
         settings = {
             "debug": DEBUG,
+            "query_stats_headers": QUERY_STATS_HEADERS,
             "template_path": BASE_PATH + "/templates",
             "static_path": BASE_PATH + "/static"
         }
         super(Application, self).__init__(handlers, **settings)
-        self.conn = conn
+        if db is db.engine:
+            self.conn = None
+        else:
+            self.conn = db
+        self.engine = db.engine
+        track_queries(db)
+        self.pool_stats = pool_stats(self.engine)
+        self.db_executor = create_db_executor(db, connect = self.pool_stats.connect)
+        cache_counters = cache_counters or dict()
+        self.cache = ResponseCache(RESPONSE_CACHE_BYTES, shared = cache_counters.get("cache"))
+        self.auth_cache = AuthCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL, shared = cache_counters.get("auth_cache"))
+        self.revocations = cache_counters.get("revocations") or SessionRevocations()
+        if hash_processes is None:
+            hash_processes = HASH_PROCESSES if self.conn is None else 0
+        self.hash_executor = create_hash_executor(hash_processes)
+        self.hash_iterations = hash_iterations
+
+    def __call__(self, request):
+        """
+        Counts statements executed for the request in request.query_stats,
+        stack context carries collecting over to callbacks
+        scheduled by the request (db executor futures included)
+        """
+        request.query_stats = QueryStats()
+        with stack_context.StackContext(partial(collect_queries, request.query_stats)):
+            return super(Application, self).__call__(request)
+
+    def log_request(self, handler):
+        """
+        Same as default access log line followed by
+        number of statements and time spent executing them,
+        log_function setting still takes precedence
+        """
+        if "log_function" in self.settings:
+            self.settings["log_function"](handler)
+            return
+        if handler.get_status() < 400:
+            log_method = access_log.info
+        elif handler.get_status() < 500:
+            log_method = access_log.warning
+        else:
+            log_method = access_log.error
+        stats = handler.request.query_stats
+        log_method("%d %s %.2fms queries=%d db=%.2fms", handler.get_status(),
+                   handler._request_summary(), 1000.0 * handler.request.request_time(),
+                   stats.count, 1000.0 * stats.time)
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -82,21 +162,34 @@ class BaseHandler(tornado.web.RequestHandler):
     settings for other handlers
     """
 
+    # tags of cached GET responses (see cache.ResponseCache),
+    # None if responses of the handler are not cached
+    cache_tags = None
+
+    response_codes = dict(
+        Success = 200,
+        Bad_Request = 400,
+        Server_Error = 500,
+        Created = 201,
+        Not_Modified = 304,
+        Not_Found = 404,
+        Unauthorized = 401,
+        Forbidden = 403,
+        Conflict = 409
+    )
+    # status code -> message used by generic_resp
+    response_messages = dict((code, message) for message, code in response_codes.items())
+
     def __init__(self, *args, **kwargs):
         super(BaseHandler, self).__init__(*args, **kwargs)
-        self.conn = self.application.conn
-        self.client = AsyncHTTPClient()
-
-        self.response_codes = dict(
-            Success = 200,
-            Bad_Request = 400,
-            Server_Error = 500,
-            Created = 201,
-            Not_Modified = 304,
-            Not_Found = 404,
-            Unauthorized = 401,
-            Forbidden = 403
-        )
+        self._service = None
+        # db handler methods invalidate this cache after writes
+        self.cache = self.application.cache
+        self.auth_cache = self.application.auth_cache
+        self.revocations = self.application.revocations
+        self._cache_key = None
+        self._cache_generation = None
+        self._cached_etag = None
 
         self.required_product_fields = ("product_name", "product_desc", "price")
 
@@ -113,7 +206,48 @@ class BaseHandler(tornado.web.RequestHandler):
         #         self.set_status(404)
         #         self.finish()
         #         return
+        if self.request.method == "GET" and self.cache_tags is not None:
+            self.respond_from_cache()
 
+    def respond_from_cache(self):
+        """
+        Finishes request with cached response if there is one,
+        answers 304 if client already has it (If-None-Match matches the etag),
+        else remembers key so finish stores the response
+        """
+        self._cache_key = self.cache.key(self.request.path, self.request.query_arguments)
+        self._cache_generation = self.cache.generation
+        cached = self.cache.get(self._cache_key)
+        if cached is None:
+            return
+        self._cache_key = None
+        self._cached_etag, body = cached
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(body)
+        self.finish()
+
+    def compute_etag(self):
+        if self._cached_etag is not None:
+            return self._cached_etag
+        return super(BaseHandler, self).compute_etag()
+
+    def finish(self, chunk = None):
+        """
+        Stores successful response in cache before finishing
+        """
+        if chunk is not None:
+            self.write(chunk)
+        if self._cache_key is not None and self.get_status() == 200 and not self._headers_written:
+            self._cached_etag = self.cache.put(self._cache_key, b"".join(self._write_buffer),
+                                               self.cache_tags, self._cache_generation)
+        if self.settings.get("query_stats_headers") and not self._headers_written:
+            stats = self.request.query_stats
+            self.set_header("X-Query-Count", stats.count)
+            self.set_header("X-DB-Time", "%.2fms" % (1000.0 * stats.time))
+        super(BaseHandler, self).finish()
 
     def generic_resp(self, status_code, _meta = None):
 
@@ -132,79 +266,194 @@ class BaseHandler(tornado.web.RequestHandler):
                 "_meta" : "some_data"
             }
         """
-        message = "Unknown_Message"
-        for key, val in self.response_codes.items():
-            if val == status_code:
-                message = key
-
-        self.write(json.dumps(dict(status = status_code, message = message, _meta = _meta)))
+        message = self.response_messages.get(status_code, "Unknown_Message")
+        self.write(response_envelope(status_code, message, _meta))
         self.set_status(status_code)
         self.finish()
 
-    def get_self_url(self, route):
+    @property
+    def service(self):
         """
-        Returns absolute path to app, given a specific route
+        In-process lookup service (see services.LocalService),
+        created once per request
         """
+        if self._service is None:
+            self._service = LocalService(self.async_db)
+        return self._service
 
-        return self.request.protocol + "://" + self.request.host + route
-
-    @gen.coroutine
-    def remote_auth(self, username, password, persist = 0):
+    def async_db(self, handler_class):
+        """
+        Returns proxy to given database handler class
+        which methods run on application db executor and return futures
+        see async_db.AsyncDBHandler
+        """
+        return AsyncDBHandler(handler_class, self.application.db_executor, self.cache, self.auth_cache,
+                              self.revocations)
 
+    def get_page_cursor(self, argument = "cursor"):
+        """
+        Parses cursor query argument used for keyset pagination
+        Returns tuple (keyset, after):
+            keyset -- False if no cursor given (offset pagination is used)
+            after -- key of last row of previous page, None for first page
+        empty cursor argument requests first page,
+        raises ValueError if cursor is malformed
+        argument -- name of query argument containing cursor
+        """
+        cursor = self.get_query_argument(argument, None)
+        if cursor is None:
+            return False, None
+        if not cursor:
+            return True, None
+        after = decode_cursor(cursor)
+        if type(after) not in (int, long):
+            raise ValueError("Invalid cursor")
+        return True, after
+
+    def get_fields(self, field_tuple, exclude = ()):
+        """
+        Parses fields query argument (comma separated field names)
+        limiting fields returned and selected from database
+        Returns list of field names or None if argument not given,
+        raises ValueError if name is not in field_tuple
+        or only excluded fields were requested
+
+        field_tuple -- fields that can be requested (eg. USER_FIELDS)
+        exclude -- fields current user cant see (eg. SECURE_USER_FIELDS)
+        """
+        fields = self.get_query_argument("fields", None)
+        if fields is None:
+            return None
+        fields = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = set(fields) - set(field_tuple)
+        if unknown:
+            raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+        if not [name for name in fields if name not in exclude]:
+            raise ValueError("No fields selected")
+        return fields
+
+    def get_columnar(self):
         """
-        Simple handler for user authentication 
-        persist -- (int) 1 or 0
+        Returns True if list should be returned in columnar format
+        (format=columnar query argument):
+            {"columns": ["product_name", "price"], "rows": [["wiertarka", "120zl"], ...]}
+        raises ValueError on unknown format
+        """
+        format = self.get_query_argument("format", None)
+        if format not in (None, "columnar"):
+            raise ValueError("Unknown format: " + format)
+        return format == "columnar"
 
-        Returns 1 if auth ok or 0 if not
-        if persist is 1 returns secure cookie
+    def get_self_url(self, route):
+        """
+        Returns absolute path to app, given a specific route
         """
 
+        return self.request.protocol + "://" + self.request.host + route
 
-        query = "/auth?username=" + username + "&password=" + password\
-                + "&persist=" + str(persist)
+    def get_session_token(self, user_data = None):
+        """
+        Returns session token (see /auth?persist=1) sent with request
+        as 'token' key of user data, 'token' query argument
+        or Authorization: Bearer header, None if not given
+        """
+        if isinstance(user_data, dict) and user_data.get("token", None):
+            return user_data["token"]
+        token = self.get_query_argument("token", None)
+        if token:
+            return token
+        header = self.request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            return header[len("Bearer "):].strip()
+        return None
 
-        req = HTTPRequest(self.get_self_url(query), method = "GET")
-        res = yield gen.Task(AsyncHTTPClient().fetch, req)
-        raise gen.Return(res.body)
+    @gen.coroutine
+    def authenticate_user(self, unique, password, direct = False, token = None):
+        """
+        Basic authentication function, should be yielded
+        requires unique identifier (username or uuid) and password
+        or session token
+        direct -- if True identifier has to be username
+        token -- session token, checked before the password,
+        valid only if it was issued for account given as identifier
+        (see check_token)
+        Returns : bool
+        """
+        if token:
+            valid = yield self.check_token(token, unique, direct)
+            if valid:
+                raise gen.Return(True)
+        if not password:
+            raise gen.Return(False)
+        username, user_uuid, authenticated = yield self.verify_credentials(unique, password, direct)
+        raise gen.Return(authenticated)
 
     @gen.coroutine
-    def get_item_data(self, identifier, direct = 0):
+    def check_token(self, token, unique, direct = False):
         """
-        Returns item information
-        if direct == 1 looks by product_uuid
+        Checks session token against current credentials of the user
+        (username, uuid and password hash), tokens of deleted accounts
+        or issued before password change are rejected even if revocations
+        were lost with restart, should be yielded
+        direct -- if True identifier has to be username
+        Returns : bool
         """
+        if not unique:
+            raise gen.Return(False)
+        user = yield self.service.get_credentials(unique)
+        if not user or (direct and user[0] != unique):
+            raise gen.Return(False)
+        raise gen.Return(check_session_token(token, user, self.revocations))
 
-        query = "/product?id=" + identifier + "&direct=" + str(direct)
-        req = HTTPRequest(self.get_self_url(query), method = "GET")
-        res = yield gen.Task(AsyncHTTPClient().fetch, req)
-        raise gen.Return(res.body)
-    
     @gen.coroutine
-    def get_user_data(self, identifier, direct = 0):
+    def verify_credentials(self, unique, password, direct = False):
         """
-        Return user information
-        if direct == 1 looks by user_uuid
+        Checks identifier (username or uuid) and password,
+        recently verified credentials are answered from auth cache
+        without database lookup and hashing (see cache.AuthCache),
+        should be yielded
+        direct -- if True identifier has to be username
+        Returns : tuple (username, user_uuid, authenticated),
+        username and user_uuid are None if user doesnt exist
         """
-        query = "/user/?id=" + identifier + "&direct=" + str(direct)
-        req = HTTPRequest(self.get_self_url(query), method = "GET")
-        res = yield gen.Task(AsyncHTTPClient().fetch, req)
-        raise gen.Return(res.body)
+        cached = self.auth_cache.get(unique, password)
+        if cached is not None and (not direct or cached[0] == unique):
+            raise gen.Return(cached + (True, ))
+
+        generation = self.auth_cache.generation
+        user = yield self.service.get_credentials(unique)
+        if not user or (direct and user[0] != unique):
+            raise gen.Return((None, None, False))
+        if not user[1]:
+            raise gen.Return((user[0], user[2], False))
+
+        authenticated = yield self.check_password(user[0], password, user[1])
+        if authenticated:
+            self.auth_cache.put(unique, password, user[0], user[2], generation)
+        raise gen.Return((user[0], user[2], authenticated))
 
-    @tornado.web.asynchronous
-    def authenticate_user(self, unique, password):
+    @gen.coroutine
+    def check_password(self, username, password, signature):
         """
-        Basic authentication function 
-        used for synchronously fetch user information
-        requires unique identifier (username or uuid) and password
+        Verifies password against stored hash on the hash executor
+        (outside of the IOLoop), should be yielded.
+        If hash uses outdated algorithm or cost (see PASSWORD_HASH_ALGORITHM
+        and PASSWORD_HASH_ITERATIONS) it is replaced with new one
         Returns : bool
         """
-        user = self.get_credentials(unique)
-
-        if not user:
-            return False
-
-        authenticated = check_password_hash(password, user[1])
-        return authenticated
+        executor = self.application.hash_executor
+        authenticated = yield executor.submit(check_password_hash, password, signature)
+        if authenticated and password_needs_rehash(signature, self.application.hash_iterations):
+            new_hash = yield self.hash_password(password)
+            yield self.async_db(UserDatabaseHandler).replace_password_hash(username, signature, new_hash)
+        raise gen.Return(authenticated)
+
+    def hash_password(self, password):
+        """
+        Returns future of password hash computed on the hash executor
+        """
+        return self.application.hash_executor.submit(generate_password_hash, password,
+                                                     iterations = self.application.hash_iterations)
 
 
 class IndexHandler(tornado.web.RequestHandler):
@@ -215,8 +464,11 @@ class IndexHandler(tornado.web.RequestHandler):
         self.render("index.html", host = self.request.protocol + "://" + self.request.host )
 
 class UsersHandler(BaseHandler, UserDatabaseHandler):
+
+    cache_tags = ("users",)
     
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
 
         """
@@ -224,9 +476,21 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
         and additional metadata
 
         example url: www.base_adress.com/users?limit=10&offset=20
+                     www.base_adress.com/users?limit=10&cursor=
+                     www.base_adress.com/users?limit=10&fields=username,joined
+
+        if cursor is given (empty for first page) keyset pagination
+        is used instead of offset and _metadata contains next_cursor
+        to be passed to get next page (null on the last page)
+
+        fields -- (optional) comma separated USER_FIELDS to return,
+        private fields are never returned
+        format -- (optional) columnar returns users as
+        {"columns": [...], "rows": [[...], ...]} (see get_columnar)
 
         Response Codes:
             200 -- OK
+            400 -- Invalid cursor, limit, fields or format
             500 -- Server Error
 
         """
@@ -237,19 +501,41 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
             self.generic_resp(500, str(e))
             return
         try:
-            list_of_users = self.list_all_users(limit, offset, safe = True)
-            number_of_users = self.get_number_of_users()
-
+            keyset, after = self.get_page_cursor()
+            if keyset:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError("Invalid limit")
+            fields = self.get_fields(USER_FIELDS, SECURE_USER_FIELDS)
+            columnar = self.get_columnar()
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+        try:
+            db = self.async_db(UserDatabaseHandler)
             result = dict()
-            result["users"] = list_of_users
             result["_metadata"] = dict()
+            if keyset:
+                (list_of_users, last), number_of_users = yield [
+                    db.list_users_after(limit, after, safe = True, fields = fields, columnar = columnar),
+                    db.get_number_of_users()
+                ]
+                result["_metadata"]["cursor"] = self.get_query_argument("cursor")
+                result["_metadata"]["next_cursor"] = encode_cursor(last) if last is not None else None
+            else:
+                list_of_users, number_of_users = yield [
+                    db.list_all_users(limit, offset, safe = True, fields = fields, columnar = columnar),
+                    db.get_number_of_users()
+                ]
+                result["_metadata"]["offset"] = offset
+
+            result["users"] = list_of_users
             result["_metadata"]["total"] = number_of_users
             result["_metadata"]["limit"] = limit
-            result["_metadata"]["offset"] = offset
             result["status"] = 200
             result["message"] = "OK"
 
-            self.write(json.dumps(result))
+            self.write(dumps(result))
             self.finish()
             return
         except Exception as e:
@@ -258,6 +544,7 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
             return
     
     @tornado.web.asynchronous
+    @gen.coroutine
     def post(self):
         """
         Create new user,
@@ -269,6 +556,13 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
 
         example url : www.base.com/users
 
+        To create many users at once send list of users instead:
+            {"users": [{"username": ..., "email": ..., "password": ...}, ...]}
+        _meta key contains result for every user:
+            {"username": "konrad", "status": 201, "uuid": "..."}
+        status is 201 if created, 409 if username or email is taken
+        and 400 if malformed, response status is 201 if any user was created
+
         Response Codes:
             201 -- Account Created
             400 -- Bad Request( Wrong credentials )
@@ -278,6 +572,9 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
         if not self.request.body:
             self.generic_resp(404)
         rec = json.loads(self.request.body)
+        if "users" in rec:
+            yield self.create_many(rec["users"])
+            return
         # Process data  -- remove whitespace
         # Validate data here
         # Should be validated on frontend side first
@@ -288,14 +585,16 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
                 self.generic_resp(400, "Missing fields")
                 return
         try:
-            if not self.credentials_unique(data["username"], data["email"]):
+            db = self.async_db(UserDatabaseHandler)
+            unique = yield db.credentials_unique(data["username"], data["email"])
+            if not unique:
                 self.generic_resp(400, "Username and password have to be unique")
                 return
-            data["password"] = generate_password_hash(data["password"])
+            data["password"] = yield self.hash_password(data["password"])
             # TODO think abot parsing date
             data["joined"] = datetime.now().date()
             try:
-                id = self.create_user(data)
+                id = yield db.create_user(data)
                 self.generic_resp(201)
                 return
             except Exception as e:
@@ -305,6 +604,39 @@ class UsersHandler(BaseHandler, UserDatabaseHandler):
             self.generic_resp(500, str(e))
             return
 
+    @gen.coroutine
+    def create_many(self, records):
+        """
+        Creates list of users in single transaction,
+        runs on db executor as passwords are hashed meanwhile,
+        see post for details
+        """
+        if not isinstance(records, list) or not records:
+            self.generic_resp(400, "Data not parsed properly")
+            return
+        if len(records) > MAX_BULK_USERS:
+            self.generic_resp(400, "Too many users, maximum is {0}".format(MAX_BULK_USERS))
+            return
+        joined = datetime.now().date()
+        for record in records:
+            if isinstance(record, dict):
+                record["joined"] = joined
+        try:
+            results = yield self.async_db(UserDatabaseHandler).create_users(
+                records, hash_passwords = partial(hash_passwords, self.application.hash_executor,
+                                                  iterations = self.application.hash_iterations))
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+        statuses = set(result["status"] for result in results)
+        if 201 in statuses:
+            self.generic_resp(201, results)
+        elif 409 in statuses:
+            self.generic_resp(409, results)
+        else:
+            self.generic_resp(400, results)
+
+
 
 class UserHandler(BaseHandler, UserDatabaseHandler):
 
@@ -319,6 +651,7 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
 
 
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         """
         Return single user Information 
@@ -338,6 +671,8 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
             the user and gives detailed account info
             direct -- whether it is direct connection (username provided - 1)
             or remote (uuid is checked - 0) defaults to 0
+            fields -- (optional) comma separated USER_FIELDS to return,
+            private ones only if authenticated
 
         """
                 
@@ -354,12 +689,18 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
             self.generic_resp(404, "Missing uuid")
             return
         if password:
-            auth = self.authenticate_user(identifier, password)
+            auth = yield self.authenticate_user(identifier, password)
             if auth:
                 visitor = False
+        try:
+            fields = self.get_fields(USER_FIELDS, SECURE_USER_FIELDS if visitor else ())
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
         try:
             # if authenticated
-            user_data = self.get_user(identifier, safe = visitor, direct = direct)
+            user_data = yield self.async_db(UserDatabaseHandler).get_user(identifier, safe = visitor, direct = direct,
+                                                                          fields = fields)
             if not user_data:
                 self.generic_resp(404, "User doesnt exist")
                 return
@@ -369,7 +710,7 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
                 result["status"] = 200
                 result["message"] = "OK"
                 self.set_status(200)
-                self.write(json.dumps(result))
+                self.write(dumps(result))
                 self.finish()
                 return
         except Exception as e:
@@ -377,6 +718,7 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
             return
 
     @tornado.web.asynchronous
+    @gen.coroutine
     def put(self):
         """
         Update user_information 
@@ -404,12 +746,13 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
 
         """
         username = self.get_query_argument("username")
-        password = self.get_query_argument("password")
+        password = self.get_query_argument("password", None)
+        token = self.get_session_token()
 
-        if not username or not password:
+        if not username or not (password or token):
             self.generic_resp(403)
             return
-        authenticated = self.authenticate_user(username, password)
+        authenticated = yield self.authenticate_user(username, password, token = token)
         if not authenticated:
             self.generic_resp(403)
             return
@@ -420,39 +763,43 @@ class UserHandler(BaseHandler, UserDatabaseHandler):
             return
         update_data = json.loads(data)["update"]
         if "password" in update_data.keys():
-            update_data["password"] = generate_password_hash(update_data["password"])
+            update_data["password"] = yield self.hash_password(update_data["password"])
         try:
-            updated = self.update_user(username, update_data, uuid = False)
+            updated = yield self.async_db(UserDatabaseHandler).update_user(username, update_data, uuid = False)
             if not updated:
                 self.generic_resp(500)
                 return
             else:
-                self.generic_resp(201, json.dumps(updated))
+                self.generic_resp(201, dumps(updated))
                 return
         except Exception as e:
             self.generic_resp(500, str(e))
             return
 
+    @tornado.web.asynchronous
+    @gen.coroutine
     def delete(self):
         """
         Delete user with given username or password
         Requires Validation
         Sample request:
             www.base.com?id=x&password=y
+            www.base.com?id=x&token=session_token
         """
         id = self.get_query_argument("id", None)
         password = self.get_query_argument("password", None)
+        token = self.get_session_token()
 
-        if not id or not password:
+        if not id or not (password or token):
             self.generic_resp(403)
             return
-        authenticated = self.authenticate_user(id, password)
+        authenticated = yield self.authenticate_user(id, password, token = token)
         if not authenticated:
             self.generic_resp(403)
             return
         else:
             try:
-                self.delete_user(id, uuid = False)
+                yield self.async_db(UserDatabaseHandler).delete_user(id, uuid = False)
                 self.generic_resp(200)
                 return
             except Exception as e:
@@ -465,47 +812,106 @@ class ProductsHandler(BaseHandler, ProductDatabaseHandler):
         GET - gets list of products
         POST -- creates new product
     """
+
+    cache_tags = ("products",)
+
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         """
         Get list of products 
 
         params: limit -- defaults to 10
                 offset -- defaults to 0
+                cursor -- (optional) use keyset pagination instead of offset,
+                empty for the first page, next pages use next_cursor from _metadata
                 category -- (optional)limits search for product to given category
+                fields -- (optional) comma separated PRODUCT_FIELDS to return
+                format -- (optional) columnar returns products as
+                {"columns": [...], "rows": [[...], ...]} (see get_columnar)
+                min_price, max_price -- (optional) inclusive price range (eg. 12.50)
+                sort -- (optional) price or -price (descending), products are
+                returned in that order (format=columnar is best for keeping it),
+                cannot be used with cursor
 
         sample request:
             www.base.com/products?limit=x&offset=y
+            www.base.com/products?limit=x&cursor=
+            www.base.com/products?limit=x&fields=product_name,price
+            www.base.com/products?min_price=10&max_price=99.99&sort=-price
         Returns:
             json containing list of products
             as well as _metadata with current
-            limit, offset and total number of products
+            limit, offset (or cursor and next_cursor) and total number of products
         """
 
         limit = self.get_query_argument("limit", 10)
         offset = self.get_query_argument("offset", 0)
         category = self.get_query_argument("category", None)
+        sort = self.get_query_argument("sort", None)
 
         try:
-            number_of_products = self.get_number_of_products()
-            product_list = self.get_product_list(limit, offset, category)
-        except Exception as e:
-            self.generic_resp(500, str(e))
+            keyset, after = self.get_page_cursor()
+            if keyset:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError("Invalid limit")
+                if sort is not None:
+                    raise ValueError("Sorting is not supported with cursor")
+            if sort not in (None, "price", "-price"):
+                raise ValueError("Unknown sort: " + sort)
+            fields = self.get_fields(PRODUCT_FIELDS)
+            columnar = self.get_columnar()
+            min_price = self.get_price_argument("min_price")
+            max_price = self.get_price_argument("max_price")
+        except ValueError as e:
+            self.generic_resp(400, str(e))
             return
 
         list_of_products = dict()
         list_of_products["_metadata"] = dict()
+        try:
+            db = self.async_db(ProductDatabaseHandler)
+            if keyset:
+                number_of_products, (product_list, last) = yield [
+                    db.get_number_of_products(category, min_price, max_price),
+                    db.get_products_after(limit, after, category, fields, columnar, min_price, max_price)
+                ]
+                list_of_products["_metadata"]["cursor"] = self.get_query_argument("cursor")
+                list_of_products["_metadata"]["next_cursor"] = encode_cursor(last) if last is not None else None
+            else:
+                number_of_products, product_list = yield [
+                    db.get_number_of_products(category, min_price, max_price),
+                    db.get_product_list(limit, offset, category, fields, columnar, min_price, max_price, sort)
+                ]
+                list_of_products["_metadata"]["offset"] = offset
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+
         list_of_products["_metadata"]["limit"] = limit
-        list_of_products["_metadata"]["offset"] = offset
         list_of_products["_metadata"]["total"] = number_of_products
         # list_of_products["_metadata"]["category"] = category or "All"
         list_of_products["products"] = product_list
         list_of_products["status"] = 200
         list_of_products["message"] = "OK"
-        self.write(json.dumps(list_of_products))
+        self.write(dumps(list_of_products))
         self.set_status(200)
         self.finish()
 
+    def get_price_argument(self, name):
+        """
+        Returns price query argument (eg. 12.50) in minor units,
+        None if not given, raises ValueError if it is not a price
+        """
+        price = self.get_query_argument(name, None)
+        if price is None:
+            return None
+        match = PRICE_PATTERN.match(price.strip())
+        if not match or match.end() != len(price.strip()) or parse_price(price) is None:
+            raise ValueError("Invalid " + name)
+        return parse_price(price)
+
 
     @tornado.web.asynchronous
     @gen.coroutine
@@ -520,9 +926,9 @@ class ProductsHandler(BaseHandler, ProductDatabaseHandler):
                 price -- string
             'user' object with :
                 username
-                password 
-                can be also provided from secure cookie
-            'cookie' -- (optional) secure cookie sent by javascript
+                password -- or token
+                token -- session token returned by /auth?persist=1,
+                can be also sent as Authorization: Bearer header
 
         Returns : 201 -- Created
                   403 -- Forbidden if authentication failed
@@ -549,15 +955,9 @@ class ProductsHandler(BaseHandler, ProductDatabaseHandler):
                 self.generic_resp(400, "Data not parsed properly")
                 return
 
-        # print "running"
-
-        # implement cookie authentication
-
-
-        resp = yield self.remote_auth(user_data["username"], user_data["password"], persist = 0)
-
         try:
-            authenticated = int(resp)
+            authenticated = yield self.authenticate_user(user_data["username"], user_data.get("password", None),
+                                                         direct = True, token = self.get_session_token(user_data))
         except Exception as e:
             self.generic_resp(500, str(e))
             return
@@ -565,7 +965,9 @@ class ProductsHandler(BaseHandler, ProductDatabaseHandler):
         if authenticated == 0:
             self.generic_resp(403, "Invalid Credentials")
             return
-        if not self.product_unique(product_data["product_name"]):
+        db = self.async_db(ProductDatabaseHandler)
+        unique = yield db.product_unique(product_data["product_name"])
+        if not unique:
             self.generic_resp(400, "This product name is already taken")
             return
 
@@ -575,16 +977,119 @@ class ProductsHandler(BaseHandler, ProductDatabaseHandler):
         parsed_product_data["seller"] = user_data["username"]
 
         try:
-            success = self.create_product(parsed_product_data)
-            self.generic_resp(201, json.dumps(success))
+            success = yield db.create_product(parsed_product_data)
+            self.generic_resp(201, dumps(success))
             return
 
         except Exception as e:
             self.generic_resp(500, str(e))
             return
 
+class ProductSearchHandler(BaseHandler, ProductDatabaseHandler):
+    """
+    Full text search in product names and descriptions
+    implements only GET method
+    """
+
+    cache_tags = ("products",)
+
+    @tornado.web.asynchronous
+    @gen.coroutine
+    def get(self):
+        """
+        Get products matching all the words of query, most relevant first
+
+        params: q -- words to look for
+                limit -- defaults to 10, at most SEARCH_MAX_LIMIT
+                offset -- defaults to 0
+                category -- (optional) limits search to given category
+                fields -- (optional) comma separated PRODUCT_FIELDS to return
+                format -- (optional) columnar, see get_columnar
+
+        sample request:
+            www.base.com/products/search?q=wiertarka+udarowa&limit=x&offset=y
+        Returns:
+            json containing list of products ordered by relevance
+            and _metadata with query, limit, offset
+            and next_offset (None if there are no more results)
+        """
+        query = self.get_query_argument("q", u"")
+        category = self.get_query_argument("category", None)
+
+        try:
+            limit = min(int(self.get_query_argument("limit", 10)), SEARCH_MAX_LIMIT)
+            offset = int(self.get_query_argument("offset", 0))
+            if limit < 1 or offset < 0:
+                raise ValueError("Invalid limit or offset")
+            fields = self.get_fields(PRODUCT_FIELDS)
+            columnar = self.get_columnar()
+            found, more = yield self.async_db(ProductDatabaseHandler)\
+                    .search_products(query, limit, offset, category, fields, columnar)
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+
+        result = dict()
+        result["_metadata"] = dict(
+            query = query,
+            limit = limit,
+            offset = offset,
+            next_offset = offset + limit if more else None
+        )
+        result["products"] = found
+        result["status"] = 200
+        result["message"] = "OK"
+        self.write(dumps(result))
+        self.set_status(200)
+        self.finish()
+
+
+class CategoriesHandler(BaseHandler, ProductDatabaseHandler):
+    """
+    Number of products in every category,
+    implements only GET method
+    """
+
+    cache_tags = ("products",)
+
+    @tornado.web.asynchronous
+    @gen.coroutine
+    def get(self):
+        """
+        Get product counts per category, served from counters
+        maintained by product writes, response is cached
+        and has an ETag (send it in If-None-Match to get 304)
+
+        sample request:
+            www.base.com/products/categories
+        Returns:
+            json containing categories: {category: number of products}
+            and _metadata with total number of products
+        """
+        try:
+            categories, total = yield self.async_db(ProductDatabaseHandler).get_category_counts()
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+
+        result = dict()
+        result["_metadata"] = dict(total = total)
+        result["categories"] = categories
+        result["status"] = 200
+        result["message"] = "OK"
+        self.write(dumps(result))
+        self.set_status(200)
+        self.finish()
+
+
 class ProductHandler(BaseHandler, ProductDatabaseHandler):
 
+    # replaced by product:<uuid> once product is found
+    cache_tags = ()
+
     @tornado.web.asynchronous
     @gen.coroutine
     def get(self):
@@ -595,6 +1100,7 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
         sample request: www.base.com/product?id=xdirect=1
         id -- unique product identifier name or uuid
         direct -- if set to 1 looks by uuid if 0 by name
+        fields -- (optional) comma separated PRODUCT_FIELDS to return
         """
 
         identifier = self.get_query_argument("id", None)
@@ -609,18 +1115,27 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
         except:
             direct = False
         try:
-
-            res = self.get_product(identifier, direct)
+            fields = self.get_fields(PRODUCT_FIELDS)
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+        try:
+            # uuid is needed for cache tag
+            res = yield self.async_db(ProductDatabaseHandler)\
+                    .get_product(identifier, direct, None if fields is None else fields + ["uuid"])
             if not res:
                 self.generic_resp(404)
                 return
 
+            self.cache_tags = ("product:" + res["uuid"],)
+            if fields is not None and "uuid" not in fields:
+                del res["uuid"]
             resp = dict()
             resp["product"] = res
             resp["status"] = 200
             resp["mesasage"] = "OK"
 
-            self.write(json.dumps(resp))
+            self.write(dumps(resp))
             self.set_status(200)
             return
         except Exception as e:
@@ -649,7 +1164,7 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
             }
             "user": {
                 "username": "konrad",
-                "password": "test"
+                "password": "test" -- or "token": session token
             }
             }
         
@@ -676,9 +1191,8 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
         try:
             try:
                 # authenticate user
-                authenticated = yield\
-                        self.remote_auth(user_data["username"], user_data["password"])
-                authenticated = int(authenticated)
+                authenticated = yield self.authenticate_user(user_data["username"], user_data.get("password", None),
+                                                             direct = True, token = self.get_session_token(user_data))
             except Exception as e:
                 self.generic_resp(500, str(e))
                 return
@@ -690,9 +1204,10 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
             
             # get full product info
             try:
-                full_product_data = yield\
-                        self.get_item_data(product_data["product_name"], direct = 0)
-                full_product_data = json.loads(full_product_data)["product"]
+                full_product_data = yield self.service.get_item_data(product_data["product_name"])
+                if not full_product_data:
+                    self.generic_resp(404)
+                    return
                 if full_product_data["seller"] != user_data["username"]:
                     self.generic_resp(401, "You dont have permission to update this item")
                     return
@@ -704,12 +1219,12 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
             return
 
         try:
-            result = self.update_product(full_product_data["uuid"], product_data)
+            result = yield self.async_db(ProductDatabaseHandler).update_product(full_product_data["uuid"], product_data)
             resp = dict()
             resp["status"] = 201
             resp["message"] = "Created"
             resp["updated"] = result
-            self.write(json.dumps(resp))
+            self.write(dumps(resp))
             self.set_status(201)
             self.finish()
             return
@@ -728,7 +1243,8 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
         query parameters:
             id -- (required) identifier of the product
             name -- (required) name of the owner
-            password -- (required) user_password
+            password -- (required) user_password,
+            can be replaced by token -- session token
             direct -- if 1 gets product by uuid else by name
 
             id of the owner has to match 'seller' field in products table
@@ -738,21 +1254,20 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
         product_identifier = self.get_query_argument("id", None)
         username = self.get_query_argument("name", None)
         password = self.get_query_argument("password", None)
+        token = self.get_session_token()
         direct = self.get_query_argument("direct", 0)
         try:
             direct = int(direct)
         except:
             direct = 0
 
-        if not username or not password or not product_identifier:
+        if not username or not (password or token) or not product_identifier:
             self.generic_resp(400, "Missing fields")
             return
 
         try:
-            authenticated = yield self.remote_auth(username, password, persist = 0)
-
             try:
-                authenticated = int(authenticated)
+                authenticated = yield self.authenticate_user(username, password, direct = True, token = token)
                 if not authenticated:
                     self.generic_resp(401, "Authentication Failed")
                     return
@@ -760,12 +1275,10 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
                 self.generic_resp(500)
                 return
 
-            item_data = yield self.get_item_data(product_identifier, direct = direct)
-            item_data = json.loads(item_data)
-            if item_data["status"] != 200:
+            item_data = yield self.service.get_item_data(product_identifier, direct)
+            if not item_data:
                 self.generic_resp(404, "Item Not Found")
                 return
-            item_data = item_data["product"]
 
             if username != item_data["seller"]:
                 self.generic_resp(401, "Permission Denied")
@@ -775,7 +1288,7 @@ class ProductHandler(BaseHandler, ProductDatabaseHandler):
             return
 
         try:
-            self.delete_product(product_identifier, uuid = direct)
+            yield self.async_db(ProductDatabaseHandler).delete_product(product_identifier, uuid = direct)
             self.generic_resp(201, "Product deleted")
             return
 
@@ -788,8 +1301,13 @@ class TopProductsHandler(BaseHandler, MiscDBHandler):
     """
     Simple handler for getting most selled products 
     accepts optional limit argument
+    and format=columnar (see BaseHandler.get_columnar), which keeps the order
     """
+
+    cache_tags = ("top",)
+
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
 
         limit = self.get_query_argument("limit", 10)
@@ -798,8 +1316,15 @@ class TopProductsHandler(BaseHandler, MiscDBHandler):
         
 
         try:
-            top_products = self.get_top_selling_products(limit) or "No Products"
-            self.write(json.dumps(top_products))
+            columnar = self.get_columnar()
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+
+        try:
+            top_products = yield self.async_db(MiscDBHandler).get_top_selling_products(limit, columnar)
+            top_products = top_products or "No Products"
+            self.write(dumps(top_products))
             self.set_status(200)
             self.finish()
             return
@@ -810,6 +1335,7 @@ class TopProductsHandler(BaseHandler, MiscDBHandler):
 class BuyProductsHandler(BaseHandler, BoughtDBHandler):
 
     @tornado.web.asynchronous
+    @gen.coroutine
     def post(self):
         """
         
@@ -828,7 +1354,8 @@ class BuyProductsHandler(BaseHandler, BoughtDBHandler):
                     "user_uuid" : "16a0182a-8f58-4c4f-93ca-4ad62287e64f" ,
                     "username" :"konrad",   --- optional
                     "password" : "test",
-                    "cookie" : generated_secure_cookie here -- optional -- to implement
+                    "token" : session token from /auth?persist=1 -- optional,
+                              replaces password, requires username
                 },
 
                 "product": {
@@ -839,28 +1366,41 @@ class BuyProductsHandler(BaseHandler, BoughtDBHandler):
 
             }
 
+        To buy many products at once (cart checkout) send list
+        of products instead, all of them are bought in one transaction:
+
+            {
+                "user": { ... },
+                "products": [
+                    {"product_name": "wiertarka", "quantity": 10},
+                    {"product_uuid": "fda4a4c4-8c8f-4fc2-8006-bab1556f3045", "quantity": 1}
+                ]
+            }
+
+        _meta key of the response contains result for every item:
+            {"product": "wiertarka", "quantity": 10, "status": 201}
+        item status is 201 if bought, 404 if product not found
+        or 400 if malformed. Response status is 201 if any item was bought
+
         """
 
         try:
             body = json.loads(self.request.body)
             user_data = body["user"]
-            product_data = body["product"]
+            items = body.get("products", None)
+            product_data = body["product"] if items is None else None
         except:
             self.generic_resp(400, "Data not parsed properly")
             return
+        if items is not None:
+            yield self.buy_many(user_data, items)
+            return
 
     
-        user_id = user_data.get("username", None)
-        if not user_id:
-            user_id = user_data.get("user_uuid", None)
-        else:
-            user_id = self.get_uuid_by_username(user_id)
+        user_id = user_data.get("username", None) or user_data.get("user_uuid", None)
 
-        product_id = product_data.get("product_name", None)
-        if not product_id:
-            product_id = product_data.get("product_uuid", None)
-        else:
-            product_id = self.get_uuid_by_product_name(product_id)
+        product_uuid = not product_data.get("product_name", None)
+        product_id = product_data.get("product_name", None) or product_data.get("product_uuid", None)
 
         if not product_id or not user_id:
             self.generic_resp(404)
@@ -869,21 +1409,98 @@ class BuyProductsHandler(BaseHandler, BoughtDBHandler):
 
         # authenticate
         password = user_data.get("password", None)
+        token = self.get_session_token(user_data)
         quantity = product_data.get("quantity", None)
-        if not password or not quantity:
+        if not (password or token) or type(quantity) not in (int, long) or quantity < 1:
             self.generic_resp(400, "Data not parsed properly")
             return
-        authenticated = self.authenticate_user(user_id, password)
+        try:
+            username, authenticated = yield self.authenticate_buyer(user_data, password, token)
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+        if not username:
+            self.generic_resp(404)
+            return
         if not authenticated:
+            product_column = products.c.product_uuid if product_uuid else products.c.product_name
+            exists = yield self.async_db(BoughtDBHandler).check_exists(product_column, product_id)
+            if not exists:
+                self.generic_resp(404)
+                return
             self.generic_resp(403, "Invalid username or password")
             return
 
         try:
-            self.add_bought_product(quantity, user_id, product_id)
+            bought = yield self.async_db(BoughtDBHandler).add_bought_product(quantity, username, product_id,
+                                                                             user_uuid = False,
+                                                                             product_uuid = product_uuid)
+            if not bought:
+                self.generic_resp(404)
+                return
             self.generic_resp(201, "Bought succesfully")
         except Exception as e:
             self.generic_resp(500, str(e))
 
+    @gen.coroutine
+    def buy_many(self, user_data, items):
+        """
+        Buys list of products authenticating user once,
+        see post for details
+        """
+        user_id = user_data.get("username", None) or user_data.get("user_uuid", None)
+        password = user_data.get("password", None)
+        token = self.get_session_token(user_data)
+        if not user_id:
+            self.generic_resp(404)
+            return
+        if not (password or token) or not isinstance(items, list) or not items:
+            self.generic_resp(400, "Data not parsed properly")
+            return
+        if len(items) > MAX_CART_ITEMS:
+            self.generic_resp(400, "Too many items, maximum is {0}".format(MAX_CART_ITEMS))
+            return
+        try:
+            username, authenticated = yield self.authenticate_buyer(user_data, password, token)
+            if not username:
+                self.generic_resp(404)
+                return
+            if not authenticated:
+                self.generic_resp(403, "Invalid username or password")
+                return
+            results = yield self.async_db(BoughtDBHandler).add_bought_products(username, items, user_uuid = False)
+            if results is None:
+                self.generic_resp(404)
+                return
+        except Exception as e:
+            self.generic_resp(500, str(e))
+            return
+        statuses = set(result["status"] for result in results)
+        if 201 in statuses:
+            self.generic_resp(201, results)
+        elif 404 in statuses:
+            self.generic_resp(404, results)
+        else:
+            self.generic_resp(400, results)
+
+    @gen.coroutine
+    def authenticate_buyer(self, user_data, password, token):
+        """
+        Authenticates buyer with session token (requires username)
+        or password (username or user_uuid), should be yielded
+        Returns : tuple (username, authenticated),
+        username is None if user doesnt exist
+        """
+        username = user_data.get("username", None)
+        if token:
+            valid = yield self.check_token(token, username, direct = True)
+            if valid:
+                raise gen.Return((username, True))
+        # looks by username or uuid
+        username, user_uuid, authenticated = yield self.verify_credentials(
+            username or user_data.get("user_uuid", None), password or "")
+        raise gen.Return((username, authenticated))
+
 
 class BoughtProductsHandler(BaseHandler, BoughtDBHandler):
 
@@ -892,14 +1509,25 @@ class BoughtProductsHandler(BaseHandler, BoughtDBHandler):
     sample request
     return 404 if no items found
     www.base.com/user/konrad/bought
+    www.base.com/user/konrad/bought?format=columnar
     """
 
+    @tornado.web.asynchronous
+    @gen.coroutine
     def get(self, username):
         try:
-            resp = self.get_users_bought_products(username, uuid = False)
-            if not resp:
+            columnar = self.get_columnar()
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+        try:
+            resp = yield self.async_db(BoughtDBHandler).get_users_bought_products(username, uuid = False,
+                                                                                  columnar = columnar)
+            if not resp or (columnar and not resp["rows"]):
                 self.generic_resp(404)
-            self.write(json.dumps(resp))
+                return
+            self.write(dumps(resp))
+            self.finish()
             return
 
         except Exception as e:
@@ -909,19 +1537,128 @@ class SoldProductsHandler(BaseHandler, BoughtDBHandler):
     """
     View for gettting all items that the person is selling 
     return 404 if no items found
+    accepts format=columnar (see BaseHandler.get_columnar)
     """
+    @tornado.web.asynchronous
+    @gen.coroutine
     def get(self, username):
         try:
-            resp = self.get_users_sold_products(username)
-            if not resp:
+            columnar = self.get_columnar()
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+        try:
+            resp = yield self.async_db(BoughtDBHandler).get_users_sold_products(username, columnar)
+            if not resp or (columnar and not resp["rows"]):
                 self.generic_resp(404)
-            self.write(json.dumps(resp))
+                return
+            self.write(dumps(resp))
+            self.finish()
             return
 
         except Exception as e:
             self.generic_resp(500, str(e))
 
 
+class ExportHandler(BaseHandler):
+    """
+    Base of handlers streaming whole table as NDJSON (one json object per line),
+    rows are read in chunks of chunk_size, every chunk is written
+    and flushed before next one is read so memory use doesnt depend on table size
+
+    query parameters:
+        since -- (optional) next_since returned by previous export,
+        only rows added after it are exported
+        fields -- (optional) comma separated field_tuple fields to export
+
+    last line contains export metadata:
+        {"_metadata": {"count": 1200, "next_since": "MTIwMA"}}
+    response without it was interrupted
+    """
+
+    chunk_size = EXPORT_CHUNK_ROWS
+    # fields that can be exported and fields that never are
+    field_tuple = ()
+    exclude_fields = ()
+
+    def export_chunk(self, after, fields):
+        """
+        Returns future of tuple (rows, key of last row),
+        see db_base.BaseDBHandler.export_rows_after
+        """
+        raise NotImplementedError
+
+    @tornado.web.asynchronous
+    @gen.coroutine
+    def get(self):
+        try:
+            keyset, last = self.get_page_cursor("since")
+            fields = self.get_fields(self.field_tuple, self.exclude_fields)
+        except ValueError as e:
+            self.generic_resp(400, str(e))
+            return
+
+        count = 0
+        streaming = False
+        while True:
+            try:
+                rows, key = yield self.export_chunk(last, fields)
+            except Exception as e:
+                if not streaming:
+                    self.generic_resp(500, str(e))
+                else:
+                    # already streaming, leave out metadata line
+                    logging.error("Export failed: {0}".format(e))
+                    self.finish()
+                return
+            if not streaming:
+                # set only once first chunk was read, errors before stay plain json responses
+                self.set_header("Content-Type", "application/x-ndjson")
+                streaming = True
+            if rows:
+                self.write("".join(dumps(row) + "\n" for row in rows))
+                count += len(rows)
+                last = key
+            if len(rows) < self.chunk_size:
+                break
+            yield gen.Task(self.flush)
+            if self.request.connection.stream.closed():
+                return
+
+        next_since = encode_cursor(last) if last is not None else ""
+        self.write(dumps(dict(_metadata = dict(count = count, next_since = next_since))) + "\n")
+        self.finish()
+
+class UsersExportHandler(ExportHandler):
+    """
+    Streams all users as NDJSON without private fields
+    (same as /users), see ExportHandler
+
+    sample request: www.base.com/users/export?since=MTIwMA
+    """
+
+    field_tuple = USER_FIELDS
+    exclude_fields = SECURE_USER_FIELDS
+
+    def export_chunk(self, after, fields):
+        return self.async_db(UserDatabaseHandler).export_users(self.chunk_size, after, safe = True, fields = fields)
+
+class ProductsExportHandler(ExportHandler):
+    """
+    Streams all products as NDJSON, see ExportHandler
+
+    query parameters:
+        category -- (optional) exports only products from given category
+
+    sample request: www.base.com/products/export?category=Tools&since=MTIwMA
+    """
+
+    field_tuple = PRODUCT_FIELDS
+
+    def export_chunk(self, after, fields):
+        category = self.get_query_argument("category", None)
+        return self.async_db(ProductDatabaseHandler).export_products(self.chunk_size, after, category, fields)
+
 
 class AuthenticationHandler(BaseHandler, AuthDBHandler):
     """
@@ -930,11 +1667,13 @@ class AuthenticationHandler(BaseHandler, AuthDBHandler):
     implements only get method and is meant to be used 
     by async http client on backend side
     expects following query parameters:
-        username password persist -- (optional) if set to 1 returns encrypted cookie to be saved in the browser if 0 returns 1 if succesfully authenticated or 0 if not 
+        username password persist -- (optional) if set to 1 returns signed session token (see generate_session_token) to be saved in the browser if 0 returns 1 if succesfully authenticated or 0 if not 
+    session token can be used instead of password by handlers that modify data
 
     sample request: www.base.py/auth?username=x&password=y?persist=1
     """
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
 
         username = self.get_query_argument("username", None)
@@ -951,19 +1690,23 @@ class AuthenticationHandler(BaseHandler, AuthDBHandler):
             persist = False
 
         try:
-            hash = self.get_password(username, uuid = False)
+            user, user_uuid, authenticated = yield self.verify_credentials(username, password, direct = True)
         except:
             self.generic_resp(500)
             return
 
-        authenticated = check_password_hash(password, hash)
         if not authenticated:
             self.write(str(0))
             self.finish()
             return
 
         if persist:
-            self.write(generate_secure_cookie(username))
+            try:
+                user = yield self.service.get_credentials(user_uuid)
+            except:
+                self.generic_resp(500)
+                return
+            self.write(generate_session_token(user[0], user[2], user[1]))
             self.set_status(201)
             self.finish()
             return
@@ -973,11 +1716,42 @@ class AuthenticationHandler(BaseHandler, AuthDBHandler):
         
 
 
+class StatsHandler(BaseHandler):
+    """
+    Returns runtime statistics of the application,
+    connection pool usage, response and auth cache
+    """
+
+    def get(self):
+        result = dict()
+        result["pool"] = self.application.pool_stats.as_dict()
+        result["cache"] = self.application.cache.as_dict()
+        result["auth_cache"] = self.application.auth_cache.as_dict()
+        result["status"] = 200
+        result["message"] = "OK"
+        self.write(dumps(result))
+
+
 def main():
+    """
+    Runs the server, with --workers greater than 1 forks worker processes
+    accepting connections on shared socket, parent process only restarts
+    workers that died (see tornado.process.fork_processes)
+    """
     sys.path.append(os.path.dirname(os.path.realpath(__file__)))
     tornado.options.parse_command_line()
-    app = Application(engine.connect())
+    sockets = bind_sockets(options.port)
+    cache_counters = None
+    if options.workers > 1:
+        # shared memory has to exist before the fork
+        cache_counters = dict(cache = SharedCounter(), auth_cache = SharedCounter(),
+                              revocations = SessionRevocations())
+        process.fork_processes(options.workers)
+    # engine, pool, executors and IOLoop are created after the fork,
+    # connections and threads cant be shared between processes
+    db_engine = create_db_engine(options.database)
+    app = Application(db_engine, cache_counters = cache_counters)
     http_server = HTTPServer(app)
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    http_server.add_sockets(sockets)
+    IOLoop.instance().start()
     
@@ -1,9 +1,19 @@
+import os
+from alembic.config import Config
+from alembic import command
+
 from core.models import metadata, engine
-from core.config import DATABASE_PATH
+from core.config import DATABASE_PATH, ROOT_PATH
+from core.db_base import MiscDBHandler
 
 
 
 if __name__ == "__main__":
     metadata.bind = engine
     metadata.create_all()
+    MiscDBHandler(engine.connect()).reconcile_counters()
+    # fresh database already has current schema, mark it as migrated
+    alembic_cfg = Config(os.path.join(ROOT_PATH, "alembic.ini"))
+    alembic_cfg.set_main_option("script_location", os.path.join(ROOT_PATH, "migrations"))
+    command.stamp(alembic_cfg, "head")
     print "Database Created : " +  DATABASE_PATH
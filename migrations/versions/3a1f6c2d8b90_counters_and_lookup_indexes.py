@@ -0,0 +1,57 @@
+"""counters table and lookup indexes
+
+Brings databases created by create_db.py before migrations existed
+up to date: creates maintained counters and indexes used by lookups
+in db_base.py
+
+Revision ID: 3a1f6c2d8b90
+Revises: None
+Create Date: 2014-03-02 18:21:40.512043
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f6c2d8b90'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.engine.reflection import Inspector
+
+
+INDEXES = (
+    ("ix_users_user_uuid", "users", ["user_uuid"]),
+    ("ix_users_username", "users", ["username"]),
+    ("ix_users_email", "users", ["email"]),
+    ("ix_bought_products_user_product", "bought_products", ["user_id", "product_id"]),
+    ("ix_bought_products_product_id", "bought_products", ["product_id"]),
+    ("ix_products_product_uuid", "products", ["product_uuid"]),
+    ("ix_products_product_name", "products", ["product_name"]),
+    ("ix_products_seller", "products", ["seller"]),
+    ("ix_products_category", "products", ["category", "product_id"]),
+)
+
+
+def upgrade():
+    inspector = Inspector.from_engine(op.get_bind())
+    if "counters" not in inspector.get_table_names():
+        op.create_table("counters",
+                        sa.Column("name", sa.String(80), primary_key = True),
+                        sa.Column("value", sa.Integer, nullable = False, default = 0))
+    op.execute("DELETE FROM counters")
+    op.execute("INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    op.execute("INSERT INTO counters (name, value) SELECT 'products', COUNT(*) FROM products")
+    op.execute("INSERT INTO counters (name, value) "
+               "SELECT 'products:' || category, COUNT(*) FROM products "
+               "WHERE category IS NOT NULL GROUP BY category")
+
+    for name, table, columns in INDEXES:
+        existing = [index["name"] for index in inspector.get_indexes(table)]
+        if name not in existing:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table)
+    op.drop_table("counters")
@@ -0,0 +1,37 @@
+"""unique bought product per user
+
+Merges duplicate (user_id, product_id) rows summing their quantities
+and makes the index on these columns unique, it is used as conflict
+target by the purchase upsert
+
+Revision ID: 51c9e0a7d3f2
+Revises: 3a1f6c2d8b90
+Create Date: 2014-03-04 21:02:13.118720
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51c9e0a7d3f2'
+down_revision = '3a1f6c2d8b90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("UPDATE bought_products SET quantity = ("
+               "    SELECT SUM(b.quantity) FROM bought_products b"
+               "    WHERE b.user_id = bought_products.user_id AND b.product_id = bought_products.product_id)"
+               " WHERE bought_id IN ("
+               "    SELECT MIN(bought_id) FROM bought_products"
+               "    GROUP BY user_id, product_id HAVING COUNT(*) > 1)")
+    op.execute("DELETE FROM bought_products WHERE bought_id NOT IN ("
+               "    SELECT MIN(bought_id) FROM bought_products GROUP BY user_id, product_id)")
+    op.drop_index("ix_bought_products_user_product", "bought_products")
+    op.create_index("ix_bought_products_user_product", "bought_products",
+                    ["user_id", "product_id"], unique = True)
+
+
+def downgrade():
+    op.drop_index("ix_bought_products_user_product", "bought_products")
+    op.create_index("ix_bought_products_user_product", "bought_products", ["user_id", "product_id"])
@@ -0,0 +1,32 @@
+"""unique uuid indexes
+
+Makes indexes on user_uuid and product_uuid unique, new rows are
+inserted with random uuid straight away and retried on collision
+instead of checking if uuid is taken first
+
+Revision ID: 6e4b2f91c7a5
+Revises: 51c9e0a7d3f2
+Create Date: 2014-03-06 19:44:51.530112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e4b2f91c7a5'
+down_revision = '51c9e0a7d3f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.drop_index("ix_users_user_uuid", "users")
+    op.create_index("ix_users_user_uuid", "users", ["user_uuid"], unique = True)
+    op.drop_index("ix_products_product_uuid", "products")
+    op.create_index("ix_products_product_uuid", "products", ["product_uuid"], unique = True)
+
+
+def downgrade():
+    op.drop_index("ix_products_product_uuid", "products")
+    op.create_index("ix_products_product_uuid", "products", ["product_uuid"])
+    op.drop_index("ix_users_user_uuid", "users")
+    op.create_index("ix_users_user_uuid", "users", ["user_uuid"])
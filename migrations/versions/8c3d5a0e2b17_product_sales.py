@@ -0,0 +1,36 @@
+"""product sales
+
+Adds product_sales table holding total quantity sold per product,
+seeded from bought_products, /products/top reads it through
+the quantity index instead of aggregating all purchases
+
+Revision ID: 8c3d5a0e2b17
+Revises: 6e4b2f91c7a5
+Create Date: 2014-03-08 16:12:37.904415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c3d5a0e2b17'
+down_revision = '6e4b2f91c7a5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table("product_sales",
+                    sa.Column("product_id", sa.Integer,
+                              sa.ForeignKey("products.product_id", ondelete = "CASCADE"),
+                              primary_key = True),
+                    sa.Column("quantity", sa.Integer, nullable = False, default = 0))
+    op.execute("INSERT INTO product_sales (product_id, quantity) "
+               "SELECT bought_products.product_id, SUM(bought_products.quantity) "
+               "FROM bought_products JOIN products ON products.product_id = bought_products.product_id "
+               "GROUP BY bought_products.product_id")
+    op.create_index("ix_product_sales_quantity", "product_sales", ["quantity"])
+
+
+def downgrade():
+    op.drop_index("ix_product_sales_quantity", "product_sales")
+    op.drop_table("product_sales")
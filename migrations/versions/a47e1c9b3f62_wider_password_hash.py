@@ -0,0 +1,29 @@
+"""wider password hash
+
+Password hashes now store algorithm, cost and salt
+(pbkdf2_sha256$iterations$salt$hash) and dont fit in 40 characters.
+Existing sha1 hashes are kept and replaced on next login
+
+Revision ID: a47e1c9b3f62
+Revises: 8c3d5a0e2b17
+Create Date: 2014-03-10 20:31:05.218374
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a47e1c9b3f62'
+down_revision = '8c3d5a0e2b17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # sqlite doesnt enforce length of varchar (nor supports altering columns)
+    if op.get_bind().dialect.name != "sqlite":
+        op.alter_column("users", "password", type_ = sa.String(128), existing_type = sa.String(40))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        op.alter_column("users", "password", type_ = sa.String(40), existing_type = sa.String(128))
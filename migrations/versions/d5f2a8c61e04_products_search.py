@@ -0,0 +1,53 @@
+"""products search
+
+Adds products_search full text index (sqlite FTS5) over product names
+and descriptions, kept in sync with products by triggers,
+and fills it with existing products
+
+Revision ID: d5f2a8c61e04
+Revises: a47e1c9b3f62
+Create Date: 2014-03-12 18:44:21.570913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd5f2a8c61e04'
+down_revision = 'a47e1c9b3f62'
+
+from alembic import op
+import sqlalchemy as sa
+
+# copied so later changes to models dont change this revision
+PRODUCTS_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE products_search USING fts5("
+    "product_name, product_desc, content='products', content_rowid='product_id')",
+    "CREATE TRIGGER products_search_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO products_search (rowid, product_name, product_desc) "
+    "VALUES (new.product_id, new.product_name, new.product_desc); END",
+    "CREATE TRIGGER products_search_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO products_search (products_search, rowid, product_name, product_desc) "
+    "VALUES ('delete', old.product_id, old.product_name, old.product_desc); END",
+    "CREATE TRIGGER products_search_update AFTER UPDATE OF product_name, product_desc ON products BEGIN "
+    "INSERT INTO products_search (products_search, rowid, product_name, product_desc) "
+    "VALUES ('delete', old.product_id, old.product_name, old.product_desc); "
+    "INSERT INTO products_search (rowid, product_name, product_desc) "
+    "VALUES (new.product_id, new.product_name, new.product_desc); END",
+)
+
+
+def upgrade():
+    # full text search is implemented only for sqlite
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for statement in PRODUCTS_SEARCH_DDL:
+        op.execute(statement)
+    op.execute("INSERT INTO products_search (products_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    op.execute("DROP TRIGGER products_search_update")
+    op.execute("DROP TRIGGER products_search_delete")
+    op.execute("DROP TRIGGER products_search_insert")
+    op.execute("DROP TABLE products_search")
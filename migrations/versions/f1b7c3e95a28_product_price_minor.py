@@ -0,0 +1,77 @@
+"""product price minor
+
+Adds products.price_minor, price in minor units parsed from free form
+price string, with indexes for price range filters and sorting
+(alone and within category)
+
+Revision ID: f1b7c3e95a28
+Revises: d5f2a8c61e04
+Create Date: 2014-03-14 11:02:47.381920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c3e95a28'
+down_revision = 'd5f2a8c61e04'
+
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+# copied from helper_functions so later changes dont change this revision
+PRICE_PATTERN = re.compile(ur"\d+(?:(?:[.,]|[ \u00a0](?=\d{3}(?!\d)))\d+)*")
+BATCH = 10000
+
+
+def parse_price(price):
+    if price is None:
+        return None
+    match = PRICE_PATTERN.search(unicode(price))
+    if not match:
+        return None
+    groups = re.split(r"\D", match.group())
+    separators = re.findall(r"\D", match.group())
+    minor = u"0"
+    if separators and separators[-1] in u".," and len(groups[-1]) <= 2:
+        minor = groups.pop()
+        # decimal separator cant be also thousands separator
+        if separators.pop() in separators:
+            return None
+    if separators:
+        if len(set(separators)) > 1 or groups[0].startswith(u"0") or len(groups[0]) > 3:
+            return None
+        if any(len(group) != 3 for group in groups[1:]):
+            return None
+    return int(u"".join(groups)) * 100 + int(minor.ljust(2, u"0"))
+
+
+def upgrade():
+    op.add_column("products", sa.Column("price_minor", sa.Integer))
+    conn = op.get_bind()
+    products = sa.sql.table("products", sa.sql.column("product_id"), sa.sql.column("price"),
+                            sa.sql.column("price_minor"))
+    update_q = products.update()\
+            .where(products.c.product_id == sa.bindparam("id"))\
+            .values(price_minor = sa.bindparam("minor"))
+    last = 0
+    while True:
+        rows = conn.execute(sa.select([products.c.product_id, products.c.price])
+                            .where(products.c.product_id > last)
+                            .order_by(products.c.product_id).limit(BATCH)).fetchall()
+        if not rows:
+            break
+        updates = [dict(id = product_id, minor = parse_price(price)) for product_id, price in rows
+                   if parse_price(price) is not None]
+        if updates:
+            conn.execute(update_q, updates)
+        last = rows[-1][0]
+    op.create_index("ix_products_price_minor", "products", ["price_minor", "product_id"])
+    op.create_index("ix_products_category_price_minor", "products", ["category", "price_minor", "product_id"])
+
+
+def downgrade():
+    op.drop_index("ix_products_category_price_minor", "products")
+    op.drop_index("ix_products_price_minor", "products")
+    # sqlite supports dropping columns since 3.35
+    op.drop_column("products", "price_minor")